@@ -0,0 +1,41 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module serving aggregated API and job stats (see instrumentation.py).
+
+Kept separate from instrumentation so that webapp2 is not imported by
+instances which only serve the API.
+"""
+
+
+import json
+
+import webapp2
+
+import instrumentation
+import jobs
+import services
+import worker  # Registers the job types.
+
+
+class StatsHandler(webapp2.RequestHandler):
+  """Handler serving aggregated API stats as JSON.
+
+  Only meant to be served to admins; see app.yaml.
+  """
+
+  def get(self):
+    """Writes stats for every remote method of the served APIs and job type."""
+    methods = []
+    for api_class in services.api_list:
+      for method_name in sorted(api_class.all_remote_methods()):
+        methods.append('%s.%s' % (api_class.__name__, method_name))
+    methods.extend(jobs.registered_names())
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(instrumentation.get_stats(methods),
+                                   indent=2, sort_keys=True))
+
+
+application = webapp2.WSGIApplication([
+    ('/admin/stats', StatsHandler),
+])
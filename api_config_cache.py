@@ -0,0 +1,193 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Helper module to start the Endpoints API server from a stored API config.
+
+endpoints.api_server generates the JSON API config for the service classes
+(walking every method and message class) on every instance start. The config
+only changes when the API code does, so make_api_config.py generates it once
+before deploying and stores it in API_CONFIG_FILE along with a fingerprint of
+the API source files, including the bundled endpoints-proto-datastore library
+(which determines the message classes of ProtoModel methods), and the hostname
+the config was generated for (the config contains the API root URL).
+
+api_server below uses the stored config in place of generating it, as long as
+the fingerprint and hostname still match; otherwise (or if the file is
+missing) the config is generated as usual and a warning is logged.
+
+Beware, as in auth_util, this involves temporarily replacing a method of the
+endpoints library.
+"""
+
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+
+from google.appengine.ext import endpoints
+from google.appengine.ext.endpoints import api_config
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+API_CONFIG_FILE = os.path.join(APP_ROOT, 'api-config.json')
+# Files which determine the API config.
+SOURCE_FILES = ('auth_util.py', 'models.py', 'picturesque.py', 'settings.py')
+# Directories of libraries whose Python files also determine the API config.
+SOURCE_DIRECTORIES = (
+    os.path.join('endpoints-proto-datastore', 'endpoints_proto_datastore'),)
+# Set to any value to always generate the config, e.g. to compare start times.
+DISABLE_ENV_VAR = 'PICTURESQUE_DISABLE_API_CONFIG_CACHE'
+HOSTNAME_ENV_VAR = 'DEFAULT_VERSION_HOSTNAME'
+
+
+original_pretty_print = (
+    api_config.ApiConfigGenerator.pretty_print_config_to_json.im_func)
+
+
+@contextlib.contextmanager
+def _patched_pretty_print(patched):
+  """Replaces ApiConfigGenerator.pretty_print_config_to_json temporarily.
+
+  Args:
+    patched: Function to be used as the method while the context is active.
+      It is passed the same arguments as the original method.
+  """
+  api_config.ApiConfigGenerator.pretty_print_config_to_json = patched
+  try:
+    yield
+  finally:
+    api_config.ApiConfigGenerator.pretty_print_config_to_json = (
+        original_pretty_print)
+
+
+def _SourcePaths():
+  """Lists the files the API config is generated from.
+
+  Returns:
+    List of paths relative to APP_ROOT, in a stable order.
+  """
+  paths = list(SOURCE_FILES)
+  for directory in SOURCE_DIRECTORIES:
+    library_paths = []
+    for dirpath, _, filenames in os.walk(os.path.join(APP_ROOT, directory)):
+      library_paths.extend(
+          os.path.relpath(os.path.join(dirpath, filename), APP_ROOT)
+          for filename in filenames if filename.endswith('.py'))
+    paths.extend(sorted(library_paths))
+  return paths
+
+
+def source_fingerprint():
+  """Computes a fingerprint of the files the API config is generated from.
+
+  Returns:
+    String containing a hex digest.
+  """
+  digest = hashlib.sha1()
+  for path in _SourcePaths():
+    # The path is included so that moving code between files is noticed.
+    digest.update(path.replace(os.sep, '/') + '\0')
+    with open(os.path.join(APP_ROOT, path), 'rb') as fh:
+      digest.update(fh.read())
+  return digest.hexdigest()
+
+
+def services_key(service_classes):
+  """Creates the key under which the config for service classes is stored.
+
+  Args:
+    service_classes: List of protorpc.remote.Service subclasses which are
+      served together as one API version.
+
+  Returns:
+    String naming the classes.
+  """
+  return ','.join(sorted('%s.%s' % (service_class.__module__,
+                                    service_class.__name__)
+                         for service_class in service_classes))
+
+
+def load_configs():
+  """Loads stored API configs if they match the current source files.
+
+  Returns:
+    Dictionary of API config JSON strings keyed by services_key, empty if
+      there is no usable stored config.
+  """
+  if os.getenv(DISABLE_ENV_VAR):
+    return {}
+
+  try:
+    with open(API_CONFIG_FILE, 'rb') as fh:
+      stored = json.load(fh)
+  except (IOError, ValueError):
+    logging.warning('No stored API config in %s.', API_CONFIG_FILE)
+    return {}
+
+  if stored.get('fingerprint') != source_fingerprint():
+    logging.warning('Stored API config is out of date; regenerate it with '
+                    'make_api_config.py.')
+    return {}
+  if stored.get('hostname') != os.getenv(HOSTNAME_ENV_VAR):
+    logging.warning('Stored API config was generated for %s, not %s.',
+                    stored.get('hostname'), os.getenv(HOSTNAME_ENV_VAR))
+    return {}
+  return stored.get('configs', {})
+
+
+def api_server(api_services, **kwargs):
+  """Creates an Endpoints API server, using stored API configs if possible.
+
+  Args:
+    api_services: List of protorpc.remote.Service classes implementing the
+      API, as for endpoints.api_server.
+    **kwargs: Passed through to endpoints.api_server.
+
+  Returns:
+    The WSGI application returned by endpoints.api_server.
+  """
+  configs = load_configs()
+
+  def pretty_print_from_cache(generator, services, *args, **kwargs):
+    config = None
+    if not (args or kwargs):
+      config = configs.get(services_key(services))
+    if config is None:
+      config = original_pretty_print(generator, services, *args, **kwargs)
+    return config
+
+  with _patched_pretty_print(pretty_print_from_cache):
+    return endpoints.api_server(api_services, **kwargs)
+
+
+def write_configs(api_services, **kwargs):
+  """Generates the API configs for services and stores them.
+
+  The configs are recorded while creating an API server exactly as
+  api_server does, so the stored keys match the ones looked up at startup.
+  The hostname the API will be served from must be set in the environment
+  (as HOSTNAME_ENV_VAR) beforehand.
+
+  Args:
+    api_services: List of protorpc.remote.Service classes implementing the
+      API, as for endpoints.api_server.
+    **kwargs: Passed through to endpoints.api_server.
+  """
+  configs = {}
+
+  def recording_pretty_print(generator, services, *args, **kwargs):
+    config = original_pretty_print(generator, services, *args, **kwargs)
+    if not (args or kwargs):
+      configs[services_key(services)] = config
+    return config
+
+  with _patched_pretty_print(recording_pretty_print):
+    endpoints.api_server(api_services, **kwargs)
+
+  with open(API_CONFIG_FILE, 'wb') as fh:
+    json.dump({
+        'configs': configs,
+        'fingerprint': source_fingerprint(),
+        'hostname': os.getenv(HOSTNAME_ENV_VAR),
+    }, fh, indent=2, sort_keys=True)
@@ -0,0 +1,582 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Benchmark harness for the Picturesque API against local service stubs.
+
+Seeds synthetic users and photos into the testbed datastore stub, then calls
+the PicturesqueApi methods directly (as the Endpoints SPI handler would) and
+reports, per workload, latency percentiles, the mean number of service RPCs
+per call (datastore_v3, taskqueue, urlfetch, memcache) and the mean size of
+the JSON serialized response.
+
+Authentication is simulated: the harness sets the Endpoints user in the
+environment and replaces auth_util.get_google_plus_user_id so no tokens or
+network calls are involved.
+
+Usage (from the application root):
+
+  python benchmark.py --sdk /path/to/google_appengine \\
+      --users 20 --photos-per-user 100 --acl-size 10 --tags 25 \\
+      --iterations 200 --workloads create,read,list,patch,acl,signup,similar
+
+Use --serialization-pages 10,100,1000 to also compare the default and fast
+(PhotoMessageSerializer) photo.list serialization paths, --startup-runs N to
+time instance startup with and without the stored API config (see
+api_config_cache.py), --storage to keep photo contents in a storage backend
+(see photo_storage.py), --parent-photos to store photos under their owner
+and list them with ancestor queries and --json to emit machine readable
+results for comparing runs.
+"""
+
+
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+WORKLOADS = ('create', 'read', 'list', 'list_shared', 'patch', 'acl',
+             'signup', 'similar')
+STORAGE_BACKENDS = ('inline', 'datastore', 'local')
+AUTH_DOMAIN = 'gmail.com'
+PERCENTILES = (50, 90, 99)
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a fresh interpreter to measure the time until services.application
+# is ready, i.e. the work done by a loading request.
+STARTUP_SCRIPT = """
+import os
+import sys
+import time
+
+sys.path.insert(0, %(sdk)r)
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+start = time.time()
+import appengine_config
+import services
+print time.time() - start
+"""
+
+
+def fix_sys_path(sdk_path):
+  """Adds the App Engine SDK and its bundled libraries to sys.path.
+
+  Args:
+    sdk_path: String; path to the google_appengine SDK directory.
+  """
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+
+
+def percentile(sorted_values, percent):
+  """Nearest-rank percentile of an already sorted list.
+
+  Args:
+    sorted_values: Non-empty list of numbers in ascending order.
+    percent: Number between 0 and 100.
+
+  Returns:
+    The value at the given percentile.
+  """
+  index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+  return sorted_values[index]
+
+
+class RpcCounter(object):
+  """Counts service RPCs made through the API proxy.
+
+  Installed as a pre-call hook, so it sees every RPC made by ndb, the task
+  queue (see jobs.py), urlfetch and so on, keyed as 'service.Method'.
+  """
+
+  def __init__(self):
+    self.counts = collections.Counter()
+
+  def __call__(self, service, call, unused_request, unused_response):
+    """Pre-call hook; counts a single RPC."""
+    self.counts['%s.%s' % (service, call)] += 1
+
+  def Reset(self):
+    """Clears the counts and returns the previous ones."""
+    counts = self.counts
+    self.counts = collections.Counter()
+    return counts
+
+
+class WorkloadResult(object):
+  """Accumulates measurements for one workload."""
+
+  def __init__(self, name):
+    self.name = name
+    self.latencies = []
+    self.errors = collections.Counter()
+    self.rpcs = collections.Counter()
+    self.response_bytes = 0
+
+  def Record(self, latency, rpc_counts, response_bytes, error=None):
+    """Records a single call."""
+    self.latencies.append(latency)
+    self.rpcs.update(rpc_counts)
+    self.response_bytes += response_bytes
+    if error is not None:
+      self.errors[error] += 1
+
+  def Summary(self):
+    """Returns a dictionary summarizing the workload."""
+    calls = len(self.latencies)
+    latencies = sorted(self.latencies)
+    summary = {
+        'workload': self.name,
+        'calls': calls,
+        'errors': dict(self.errors),
+        'meanResponseBytes': self.response_bytes / float(calls or 1),
+        'rpcsPerCall': dict((name, count / float(calls or 1))
+                            for name, count in self.rpcs.iteritems()),
+    }
+    for percent in PERCENTILES:
+      summary['p%dMs' % percent] = (
+          1000 * percentile(latencies, percent) if latencies else 0.0)
+    summary['maxMs'] = 1000 * latencies[-1] if latencies else 0.0
+    return summary
+
+
+class Benchmark(object):
+  """Seeds the stub datastore and drives API workloads against it.
+
+  Args:
+    args: The parsed command line arguments.
+  """
+
+  def __init__(self, args):
+    self.args = args
+    self.random = random.Random(args.seed)
+    self.users = []  # List of (googleplus_user_id, users.User) tuples
+    self.photo_keys = collections.defaultdict(list)
+    self.shared_with = collections.defaultdict(set)
+    self.current_googleplus_user_id = None
+
+  def SetUp(self):
+    """Activates the testbed stubs and wires in simulated authentication."""
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    import appengine_config  # For import path mangling
+    import auth_util
+    from models import Photo
+    import photo_storage
+    import picturesque
+    import rate_limit
+
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.setup_env(auth_domain=AUTH_DOMAIN, overwrite=True)
+    # Strongly consistent, so seeded data is visible to queries at once.
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    self.testbed.init_urlfetch_stub()
+    # Photo.ComputePerceptualHash shrinks photos with the Images API.
+    self.testbed.init_images_stub()
+    self.testbed.init_user_stub()
+
+    auth_util.get_google_plus_user_id = lambda: self.current_googleplus_user_id
+    rate_limit.ENABLED = self.args.rate_limit
+    Photo.PARENT_UNDER_OWNER = self.args.parent_photos
+    Photo.OWNER_ANCESTOR_QUERIES = self.args.parent_photos
+
+    self.storage_root = None
+    if self.args.storage == 'datastore':
+      photo_storage.set_storage(photo_storage.DatastoreStorage())
+    elif self.args.storage == 'local':
+      self.storage_root = tempfile.mkdtemp(prefix='picturesque-photos-')
+      photo_storage.set_storage(
+          photo_storage.LocalFileStorage(self.storage_root))
+
+    self.rpc_counter = RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'benchmark_rpc_counter', self.rpc_counter)
+
+    self.api = picturesque.PicturesqueApi()
+
+  def TearDown(self):
+    """Deactivates the testbed stubs and removes stored photo contents."""
+    import photo_storage
+
+    photo_storage.set_storage(None)
+    if self.storage_root is not None:
+      shutil.rmtree(self.storage_root, ignore_errors=True)
+    self.testbed.deactivate()
+
+  def _Photo(self, googleplus_user_id, owner, acl, perceptual_hash):
+    """Creates a synthetic (unsaved) Photo."""
+    from models import Photo
+    return Photo(parent=Photo.OwnerParent(googleplus_user_id),
+                 title=self._Title(), description=self._Description(),
+                 base64_photo=os.urandom(self.args.photo_bytes),
+                 mime_type='image/jpeg', owner=owner, acl=acl,
+                 perceptual_hash=perceptual_hash)
+
+  def _PerceptualHash(self, previous_hashes):
+    """Returns a random perceptual hash for a synthetic photo.
+
+    The synthetic contents aren't images, so hashes are made up: a fraction
+    of the photos (--near-duplicates) are a few bits away from an earlier
+    photo of the same user, as in bursts of similar shots.
+    """
+    import image_hash
+
+    if previous_hashes and self.random.random() < self.args.near_duplicates:
+      value = image_hash.from_string(self.random.choice(previous_hashes))
+      for bit in self.random.sample(xrange(image_hash.HASH_BITS),
+                                    self.random.randint(1, 3)):
+        value ^= 1 << bit
+    else:
+      value = self.random.getrandbits(image_hash.HASH_BITS)
+    return image_hash.to_string(value)
+
+  def _Title(self):
+    """Returns a random photo title."""
+    return 'Photo %d' % self.random.randint(0, 10 ** 6)
+
+  def _Description(self):
+    """Returns a description with random hash tags."""
+    tags = ['#tag%d' % self.random.randrange(self.args.tags)
+            for _ in xrange(self.args.tags_per_photo)]
+    return 'Synthetic photo %s' % ' '.join(tags)
+
+  def Seed(self):
+    """Seeds users and photos according to the configured scale."""
+    from google.appengine.api import users
+    from google.appengine.ext import ndb
+    from models import PicturesqueUser
+
+    for index in xrange(self.args.users):
+      googleplus_user_id = str(10 ** 9 + index)
+      user = users.User(email='user%d@example.com' % index)
+      self.users.append((googleplus_user_id, user))
+
+    all_ids = [googleplus_user_id for googleplus_user_id, _ in self.users]
+    for googleplus_user_id, user in self.users:
+      others = [other for other in all_ids if other != googleplus_user_id]
+      photos = []
+      for _ in xrange(self.args.photos_per_user):
+        acl = self.random.sample(others, min(self.args.acl_size, len(others)))
+        for shared_with_id in acl:
+          self.shared_with[shared_with_id].add(googleplus_user_id)
+        perceptual_hash = self._PerceptualHash(
+            [photo.perceptual_hash for photo in photos])
+        photos.append(self._Photo(googleplus_user_id, user, acl,
+                                  perceptual_hash))
+      ndb.put_multi(photos)
+      self.photo_keys[googleplus_user_id].extend(
+          photo.key for photo in photos)
+
+    ndb.put_multi([
+        PicturesqueUser(id=googleplus_user_id, user_object=user,
+                        in_users_acl_list=sorted(
+                            self.shared_with[googleplus_user_id]))
+        for googleplus_user_id, user in self.users])
+
+  def _SignIn(self):
+    """Makes a random seeded user the current user; returns their ID."""
+    googleplus_user_id, user = self.random.choice(self.users)
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = user.email()
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = AUTH_DOMAIN
+    self.current_googleplus_user_id = googleplus_user_id
+    return googleplus_user_id
+
+  def _Request(self, method_name, **kwargs):
+    """Builds a request message for an API method."""
+    method = getattr(self.api, method_name)
+    return method.remote.request_type(**kwargs)
+
+  def _Call(self, result, method_name, request):
+    """Calls an API method as a fresh request and records the outcome."""
+    from google.appengine.ext import ndb
+    from protorpc import protojson
+
+    # Each call should behave like a new request with a cold context cache.
+    ndb.get_context().clear_cache()
+    self.rpc_counter.Reset()
+    error = None
+    response = None
+    start = time.time()
+    try:
+      response = getattr(self.api, method_name)(request)
+    except Exception as exc:  # Record every failure, Endpoints or not.
+      error = exc.__class__.__name__
+    latency = time.time() - start
+
+    response_bytes = 0
+    if response is not None:
+      response_bytes = len(protojson.encode_message(response))
+    result.Record(latency, self.rpc_counter.Reset(), response_bytes,
+                  error=error)
+    return response
+
+  def RunCreate(self, result):
+    """photo.create with a new random photo."""
+    googleplus_user_id = self._SignIn()
+    request = self._Request(
+        'PhotoCreate', title=self._Title(), description=self._Description(),
+        base64Photo=os.urandom(self.args.photo_bytes), mimeType='image/jpeg')
+    response = self._Call(result, 'PhotoCreate', request)
+    if response is not None:
+      self.photo_keys[googleplus_user_id].append(response.key)
+
+  def RunRead(self, result):
+    """photo.read of one of the current user's photos."""
+    googleplus_user_id = self._SignIn()
+    key = self.random.choice(self.photo_keys[googleplus_user_id])
+    self._Call(result, 'PhotoRead', self._Request('PhotoRead', key=key))
+
+  def RunList(self, result):
+    """photo.list of the current user's photos."""
+    self._SignIn()
+    request = self._Request('PhotoList', limit=self.args.page_size)
+    self._Call(result, 'PhotoList', request)
+
+  def RunListShared(self, result):
+    """photo.list of photos another user shared with the current user."""
+    googleplus_user_id = self._SignIn()
+    owners = sorted(self.shared_with[googleplus_user_id]) or [
+        googleplus_user_id]
+    request = self._Request('PhotoList', limit=self.args.page_size,
+                            ownerGoogleplusUserId=self.random.choice(owners))
+    self._Call(result, 'PhotoList', request)
+
+  def RunPatch(self, result):
+    """photo.patch of the title of one of the current user's photos."""
+    googleplus_user_id = self._SignIn()
+    key = self.random.choice(self.photo_keys[googleplus_user_id])
+    request = self._Request('PhotoPatch', key=key, title=self._Title())
+    self._Call(result, 'PhotoPatch', request)
+
+  def RunAcl(self, result):
+    """acl.addUsers on one of the current user's photos."""
+    googleplus_user_id = self._SignIn()
+    key = self.random.choice(self.photo_keys[googleplus_user_id])
+    others = [other for other, _ in self.users if other != googleplus_user_id]
+    acl_user_ids = self.random.sample(others,
+                                      min(self.args.acl_size, len(others)))
+    request = self._Request('AclInsert', key=key, aclUserIds=acl_user_ids)
+    self._Call(result, 'AclInsert', request)
+
+  def RunSimilar(self, result):
+    """photo.similar for one of the current user's photos."""
+    googleplus_user_id = self._SignIn()
+    key = self.random.choice(self.photo_keys[googleplus_user_id])
+    request = self._Request('PhotoSimilar', key=key)
+    self._Call(result, 'PhotoSimilar', request)
+
+  def RunSignup(self, result):
+    """users.join for an existing user."""
+    from protorpc import message_types
+    self._SignIn()
+    self._Call(result, 'SignUp', message_types.VoidMessage())
+
+  def RunSerialization(self):
+    """Compares the default and fast photo.list serialization paths.
+
+    For each configured page size, builds a page of seeded photos and times
+    converting it to a collection message and encoding that as JSON, with
+    Photo.FAST_LIST_SERIALIZATION off and on.
+
+    Returns:
+      List of summary dictionaries, one per page size and path.
+    """
+    from protorpc import protojson
+    from models import Photo
+
+    googleplus_user_id = self._SignIn()
+    photos = Photo.query(Photo.owner == dict(self.users)[googleplus_user_id])
+    photos = photos.fetch(max(self.args.serialization_pages))
+    if not photos:
+      return []
+
+    summaries = []
+    original_setting = Photo.FAST_LIST_SERIALIZATION
+    try:
+      for page_size in self.args.serialization_pages:
+        page = (photos * (page_size // len(photos) + 1))[:page_size]
+        for fast in (False, True):
+          Photo.FAST_LIST_SERIALIZATION = fast
+          result = WorkloadResult('serialize_%d_%s' % (
+              page_size, 'fast' if fast else 'default'))
+          for _ in xrange(self.args.iterations):
+            self.rpc_counter.Reset()
+            start = time.time()
+            encoded = protojson.encode_message(Photo.ToMessageCollection(page))
+            result.Record(time.time() - start, self.rpc_counter.Reset(),
+                          len(encoded))
+          summaries.append(result.Summary())
+    finally:
+      Photo.FAST_LIST_SERIALIZATION = original_setting
+    return summaries
+
+  def Run(self):
+    """Runs the configured workloads and returns their summaries."""
+    runners = {
+        'create': self.RunCreate,
+        'read': self.RunRead,
+        'list': self.RunList,
+        'list_shared': self.RunListShared,
+        'patch': self.RunPatch,
+        'acl': self.RunAcl,
+        'signup': self.RunSignup,
+        'similar': self.RunSimilar,
+    }
+    summaries = []
+    for name in self.args.workloads:
+      result = WorkloadResult(name)
+      for _ in xrange(self.args.iterations):
+        runners[name](result)
+      summaries.append(result.Summary())
+    return summaries
+
+
+def run_startup(args):
+  """Measures instance startup with and without the stored API config.
+
+  Args:
+    args: The parsed command line arguments.
+
+  Returns:
+    List of two summary dictionaries, for generated and stored API configs.
+  """
+  import api_config_cache
+
+  env = dict(os.environ)
+  env.setdefault('CURRENT_VERSION_ID', '1.1')
+  try:
+    with open(api_config_cache.API_CONFIG_FILE, 'rb') as fh:
+      env[api_config_cache.HOSTNAME_ENV_VAR] = json.load(fh)['hostname']
+  except (IOError, ValueError, KeyError):
+    print >> sys.stderr, ('No stored API config; run make_api_config.py to '
+                          'measure startup with it.')
+
+  summaries = []
+  for name, disable_cache in (('startup_generated', True),
+                              ('startup_stored', False)):
+    run_env = dict(env)
+    if disable_cache:
+      run_env[api_config_cache.DISABLE_ENV_VAR] = '1'
+
+    result = WorkloadResult(name)
+    for _ in xrange(args.startup_runs):
+      output = subprocess.check_output(
+          [sys.executable, '-c', STARTUP_SCRIPT % {'sdk': args.sdk}],
+          cwd=APP_ROOT, env=run_env)
+      result.Record(float(output.strip().splitlines()[-1]), {}, 0)
+    summaries.append(result.Summary())
+  return summaries
+
+
+def print_summaries(summaries):
+  """Prints workload summaries as a human readable table."""
+  header = ('%-24s %6s %6s' + ' %9s' * (len(PERCENTILES) + 1) + ' %10s') % (
+      ('workload', 'calls', 'errors') +
+      tuple('p%d ms' % percent for percent in PERCENTILES) +
+      ('max ms', 'resp bytes'))
+  print header
+  for summary in summaries:
+    print ('%-24s %6d %6d' + ' %9.2f' * (len(PERCENTILES) + 1) + ' %10d') % (
+        (summary['workload'], summary['calls'],
+         sum(summary['errors'].values())) +
+        tuple(summary['p%dMs' % percent] for percent in PERCENTILES) +
+        (summary['maxMs'], summary['meanResponseBytes']))
+    for name, count in sorted(summary['rpcsPerCall'].iteritems()):
+      print '    %-40s %8.2f per call' % (name, count)
+    for name, count in sorted(summary['errors'].iteritems()):
+      print '    error %-34s %8d' % (name, count)
+
+
+def parse_args(argv):
+  """Parses command line arguments."""
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--sdk', default=os.getenv('APPENGINE_SDK'),
+                      help='Path to the App Engine SDK (or $APPENGINE_SDK).')
+  parser.add_argument('--users', type=int, default=10)
+  parser.add_argument('--photos-per-user', type=int, default=50)
+  parser.add_argument('--photo-bytes', type=int, default=32 * 1024)
+  parser.add_argument('--acl-size', type=int, default=5)
+  parser.add_argument('--tags', type=int, default=20,
+                      help='Number of distinct tags.')
+  parser.add_argument('--tags-per-photo', type=int, default=2)
+  parser.add_argument('--page-size', type=int, default=10)
+  parser.add_argument('--near-duplicates', type=float, default=0.2,
+                      help='Fraction of seeded photos whose perceptual hash '
+                           'is near that of an earlier photo.')
+  parser.add_argument('--iterations', type=int, default=100)
+  parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                      type=lambda value: value.split(','))
+  parser.add_argument('--serialization-pages', default=[],
+                      type=lambda value: [int(size)
+                                          for size in value.split(',')],
+                      help='Page sizes to compare photo.list serialization '
+                           'paths for, e.g. 10,100,1000.')
+  parser.add_argument('--startup-runs', type=int, default=0,
+                      help='Number of fresh interpreters to time importing '
+                           'services in, with and without the stored API '
+                           'config.')
+  parser.add_argument('--rate-limit', action='store_true',
+                      help='Apply the API rate limits (see rate_limit.py); '
+                           'off by default so workloads measure the methods.')
+  parser.add_argument('--storage', choices=STORAGE_BACKENDS, default='inline',
+                      help='Where photo contents are kept: inline in Photo '
+                           'entities, in PhotoContent entities or in files '
+                           'in a temporary directory.')
+  parser.add_argument('--parent-photos', action='store_true',
+                      help='Store photos under their owner\'s PicturesqueUser '
+                           'and list them with ancestor queries (see '
+                           'Photo.PARENT_UNDER_OWNER).')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--json', action='store_true',
+                      help='Print results as JSON.')
+  args = parser.parse_args(argv)
+
+  unknown = set(args.workloads) - set(WORKLOADS)
+  if unknown:
+    parser.error('Unknown workloads: %s' % ', '.join(sorted(unknown)))
+  if args.sdk is None:
+    parser.error('--sdk or $APPENGINE_SDK is required.')
+  return args
+
+
+def main(argv):
+  """Seeds the stubs, runs the workloads and prints the results."""
+  args = parse_args(argv)
+  fix_sys_path(args.sdk)
+
+  benchmark = Benchmark(args)
+  benchmark.SetUp()
+  try:
+    benchmark.Seed()
+    summaries = benchmark.Run()
+    if args.serialization_pages:
+      summaries.extend(benchmark.RunSerialization())
+  finally:
+    benchmark.TearDown()
+
+  if args.startup_runs:
+    summaries.extend(run_startup(args))
+
+  if args.json:
+    print json.dumps(summaries, indent=2, sort_keys=True)
+  else:
+    print_summaries(summaries)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -106,6 +106,11 @@ PicturesqueApp.data.joinPicturesque = function() {
  *     getPhotosCompletionCallback {Function} The method to be called when the
  *         getPhotos has reached completion. No arguments will be passed to
  *         this callback.
+ *     createFailureCallback {Function} The method to be called when the
+ *         server rejects a locally created photo. Default is a function which
+ *         does nothing. The stored photo metadata and the error message will
+ *         be passed in to this method (in that order). The photo stays local
+ *         and is sent again once it is edited.
  *     renameCallback {Function} The method to be called when a picture
  *         is renamed after getting a proper key from the server. Default is a
  *         function which does nothing. The previous key and the current photo
@@ -153,6 +158,7 @@ PicturesqueApp.data.DataStore = function(args) {
   var defaultCallback = function() {};
 
   this.renameCallback = args.renameCallback || defaultCallback;
+  this.createFailureCallback = args.createFailureCallback || defaultCallback;
   this.getPhotoCallback = args.getPhotoCallback ||
                           this.imageStore.saveSuccessCallback;
   this.getPhotosCompletionCallback = args.getPhotosCompletionCallback ||
@@ -171,6 +177,18 @@ PicturesqueApp.data.DataStore = function(args) {
   };
   this.imageStore.saveSuccessCallback = customSaveSuccessCallback;
 
+  // Writes waiting to be sent to the server. Anything left over from a
+  // previous session is flushed as soon as it is loaded.
+  this.flushInProgress = false;
+  this.flushTimeout = null;
+  this.writeLog = new PicturesqueApp.offline.WriteLog({
+    loadCallback: function() {
+      currentDataStore.scheduleFlush(0);
+    },
+    titlePropertyName: this.titlePropertyName,
+    descriptionPropertyName: this.descriptionPropertyName
+  });
+
   PicturesqueApp.data.log.push(['DataStore created with:', args]);
 };
 
@@ -241,10 +259,10 @@ PicturesqueApp.data.DataStore.prototype.addPhoto =
 
 
 /**
- * Creates task to send a 'create' request to the API, depending on the signed
- * in status and the network status. We expect the photoMetadata corresponds to
- * a photo which has already been saved locally, hence will have a key and
- * potentially some other values set that don't belong in the 'create' request.
+ * Records a 'create' for the photo in the write log and schedules a flush. We
+ * expect the photoMetadata corresponds to a photo which has already been
+ * saved locally, hence will have a key and potentially some other values set
+ * that don't belong in the 'create' request.
  *
  * @param {Object} photoMetadata An object containing photo contents.
  */
@@ -261,45 +279,174 @@ PicturesqueApp.data.DataStore.prototype.createPhoto = function(photoMetadata) {
         photoMetadata[this.descriptionPropertyName];
   }
 
-  // Need to wrap this.createCallback in anonymous fn. so it can be passed
-  // to other methods as a callback. Also need to wrap the temporary local
-  // storage key via closure.
+  this.writeLog.record(photoMetadata.key,
+                       PicturesqueApp.offline.WriteLog.CREATE, apiPayload);
+  this.scheduleFlush(0);
+};
+
+
+/**
+ * Updates the title and/or description of a photo locally and records a
+ * 'patch' in the write log. If the photo has not been created on the server
+ * yet, the change is folded into the pending 'create'.
+ *
+ * @param {string} key The key of the photo (local or from the server).
+ * @param {string} title The new title, or undefined to leave unchanged.
+ * @param {string} description The new description, or undefined to leave
+ *                             unchanged.
+ */
+PicturesqueApp.data.DataStore.prototype.patchPhoto =
+    function(key, title, description) {
+  var fields = {};
+  if (title !== undefined) {
+    fields[this.titlePropertyName] = title;
+  }
+  if (description !== undefined) {
+    fields[this.descriptionPropertyName] = description;
+  }
+
+  PicturesqueApp.offline.db.get(key, function(storedMetadata) {
+    if (storedMetadata) {
+      for (var fieldName in fields) {
+        storedMetadata[fieldName] = fields[fieldName];
+      }
+      PicturesqueApp.offline.db.save(storedMetadata);
+    }
+  });
+
+  this.writeLog.record(key, PicturesqueApp.offline.WriteLog.PATCH, fields);
+  this.scheduleFlush(0);
+};
+
+
+/**
+ * Removes a photo locally and records a 'delete' in the write log. If the
+ * photo has not been sent to the server yet, nothing is sent at all.
+ *
+ * @param {string} key The key of the photo (local or from the server).
+ */
+PicturesqueApp.data.DataStore.prototype.deletePhoto = function(key) {
+  PicturesqueApp.offline.db.remove(key);
+  PicturesqueApp.offline.filer.rm(key, function() {}, function(error) {
+    PicturesqueApp.data.log.push(['filesystem remove failed:', error]);
+  });
+
+  this.writeLog.record(key, PicturesqueApp.offline.WriteLog.DELETE);
+  this.scheduleFlush(0);
+};
+
+
+/**
+ * Schedules a flush of the write log after a delay. Writes recorded before
+ * the flush runs are coalesced into the same batch.
+ *
+ * @param {integer} delay Milliseconds to wait before flushing.
+ */
+PicturesqueApp.data.DataStore.prototype.scheduleFlush = function(delay) {
+  if (this.flushTimeout !== null) {
+    return;
+  }
+
   var currentDataStore = this;
-  var anonymousCreateCallback = function(apiResponse) {
-    return currentDataStore.createCallback(apiResponse, photoMetadata);
-  };
+  this.flushTimeout = setTimeout(function() {
+    currentDataStore.flushTimeout = null;
+    currentDataStore.flushWriteLog();
+  }, delay);
+};
 
-  var task = new PicturesqueApp.data.ApiCallbackTask(
-      PicturesqueApp.api.callPicturesqueAPI, 'photo', 'create',
-      apiPayload, anonymousCreateCallback);
 
-  // Need to wrap task.callTask in anonymous fn. so it can be passed to
-  // setTimeout.
-  var anonymousCallTask = function() {
-    task.callTask();
+/**
+ * Sends pending writes to the API in a 'batch' request, depending on the
+ * signed in status and the network status. The batch itself is only built
+ * once the task actually runs, so writes made while offline or before
+ * joining keep coalescing until then.
+ */
+PicturesqueApp.data.DataStore.prototype.flushWriteLog = function() {
+  if (this.flushInProgress || !this.writeLog.loaded ||
+      !this.writeLog.hasPending()) {
+    return;
+  }
+  this.flushInProgress = true;
+
+  var currentDataStore = this;
+  var sendBatch = function() {
+    var operations = currentDataStore.writeLog.nextBatch();
+    if (operations.length === 0) {
+      currentDataStore.flushInProgress = false;
+      return;
+    }
+
+    var anonymousBatchCallback = function(apiResponse) {
+      return currentDataStore.batchCallback(apiResponse, operations);
+    };
+    PicturesqueApp.api.callPicturesqueAPI(
+        'photo', 'batch', {'operations': operations}, anonymousBatchCallback);
   };
 
-  // Asynchronously call the task and let ApiCallbackTask and the offline and
-  // joinPicturesque queues do the work.
-  setTimeout(anonymousCallTask, 0);
+  var task = new PicturesqueApp.data.ApiCallbackTask(sendBatch);
+  task.callTask();
 };
 
 
 /**
- * Callback for the API 'create' method. Uses the imageStore to rename the
- * locally saved content and trigger the rename callback.
+ * Callback for the API 'batch' method. Acknowledges each result with the
+ * write log, renames locally created photos and continues flushing. If the
+ * request fails as a whole, the operations are retried with backoff.
  *
- * @param {Object} apiResponse The response from the 'create' API call holding
+ * @param {Object} apiResponse The response from the 'batch' API call.
+ * @param {Array.Object} operations The operations sent in the request.
+ */
+PicturesqueApp.data.DataStore.prototype.batchCallback =
+    function(apiResponse, operations) {
+  this.flushInProgress = false;
+
+  // error_message is due to a quirk in dev_appserver
+  if (apiResponse.code || apiResponse.error_message) {
+    PicturesqueApp.data.log.push(['photo.batch request failed:',
+                                  apiResponse]);
+    this.writeLog.release(operations);
+    this.scheduleFlush(this.writeLog.nextRetryDelay());
+    return;
+  }
+  this.writeLog.resetRetryDelay();
+
+  var currentDataStore = this;
+  var results = apiResponse.results || [];
+  var result;
+  for (var index in results) {
+    result = results[index];
+    if (operations[index].operation ===
+        PicturesqueApp.offline.WriteLog.CREATE) {
+      PicturesqueApp.offline.db.get(result.localKey, (function(result) {
+        return function(storedMetadata) {
+          if (storedMetadata) {
+            currentDataStore.createCallback(result, storedMetadata);
+          }
+        };
+      })(result));
+    }
+    this.writeLog.acknowledge(result);
+  }
+
+  this.scheduleFlush(0);
+};
+
+
+/**
+ * Callback for a 'create' operation in a 'batch' API call. Uses the imageStore
+ * to rename the locally saved content and trigger the rename callback.
+ *
+ * @param {Object} apiResponse The result of the 'create' operation holding
  *                             the inserted photo metadata.
  * @param {Object} storedMetadata The currently stored contents to be renamed.
  */
 PicturesqueApp.data.DataStore.prototype.createCallback =
     function(apiResponse, storedMetadata) {
-  // error_message is due to a quirk in dev_appserver
-  if (apiResponse.code || apiResponse.error_message) {
-    // TODO(dhermes): Perform clean-up when the API response fails.
-    PicturesqueApp.data.log.push(['photo.create request failed:',
+  if (apiResponse.error) {
+    // The write log keeps the rejected create, so the photo is not lost.
+    PicturesqueApp.data.log.push(['photo.create operation failed:',
                                   apiResponse]);
+    this.createFailureCallback(storedMetadata, apiResponse.error);
     return;
   }
   // TODO(dhermes): Actually do the renaming.
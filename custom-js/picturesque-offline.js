@@ -440,3 +440,312 @@ PicturesqueApp.offline.onOnlineCallback = function() {
  * Set the global (window) ononline callback.
  */
 window.ononline = PicturesqueApp.offline.onOnlineCallback;
+
+
+//
+// WriteLog class definition and prototype
+//
+
+/**
+ * Constructor for a WriteLog instance. Holds photo writes which have not yet
+ * been sent to the server, persisted with Lawnchair so they survive a reload.
+ *
+ * There is at most one entry per photo key; successive writes to the same
+ * photo are coalesced into that entry (see WriteLog.coalesce), so the number
+ * of operations replayed is proportional to the number of photos changed
+ * rather than the number of edits made.
+ *
+ * @param {object} args Optional object literal with the following
+ *     properties.
+ *     loadCallback {Function} The method to be called once entries persisted
+ *         by a previous session have been loaded. Default is a function which
+ *         does nothing. No arguments will be passed to this callback.
+ *     batchSize {integer} The maximum number of entries returned by
+ *         nextBatch. Default is set in PicturesqueApp.config as
+ *         WRITE_BATCH_SIZE.
+ *     initialRetryDelay {integer} Milliseconds to wait before retrying after
+ *         the first failed batch. Default is set in PicturesqueApp.config as
+ *         WRITE_RETRY_DELAY_MS.
+ *     maxRetryDelay {integer} Upper bound on the retry delay in milliseconds.
+ *         Default is set in PicturesqueApp.config as
+ *         WRITE_MAX_RETRY_DELAY_MS.
+ *     titlePropertyName {string} The name of the property on image payloads
+ *         which holds the photo title. Default is set in PicturesqueApp.config
+ *         as TITLE_PROPERTY_NAME.
+ *     descriptionPropertyName {string} The name of the property on image
+ *         payloads which holds the photo description. Default is set in
+ *         PicturesqueApp.config as DESCRIPTION_PROPERTY_NAME.
+ */
+PicturesqueApp.offline.WriteLog = function(args) {
+  args = args || {};
+
+  this.batchSize = args.batchSize || PicturesqueApp.config.WRITE_BATCH_SIZE;
+  this.initialRetryDelay = args.initialRetryDelay ||
+                           PicturesqueApp.config.WRITE_RETRY_DELAY_MS;
+  this.maxRetryDelay = args.maxRetryDelay ||
+                       PicturesqueApp.config.WRITE_MAX_RETRY_DELAY_MS;
+  this.retryDelay = this.initialRetryDelay;
+  this.titlePropertyName = args.titlePropertyName ||
+                           PicturesqueApp.config.TITLE_PROPERTY_NAME;
+  this.descriptionPropertyName =
+      args.descriptionPropertyName ||
+      PicturesqueApp.config.DESCRIPTION_PROPERTY_NAME;
+
+  // In-memory mirror of the persisted entries, keyed by photo key.
+  this.entries = {};
+  this.sequence = 0;
+  this.loaded = false;
+
+  var loadCallback = args.loadCallback || function() {};
+  var currentLog = this;
+  this.db = new Lawnchair({name: 'PicturesqueApp.writeLog'}, function() {
+    this.all(function(records) {
+      records.forEach(function(entry) {
+        // Anything in flight when the page went away is sent again.
+        delete entry.sentVersion;
+        currentLog.entries[entry.key] = entry;
+        currentLog.sequence = Math.max(currentLog.sequence, entry.sequence);
+      });
+      currentLog.loaded = true;
+      loadCallback();
+    });
+  });
+
+  PicturesqueApp.offline.log.push(['WriteLog created with:', args]);
+};
+
+
+/**
+ * Operation names, matching the server side PhotoOperation.Operation enum.
+ * @type {Object}
+ */
+PicturesqueApp.offline.WriteLog.CREATE = 'CREATE';
+PicturesqueApp.offline.WriteLog.PATCH = 'PATCH';
+PicturesqueApp.offline.WriteLog.DELETE = 'DELETE';
+
+
+/**
+ * Combines a new write with the pending entry (if any) for the same photo.
+ *
+ *     (none)   + X      -> X
+ *     CREATE   + PATCH  -> CREATE with the patched fields merged in
+ *     PATCH    + PATCH  -> PATCH with both sets of fields
+ *     CREATE   + DELETE -> nothing, unless the CREATE is already in flight
+ *     PATCH    + DELETE -> DELETE
+ *     DELETE   + X      -> DELETE
+ *
+ * A new write to a CREATE the server rejected makes it pending again, so
+ * the user can correct the photo and have it sent once more.
+ *
+ * @param {Object} entry The pending entry or undefined if there is none.
+ * @param {string} key The key of the photo being written.
+ * @param {string} operation One of CREATE, PATCH or DELETE.
+ * @param {Object} fields The photo fields being written.
+ * @return {Object} The entry to be stored, or null if nothing needs to be
+ *                  sent for the photo any longer.
+ */
+PicturesqueApp.offline.WriteLog.coalesce =
+    function(entry, key, operation, fields) {
+  var WriteLog = PicturesqueApp.offline.WriteLog;
+
+  if (!entry) {
+    entry = {'key': key, 'operation': operation, 'fields': {}};
+  } else if (entry.operation === WriteLog.DELETE) {
+    return entry;
+  } else if (operation === WriteLog.DELETE) {
+    if (entry.operation === WriteLog.CREATE &&
+        entry.sentVersion === undefined) {
+      return null;
+    }
+    entry.operation = WriteLog.DELETE;
+    entry.fields = {};
+    return entry;
+  }
+
+  delete entry.rejected;
+  for (var fieldName in fields) {
+    entry.fields[fieldName] = fields[fieldName];
+  }
+  return entry;
+};
+
+
+/**
+ * Records a write, coalescing it with any pending write for the same photo
+ * and persisting the result.
+ *
+ * @param {string} key The key of the photo being written; a temporary key for
+ *                     photos which have not yet been created on the server.
+ * @param {string} operation One of CREATE, PATCH or DELETE.
+ * @param {Object} fields The photo fields being written.
+ * @return {Object} The stored entry, or null if the write cancelled out the
+ *                  pending one.
+ */
+PicturesqueApp.offline.WriteLog.prototype.record =
+    function(key, operation, fields) {
+  var entry = PicturesqueApp.offline.WriteLog.coalesce(
+      this.entries[key], key, operation, fields || {});
+
+  if (entry === null) {
+    delete this.entries[key];
+    this.db.remove(key);
+    return null;
+  }
+
+  if (entry.sequence === undefined) {
+    entry.sequence = ++this.sequence;
+    entry.version = 0;
+  }
+  entry.version++;
+
+  this.entries[key] = entry;
+  this.db.save(entry);
+  return entry;
+};
+
+
+/**
+ * Determines whether there are entries waiting to be sent.
+ * @return {boolean} True if nextBatch would return a non-empty list.
+ */
+PicturesqueApp.offline.WriteLog.prototype.hasPending = function() {
+  for (var key in this.entries) {
+    if (this.entries[key].sentVersion === undefined &&
+        !this.entries[key].rejected) {
+      return true;
+    }
+  }
+  return false;
+};
+
+
+/**
+ * Marks up to batchSize of the oldest pending entries as in flight and
+ * returns the operations to send for them.
+ *
+ * @return {Array.Object} Operations in the form expected by photo.batch.
+ */
+PicturesqueApp.offline.WriteLog.prototype.nextBatch = function() {
+  var pending = [];
+  for (var key in this.entries) {
+    if (this.entries[key].sentVersion === undefined &&
+        !this.entries[key].rejected) {
+      pending.push(this.entries[key]);
+    }
+  }
+  pending.sort(function(a, b) { return a.sequence - b.sequence; });
+
+  return pending.slice(0, this.batchSize).map(function(entry) {
+    entry.sentVersion = entry.version;
+
+    var operation = {
+      'localKey': entry.key,
+      'operation': entry.operation
+    };
+    for (var fieldName in entry.fields) {
+      operation[fieldName] = entry.fields[fieldName];
+    }
+    if (entry.operation !== PicturesqueApp.offline.WriteLog.CREATE) {
+      operation.key = entry.key;
+    }
+    return operation;
+  });
+};
+
+
+/**
+ * Handles the server result for an operation returned by nextBatch.
+ *
+ * If the entry was not written to since it was sent, it is removed from the
+ * log. Otherwise the later writes are kept; for a CREATE they are moved to
+ * the key allocated by the server and become a PATCH (or stay a DELETE).
+ * A rejected CREATE is kept, marked as rejected and no longer sent, so the
+ * photo is not left existing only locally without a record of why; a later
+ * write to the photo makes it pending again (see WriteLog.coalesce), as do
+ * writes made while it was in flight. Other
+ * rejected operations are dropped, since sending them again would fail the
+ * same way.
+ *
+ * @param {Object} result A PhotoOperationResult from the photo.batch response.
+ */
+PicturesqueApp.offline.WriteLog.prototype.acknowledge = function(result) {
+  var entry = this.entries[result.localKey];
+  if (!entry) {
+    return;
+  }
+
+  if (result.error) {
+    PicturesqueApp.offline.log.push(['WriteLog operation rejected:', result]);
+    if (entry.operation === PicturesqueApp.offline.WriteLog.CREATE) {
+      // Writes made since it was sent may have fixed it; send those again.
+      if (entry.version === entry.sentVersion) {
+        entry.rejected = result.error;
+      }
+      delete entry.sentVersion;
+      this.db.save(entry);
+      return;
+    }
+  }
+
+  if (result.error || entry.version === entry.sentVersion) {
+    delete this.entries[entry.key];
+    this.db.remove(entry.key);
+    return;
+  }
+
+  delete entry.sentVersion;
+  if (result.key && result.key !== entry.key) {
+    delete this.entries[entry.key];
+    this.db.remove(entry.key);
+
+    entry.key = result.key;
+    if (entry.operation === PicturesqueApp.offline.WriteLog.CREATE) {
+      entry.operation = PicturesqueApp.offline.WriteLog.PATCH;
+      var fields = {};
+      fields[this.titlePropertyName] = entry.fields[this.titlePropertyName];
+      fields[this.descriptionPropertyName] =
+          entry.fields[this.descriptionPropertyName];
+      entry.fields = fields;
+    }
+    this.entries[entry.key] = entry;
+  }
+  this.db.save(entry);
+};
+
+
+/**
+ * Returns operations from a failed batch to the pending state so they are
+ * sent again (and can continue to coalesce in the meantime).
+ *
+ * @param {Array.Object} operations The operations returned by nextBatch.
+ */
+PicturesqueApp.offline.WriteLog.prototype.release = function(operations) {
+  var entry;
+  for (var index in operations) {
+    entry = this.entries[operations[index].localKey];
+    if (entry) {
+      delete entry.sentVersion;
+    }
+  }
+};
+
+
+/**
+ * Returns the delay to wait before retrying a failed batch and doubles it
+ * (up to maxRetryDelay) for the next failure.
+ *
+ * @return {integer} Delay in milliseconds.
+ */
+PicturesqueApp.offline.WriteLog.prototype.nextRetryDelay = function() {
+  var delay = this.retryDelay;
+  this.retryDelay = Math.min(this.retryDelay * 2, this.maxRetryDelay);
+  return delay;
+};
+
+
+/**
+ * Resets the retry delay after a successful batch.
+ */
+PicturesqueApp.offline.WriteLog.prototype.resetRetryDelay = function() {
+  this.retryDelay = this.initialRetryDelay;
+};
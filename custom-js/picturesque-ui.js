@@ -271,6 +271,21 @@ PicturesqueApp.ui.renameLocalPhoto = function(previousKey, photoMetadata) {
 };
 
 
+/**
+ * Toasts that the server rejected a locally saved photo. Has the signature
+ * needed for createFailureCallback.
+ * @param {Object} photoMetadata An object containing photo contents.
+ * @param {string} error The error message from the server.
+ */
+PicturesqueApp.ui.createFailed = function(photoMetadata, error) {
+  var title = photoMetadata[PicturesqueApp.config.TITLE_PROPERTY_NAME];
+  PicturesqueApp.ui.toastMsg(
+      'Picturesque ' + JSON.stringify(title) +
+      ' could not be saved in the clouds: ' + error +
+      ' Edit it to try again.');
+};
+
+
 /**
  * Clears all input fields for image "Save".
  */
@@ -292,7 +307,8 @@ PicturesqueApp.ui.clearSaveFields = function() {
 PicturesqueApp.ui.storeArgs = {
   'saveSuccessCallback': PicturesqueApp.ui.saveNewPhoto,
   'getPhotoCallback': PicturesqueApp.ui.displayPhoto,
-  'renameCallback': PicturesqueApp.ui.renameLocalPhoto
+  'renameCallback': PicturesqueApp.ui.renameLocalPhoto,
+  'createFailureCallback': PicturesqueApp.ui.createFailed
 };
 PicturesqueApp.ui.STORE = new PicturesqueApp.data.DataStore(PicturesqueApp.ui.storeArgs);
 
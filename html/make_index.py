@@ -1,15 +1,253 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Builds index.html, the script and stylesheet bundles and the appcache.
+
+Run from the html/ directory after changing any page, script or stylesheet:
+
+  python make_index.py [--no-bundle]
+
+The scripts and stylesheets in BUNDLES are concatenated, minified and
+written to build/ in the application root, with a hash of their contents in
+the file name (e.g. build/modules.3f2a9c1d04be.js). A changed bundle gets a
+new name, so app.yaml serves build/ with a long expiration, while index.html
+and definition.appcache, which refer to the bundles, are not cached.
+definition.appcache is regenerated with a hash of everything it lists, so
+clients download an update exactly when something changed.
+
+Minifying scripts needs the jsmin package; without it, scripts are only
+concatenated. Stylesheets are minified here. App Engine already gzips static
+responses for clients which accept it, so no precompressed copies are
+written; the gzipped sizes are reported instead.
+
+With --no-bundle, index.html and definition.appcache refer to the original
+files, which is easier to debug.
+"""
+
+
+import hashlib
+import os
+import posixpath
+import re
+import sys
+import zlib
+
 from jinja2 import Environment, PackageLoader
 
 
 ENV = Environment(loader=PackageLoader(__name__, '.'))
 TEMPLATE = ENV.get_template('index-template.html')
 
+HTML_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_ROOT = os.path.dirname(HTML_DIR)
+BUILD_DIR = 'build'
+APPCACHE_FILE = 'definition.appcache'
+
+# Bundle names and their sources (relative to APP_ROOT), in load order.
+BUNDLES = (
+    ('head.js', (
+        'custom-js/libs/jquery-1.7.2.min.js',
+        'custom-js/libs/jquery.mobile-1.1.0.js',
+    )),
+    ('app.css', (
+        'custom-css/bootstrap.css',
+        'custom-css/app-style.css',
+        'custom-css/jquery.mobile.structure-1.1.0.css',
+        'custom-css/jquery.mobile.theme-1.1.0.css',
+    )),
+    ('modules.js', (
+        'custom-js/libs/bootstrap/bootstrap.min.js',
+        'custom-js/libs/filer.min.js',
+        'custom-js/libs/lawnchair-0.6.1.js',
+        # Our modules; order is important.
+        'custom-js/picturesque-config.js',
+        'custom-js/picturesque-utils.js',
+        'custom-js/picturesque-offline.js',
+        'custom-js/picturesque-api.js',
+        'custom-js/picturesque-data.js',
+        'custom-js/picturesque-ui.js',
+    )),
+)
+# Files cached for offline use besides the page and bundles.
+APPCACHE_EXTRA = tuple(
+    'custom-css/images/%s' % (name,) for name in (
+        'ajax-loader.gif',
+        'ajax-loader.png',
+        'glyphicons-halflings-white.png',
+        'glyphicons-halflings.png',
+        'icons-18-black.png',
+        'icons-18-white.png',
+        'icons-36-black.png',
+        'icons-36-white.png',
+        'loader.gif',
+        'spinner_black_16.png',
+    )) + ('custom-images/cloud_endpoints_logo.png',)
+
+CSS_COMMENT_REGEX = re.compile(r'/\*(?!!).*?\*/', re.DOTALL)
+CSS_SPACE_REGEX = re.compile(r'\s+')
+CSS_PUNCTUATION_REGEX = re.compile(r'\s*([{};,>])\s*')
+CSS_URL_REGEX = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def read_source(path):
+  """Reads a file relative to the application root."""
+  with open(os.path.join(APP_ROOT, path), 'rb') as fh:
+    return fh.read()
+
+
+def minify_js(source):
+  """Minifies a script with jsmin, if it is installed."""
+  try:
+    from jsmin import jsmin
+  except ImportError:
+    return source
+  return jsmin(source)
+
+
+def minify_css(source):
+  """Removes comments (other than /*! ones) and unneeded whitespace."""
+  source = CSS_COMMENT_REGEX.sub('', source)
+  source = CSS_SPACE_REGEX.sub(' ', source)
+  source = CSS_PUNCTUATION_REGEX.sub(r'\1', source)
+  return source.replace(';}', '}').strip()
+
+
+def rebase_css_urls(source, path):
+  """Makes relative url()s in a stylesheet relative to BUILD_DIR.
+
+  Args:
+    source: String; the stylesheet.
+    path: String; path of the stylesheet relative to the application root.
+
+  Returns:
+    The stylesheet, with the same resources referenced from BUILD_DIR.
+  """
+  def rebase(match):
+    url = match.group(2)
+    if url.startswith(('/', 'data:', 'http:', 'https:')):
+      return match.group(0)
+    target = posixpath.normpath(posixpath.join(posixpath.dirname(path), url))
+    return 'url(%s)' % (posixpath.relpath(target, BUILD_DIR),)
+
+  return CSS_URL_REGEX.sub(rebase, source)
+
+
+def bundle_contents(name, sources):
+  """Concatenates and minifies the sources of a bundle.
+
+  Args:
+    name: String; the bundle name, ending in '.js' or '.css'.
+    sources: List of source paths relative to the application root.
+
+  Returns:
+    String; the contents of the bundle.
+  """
+  parts = []
+  for path in sources:
+    source = read_source(path)
+    if name.endswith('.css'):
+      parts.append(minify_css(rebase_css_urls(source, path)))
+    elif path.endswith('.min.js'):
+      parts.append(source.strip())
+    else:
+      parts.append(minify_js(source).strip())
+  # Scripts may not end in a semicolon, so one is added between them.
+  return ('\n' if name.endswith('.css') else ';\n').join(parts) + '\n'
+
+
+def build_bundles():
+  """Writes the bundles to BUILD_DIR and removes outdated ones.
+
+  Returns:
+    Dictionary of bundle name to its URL path, relative to the page.
+  """
+  build_path = os.path.join(APP_ROOT, BUILD_DIR)
+  if not os.path.isdir(build_path):
+    os.makedirs(build_path)
+
+  urls = {}
+  for name, sources in BUNDLES:
+    contents = bundle_contents(name, sources)
+    base, extension = os.path.splitext(name)
+    filename = '%s.%s%s' % (base, hashlib.sha1(contents).hexdigest()[:12],
+                            extension)
+    with open(os.path.join(build_path, filename), 'wb') as fh:
+      fh.write(contents)
+    urls[name] = posixpath.join(BUILD_DIR, filename)
+
+    original_size = sum(len(read_source(path)) for path in sources)
+    print '%-40s %8d bytes (from %d in %d files), %8d gzipped' % (
+        urls[name], len(contents), original_size, len(sources),
+        len(zlib.compress(contents, 9)))
+
+  current = set(posixpath.basename(url) for url in urls.itervalues())
+  for filename in os.listdir(build_path):
+    if filename not in current:
+      os.remove(os.path.join(build_path, filename))
+  return urls
+
+
+def write_index(assets):
+  """Renders index.html, with the given script and stylesheet URLs.
+
+  Args:
+    assets: Dictionary of bundle name to the list of URLs to load for it.
+  """
+  ENV.globals['assets'] = assets
+  with open(os.path.join(HTML_DIR, 'index.html'), 'wb') as fh:
+    lines = TEMPLATE.render().split('\n')
+    # No trailing whitespace
+    lines = [row.rstrip() for row in lines]
+    result = '\n'.join(lines)
+    if not result.endswith('\n'):
+      result += '\n'
+    fh.write(result)
+
+
+def write_appcache(urls):
+  """Writes the appcache manifest, listing the page and the given URLs.
+
+  Args:
+    urls: List of URL paths relative to the application root.
+  """
+  digest = hashlib.sha1()
+  digest.update(read_source('html/index.html'))
+  for url in urls:
+    digest.update(url)
+    digest.update(read_source(url))
+
+  lines = [
+      'CACHE MANIFEST',
+      '',
+      '# Generated by html/make_index.py; changes whenever a listed file',
+      '# does, which makes clients update.',
+      '# hash: %s' % (digest.hexdigest(),),
+      '',
+      'NETWORK:',
+      '*',
+      '',
+      'CACHE:',
+      '/',
+      'index.html',
+  ]
+  lines.extend(urls)
+  with open(os.path.join(APP_ROOT, APPCACHE_FILE), 'wb') as fh:
+    fh.write('\n'.join(lines) + '\n')
+
+
+def main(bundle):
+  """Builds the bundles (if bundle is set), index.html and the appcache."""
+  if bundle:
+    urls = build_bundles()
+    assets = dict((name, [url]) for name, url in urls.iteritems())
+  else:
+    assets = dict((name, list(sources)) for name, sources in BUNDLES)
+
+  write_index(assets)
+  asset_urls = [url for name, _ in BUNDLES for url in assets[name]]
+  write_appcache(asset_urls + list(APPCACHE_EXTRA))
+
 
-with open('index.html', 'wb') as fh:
-  lines = TEMPLATE.render().split('\n')
-  # No trailing whitespace
-  lines = [row.rstrip() for row in lines]
-  result = '\n'.join(lines)
-  if not result.endswith('\n'):
-    result += '\n'
-  fh.write(result)
+if __name__ == '__main__':
+  if sys.argv[1:] not in ([], ['--no-bundle']):
+    sys.exit(__doc__)
+  main(bundle=not sys.argv[1:])
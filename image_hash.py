@@ -0,0 +1,277 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module for perceptual hashes of images and finding near-duplicates.
+
+dhash computes a 64-bit difference hash: the image is shrunk to 9x8 pixels
+by the Images API (returned as a PNG, which is decoded here), converted to
+grey and each bit records whether a pixel is brighter than its right
+neighbour. Re-encoded, resized or slightly edited copies of an image, and
+consecutive shots of the same scene, get hashes which differ in only a few
+bits, so the Hamming distance between hashes measures how similar images
+look.
+
+To find the hashes within a Hamming distance of a hash without comparing it
+to every other one, hashes are indexed by multi-index hashing: a hash is
+split into SEGMENTS segments of SEGMENT_BITS bits, and segment_keys gives
+one indexed string per segment. Two hashes within distance r differ in at
+most r // SEGMENTS bits of at least one segment (by the pigeonhole
+principle), so every such hash has a segment key among the probe_keys of
+the hash. Looking up the probe keys only finds hashes sharing (nearly) a
+whole segment, which for 16-bit segments is a tiny fraction of a library;
+the candidates are then checked with hamming_distance.
+
+Hashes are stored as 16 hex digits (see to_string), since 64-bit integers
+exceed both the signed integers of the datastore and the precision of
+JavaScript numbers.
+"""
+
+
+import itertools
+import struct
+import zlib
+
+
+HASH_BITS = 64
+SEGMENTS = 4
+SEGMENT_BITS = HASH_BITS // SEGMENTS
+# Probing costs grow quickly with the distance: SEGMENTS keys for distances
+# below SEGMENTS, SEGMENTS * (SEGMENT_BITS + 1) below 2 * SEGMENTS.
+MAX_DISTANCE = 2 * SEGMENTS - 1
+
+# Size of the thumbnail; each row gives THUMBNAIL_WIDTH - 1 bits.
+THUMBNAIL_WIDTH = 9
+THUMBNAIL_HEIGHT = 8
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+# Channels per pixel of the supported (8-bit) PNG color types.
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+_PNG_PALETTE = 3
+
+
+class _FormatError(Exception):
+  """Raised when a thumbnail can't be decoded."""
+
+
+def _Unfilter(raw, width, height, channels):
+  """Reverses the PNG row filters.
+
+  Args:
+    raw: String; the decompressed image data.
+    width: Integer width in pixels.
+    height: Integer height in pixels.
+    channels: Integer number of bytes per pixel.
+
+  Returns:
+    List of height bytearrays of width * channels bytes.
+  """
+  stride = width * channels
+  if len(raw) < height * (stride + 1):
+    raise _FormatError('Truncated image data.')
+
+  rows = []
+  previous = bytearray(stride)
+  for y in xrange(height):
+    offset = y * (stride + 1)
+    filter_type = ord(raw[offset])
+    row = bytearray(raw[offset + 1:offset + 1 + stride])
+    for i in xrange(stride):
+      left = row[i - channels] if i >= channels else 0
+      up = previous[i]
+      up_left = previous[i - channels] if i >= channels else 0
+      if filter_type == 1:
+        row[i] = (row[i] + left) & 0xff
+      elif filter_type == 2:
+        row[i] = (row[i] + up) & 0xff
+      elif filter_type == 3:
+        row[i] = (row[i] + (left + up) // 2) & 0xff
+      elif filter_type == 4:
+        estimate = left + up - up_left
+        distances = (abs(estimate - left), abs(estimate - up),
+                     abs(estimate - up_left))
+        if distances[0] <= distances[1] and distances[0] <= distances[2]:
+          predictor = left
+        elif distances[1] <= distances[2]:
+          predictor = up
+        else:
+          predictor = up_left
+        row[i] = (row[i] + predictor) & 0xff
+      elif filter_type != 0:
+        raise _FormatError('Unknown PNG filter type.')
+    rows.append(row)
+    previous = row
+  return rows
+
+
+def _DecodePng(data):
+  """Decodes a small non-interlaced 8-bit PNG into grey values.
+
+  Args:
+    data: String; the PNG.
+
+  Returns:
+    List of rows, each a list of integer grey values (0-255).
+  """
+  if not data.startswith(PNG_SIGNATURE):
+    raise _FormatError('Not a PNG.')
+
+  header = None
+  palette = None
+  compressed = []
+  offset = len(PNG_SIGNATURE)
+  while True:
+    length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+    chunk = data[offset + 8:offset + 8 + length]
+    if chunk_type == 'IHDR':
+      header = struct.unpack('>IIBBBBB', chunk)
+    elif chunk_type == 'PLTE':
+      palette = [struct.unpack('BBB', chunk[index:index + 3])
+                 for index in xrange(0, len(chunk) - 2, 3)]
+    elif chunk_type == 'IDAT':
+      compressed.append(chunk)
+    elif chunk_type == 'IEND':
+      break
+    offset += 12 + length
+
+  if header is None:
+    raise _FormatError('No PNG header.')
+  width, height, depth, color_type, _, _, interlace = header
+  if depth != 8 or interlace or color_type not in _PNG_CHANNELS:
+    raise _FormatError('Unsupported PNG format.')
+  if color_type == _PNG_PALETTE and palette is None:
+    raise _FormatError('No PNG palette.')
+
+  channels = _PNG_CHANNELS[color_type]
+  rows = _Unfilter(zlib.decompress(''.join(compressed)), width, height,
+                   channels)
+  grey_rows = []
+  for row in rows:
+    grey_row = []
+    for x in xrange(width):
+      pixel = row[x * channels:(x + 1) * channels]
+      if color_type == _PNG_PALETTE:
+        pixel = palette[pixel[0]]
+      if len(pixel) < 3:  # Grey, possibly with alpha.
+        grey_row.append(pixel[0])
+      else:
+        grey_row.append((299 * pixel[0] + 587 * pixel[1] +
+                         114 * pixel[2]) // 1000)
+    grey_rows.append(grey_row)
+  return grey_rows
+
+
+def _Thumbnail(data):
+  """Shrinks an image to THUMBNAIL_WIDTH x THUMBNAIL_HEIGHT grey values.
+
+  Returns:
+    List of rows of grey values, or None if the Images API can't read the
+      image.
+  """
+  # Only needed here, so not imported when an instance starts.
+  from google.appengine.api import images
+
+  try:
+    image = images.Image(data)
+    image.resize(width=THUMBNAIL_WIDTH, height=THUMBNAIL_HEIGHT,
+                 allow_stretch=True)
+    thumbnail = image.execute_transforms(output_encoding=images.PNG)
+  except images.Error:
+    return None
+  return _DecodePng(thumbnail)
+
+
+def dhash(data):
+  """Computes the difference hash of an image.
+
+  Args:
+    data: String; the contents of an image in a format the Images API
+      supports.
+
+  Returns:
+    Integer hash of HASH_BITS bits, or None if the image can't be read.
+  """
+  if not data:
+    return None
+  try:
+    rows = _Thumbnail(data)
+  except (_FormatError, struct.error, zlib.error, IndexError):
+    return None
+  if (rows is None or len(rows) != THUMBNAIL_HEIGHT or
+      any(len(row) != THUMBNAIL_WIDTH for row in rows)):
+    return None
+
+  value = 0
+  for row in rows:
+    for left, right in zip(row, row[1:]):
+      value = (value << 1) | (left > right)
+  return value
+
+
+def to_string(value):
+  """Formats a hash as 16 hex digits."""
+  return '%016x' % (value,)
+
+
+def from_string(value):
+  """Parses a hash formatted with to_string."""
+  return int(value, 16)
+
+
+def hamming_distance(first, second):
+  """Counts the bits in which two hashes differ."""
+  return bin(first ^ second).count('1')
+
+
+def _SegmentKey(index, segment):
+  """Formats the indexed string for a segment value at an index."""
+  return '%d:%04x' % (index, segment)
+
+
+def _Segments(value):
+  """Splits a hash into SEGMENTS integer segments."""
+  mask = (1 << SEGMENT_BITS) - 1
+  return [(value >> (index * SEGMENT_BITS)) & mask
+          for index in xrange(SEGMENTS)]
+
+
+def segment_keys(hash_string):
+  """Gets the strings to index a hash under.
+
+  Args:
+    hash_string: String; a hash formatted with to_string, or None.
+
+  Returns:
+    List of SEGMENTS strings, or an empty list for None.
+  """
+  if hash_string is None:
+    return []
+  return [_SegmentKey(index, segment)
+          for index, segment in enumerate(_Segments(from_string(hash_string)))]
+
+
+def probe_keys(value, max_distance):
+  """Gets the segment keys to look up to find hashes near a hash.
+
+  Args:
+    value: Integer hash.
+    max_distance: Integer Hamming distance, at most MAX_DISTANCE.
+
+  Returns:
+    List of segment key strings. Every hash within max_distance of value has
+      at least one of its segment_keys in the list.
+
+  Raises:
+    ValueError: if max_distance is negative or more than MAX_DISTANCE.
+  """
+  if not 0 <= max_distance <= MAX_DISTANCE:
+    raise ValueError('Distance must be between 0 and %d.' % (MAX_DISTANCE,))
+
+  radius = max_distance // SEGMENTS
+  keys = []
+  for index, segment in enumerate(_Segments(value)):
+    for flipped in xrange(radius + 1):
+      for bits in itertools.combinations(xrange(SEGMENT_BITS), flipped):
+        variant = segment
+        for bit in bits:
+          variant ^= 1 << bit
+        keys.append(_SegmentKey(index, variant))
+  return keys
@@ -0,0 +1,227 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Tests for image_hash, on hashes and PNG thumbnails built in the tests.
+
+image_hash only uses the Images API to shrink images, which these tests
+don't, so they run without the SDK. From the application root:
+
+  python image_hash_test.py
+"""
+
+
+import random
+import struct
+import unittest
+import zlib
+
+import image_hash
+
+
+# Grey values of a 3x2 thumbnail.
+GREY_ROWS = [[10, 200, 30], [255, 0, 128]]
+# Per color type, a function making a pixel with a grey value.
+PIXELS = {
+    0: lambda grey: [grey],
+    2: lambda grey: [grey, grey, grey],
+    4: lambda grey: [grey, 0x80],
+    6: lambda grey: [grey, grey, grey, 0xff],
+}
+
+
+def _Predictor(filter_type, left, up, up_left):
+  """Gets the value a PNG filter predicts a byte from."""
+  if filter_type == 0:
+    return 0
+  elif filter_type == 1:
+    return left
+  elif filter_type == 2:
+    return up
+  elif filter_type == 3:
+    return (left + up) // 2
+  estimate = left + up - up_left
+  return min((abs(estimate - left), 0, left), (abs(estimate - up), 1, up),
+             (abs(estimate - up_left), 2, up_left))[2]
+
+
+def _Filter(rows, filter_type, channels):
+  """Applies a PNG filter to rows of bytes, prefixing each with its type."""
+  raw = ''
+  previous = [0] * len(rows[0])
+  for row in rows:
+    raw += chr(filter_type)
+    for i, value in enumerate(row):
+      left = row[i - channels] if i >= channels else 0
+      up_left = previous[i - channels] if i >= channels else 0
+      predictor = _Predictor(filter_type, left, previous[i], up_left)
+      raw += chr((value - predictor) & 0xff)
+    previous = row
+  return raw
+
+
+def _PngChunk(chunk_type, payload):
+  """Builds a PNG chunk, with its CRC."""
+  crc = zlib.crc32(chunk_type + payload) & 0xffffffff
+  return (struct.pack('>I', len(payload)) + chunk_type + payload +
+          struct.pack('>I', crc))
+
+
+def _Png(rows, color_type, filter_type=0, palette=None, depth=8):
+  """Builds a PNG from rows of pixels, each a list of channel values."""
+  width = len(rows[0])
+  channels = len(rows[0][0])
+  flat_rows = [[value for pixel in row for value in pixel] for row in rows]
+  raw = zlib.compress(_Filter(flat_rows, filter_type, channels))
+  data = image_hash.PNG_SIGNATURE + _PngChunk(
+      'IHDR', struct.pack('>IIBBBBB', width, len(rows), depth, color_type, 0,
+                          0, 0))
+  if palette is not None:
+    data += _PngChunk('PLTE', ''.join(struct.pack('BBB', *color)
+                                      for color in palette))
+  # Split the image data, which may span several chunks.
+  return (data + _PngChunk('IDAT', raw[:5]) + _PngChunk('IDAT', raw[5:]) +
+          _PngChunk('IEND', ''))
+
+
+class DecodePngTest(unittest.TestCase):
+  """Tests for image_hash._DecodePng."""
+
+  def testColorTypesAndFilters(self):
+    for color_type, pixel in sorted(PIXELS.items()):
+      rows = [[pixel(grey) for grey in row] for row in GREY_ROWS]
+      for filter_type in xrange(5):
+        self.assertEqual(GREY_ROWS, image_hash._DecodePng(
+            _Png(rows, color_type, filter_type)),
+                         'color type %d, filter type %d' % (color_type,
+                                                            filter_type))
+
+  def testPaethPredictor(self):
+    # Rows of differing pixels, so the Paeth predictor picks each neighbour.
+    grey_rows = [[0, 50, 100, 20], [90, 10, 250, 0], [5, 255, 60, 61]]
+    rows = [[[grey] for grey in row] for row in grey_rows]
+    self.assertEqual(grey_rows, image_hash._DecodePng(_Png(rows, 0, 4)))
+
+  def testPalette(self):
+    palette = [(0, 0, 0), (255, 255, 255), (255, 0, 0)]
+    rows = [[[0], [1], [2]]]
+    self.assertEqual([[0, 255, 76]], image_hash._DecodePng(
+        _Png(rows, 3, palette=palette)))
+
+  def testUnsupportedFormats(self):
+    rows = [[[grey] for grey in row] for row in GREY_ROWS]
+    self.assertRaises(image_hash._FormatError, image_hash._DecodePng,
+                      'GIF89a')
+    self.assertRaises(image_hash._FormatError, image_hash._DecodePng,
+                      _Png(rows, 0, depth=16))
+    self.assertRaises(image_hash._FormatError, image_hash._DecodePng,
+                      _Png(rows, 3))
+
+  def testTruncatedImageData(self):
+    rows = [[[grey] for grey in row] for row in GREY_ROWS]
+    # Claim one more row than the image data holds.
+    data = _Png(rows, 0).replace(struct.pack('>I', len(rows)),
+                                 struct.pack('>I', len(rows) + 1), 1)
+    self.assertRaises(image_hash._FormatError, image_hash._DecodePng, data)
+
+  def testUnknownFilter(self):
+    rows = [[[grey] for grey in row] for row in GREY_ROWS]
+    self.assertRaises(image_hash._FormatError, image_hash._DecodePng,
+                      _Png(rows, 0, filter_type=5))
+
+
+class DhashTest(unittest.TestCase):
+  """Tests for image_hash.dhash, with the thumbnail given."""
+
+  def setUp(self):
+    self.thumbnail = None
+    self.original_thumbnail = image_hash._Thumbnail
+    image_hash._Thumbnail = lambda unused_data: self.thumbnail
+
+  def tearDown(self):
+    image_hash._Thumbnail = self.original_thumbnail
+
+  def testBitsCompareNeighbours(self):
+    # Every row falls from left to right, except the last which rises.
+    self.thumbnail = [range(image_hash.THUMBNAIL_WIDTH, 0, -1)
+                      for _ in xrange(image_hash.THUMBNAIL_HEIGHT - 1)]
+    self.thumbnail.append(range(image_hash.THUMBNAIL_WIDTH))
+    row_bits = image_hash.THUMBNAIL_WIDTH - 1
+    self.assertEqual(((1 << (image_hash.HASH_BITS - row_bits)) - 1)
+                     << row_bits, image_hash.dhash('image'))
+
+  def testUnreadableImages(self):
+    self.assertEqual(None, image_hash.dhash(''))
+    self.assertEqual(None, image_hash.dhash('image'))
+    self.thumbnail = [[0] * image_hash.THUMBNAIL_WIDTH]
+    self.assertEqual(None, image_hash.dhash('image'))
+
+
+class HashIndexTest(unittest.TestCase):
+  """Tests for the hash strings and segment keys."""
+
+  def setUp(self):
+    self.random = random.Random(1234)
+
+  def _RandomHash(self):
+    return self.random.getrandbits(image_hash.HASH_BITS)
+
+  def _Flip(self, value, bits):
+    """Flips the given bits of a hash."""
+    for bit in bits:
+      value ^= 1 << bit
+    return value
+
+  def testStringRoundTrip(self):
+    for value in (0, 1, (1 << image_hash.HASH_BITS) - 1, self._RandomHash()):
+      hash_string = image_hash.to_string(value)
+      self.assertEqual(16, len(hash_string))
+      self.assertEqual(value, image_hash.from_string(hash_string))
+
+  def testHammingDistance(self):
+    value = self._RandomHash()
+    self.assertEqual(0, image_hash.hamming_distance(value, value))
+    self.assertEqual(3, image_hash.hamming_distance(
+        value, self._Flip(value, [0, 17, 63])))
+    self.assertEqual(image_hash.HASH_BITS, image_hash.hamming_distance(
+        0, (1 << image_hash.HASH_BITS) - 1))
+
+  def testSegmentKeys(self):
+    self.assertEqual([], image_hash.segment_keys(None))
+    self.assertEqual(['0:cdef', '1:89ab', '2:4567', '3:0123'],
+                     image_hash.segment_keys('0123456789abcdef'))
+
+  def testProbeKeysCoverDistances(self):
+    for distance in xrange(image_hash.MAX_DISTANCE + 1):
+      value = self._RandomHash()
+      probes = set(image_hash.probe_keys(value, distance))
+      # The flips spread as evenly over the segments as possible, which is
+      # the hardest case, and random ones.
+      spread = [(index % image_hash.SEGMENTS) * image_hash.SEGMENT_BITS +
+                index // image_hash.SEGMENTS for index in xrange(distance)]
+      flips = [spread] + [
+          self.random.sample(xrange(image_hash.HASH_BITS), distance)
+          for _ in xrange(100)]
+      for bits in flips:
+        near = self._Flip(value, bits)
+        self.assertTrue(
+            probes.intersection(image_hash.segment_keys(
+                image_hash.to_string(near))),
+            'distance %d, flipped bits %r' % (distance, sorted(bits)))
+
+  def testProbeKeysCount(self):
+    value = self._RandomHash()
+    self.assertEqual(image_hash.segment_keys(image_hash.to_string(value)),
+                     image_hash.probe_keys(value, 0))
+    self.assertEqual(image_hash.SEGMENTS, len(image_hash.probe_keys(
+        value, image_hash.SEGMENTS - 1)))
+    self.assertEqual(image_hash.SEGMENTS * (image_hash.SEGMENT_BITS + 1),
+                     len(image_hash.probe_keys(value,
+                                               image_hash.MAX_DISTANCE)))
+
+  def testProbeKeysDistanceOutOfRange(self):
+    self.assertRaises(ValueError, image_hash.probe_keys, 0,
+                      image_hash.MAX_DISTANCE + 1)
+    self.assertRaises(ValueError, image_hash.probe_keys, 0, -1)
+
+
+if __name__ == '__main__':
+  unittest.main()
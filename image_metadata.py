@@ -0,0 +1,313 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module for reading image metadata from file headers.
+
+extract reads the dimensions, EXIF orientation and capture date of a JPEG,
+PNG, GIF or WebP image without decoding any pixels: only the headers and
+metadata blocks are parsed (image data is skipped over by its length where
+metadata follows it), so the cost does not grow with the size of the image.
+For example, for a JPEG the markers
+are walked until the frame header (SOF), reading the EXIF block (APP1) on
+the way, and the entropy coded data is never touched.
+
+The capture date is the EXIF DateTimeOriginal (falling back to
+DateTimeDigitized and then DateTime). EXIF dates have no time zone, so it is
+the local time of the camera and is returned as a naive datetime.
+
+The width and height are those of the stored image. The orientation is the
+EXIF value (1-8, where 1 is upright); for orientations 5-8 the image is
+displayed rotated by 90 degrees, so the displayed width and height are
+swapped.
+
+Malformed or truncated headers are not an error; whatever could be read
+before the problem is returned.
+"""
+
+
+import datetime
+import re
+import struct
+
+
+JPEG_SIGNATURE = '\xff\xd8'
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+GIF_SIGNATURES = ('GIF87a', 'GIF89a')
+EXIF_HEADER = 'Exif\x00\x00'
+
+# JPEG markers without a length and payload.
+_JPEG_STANDALONE_MARKERS = frozenset([0x01] + range(0xd0, 0xd8))
+# Start of frame markers; 0xc4, 0xc8 and 0xcc are other segments.
+_JPEG_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset([0xc4, 0xc8,
+                                                               0xcc])
+_JPEG_APP1 = 0xe1
+_JPEG_SOS = 0xda
+_JPEG_EOI = 0xd9
+# Flag in the extended WebP header set when the file has an EXIF chunk.
+_WEBP_EXIF_FLAG = 0x08
+
+# TIFF tags used from IFD0 and the EXIF IFD.
+_TAG_ORIENTATION = 0x0112
+_TAG_DATE_TIME = 0x0132
+_TAG_EXIF_IFD = 0x8769
+_TAG_DATE_TIME_ORIGINAL = 0x9003
+_TAG_DATE_TIME_DIGITIZED = 0x9004
+# Sizes in bytes of the TIFF field types, by type code.
+_TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4,
+                    10: 8, 11: 4, 12: 8}
+# Bounds the number of IFD entries read, in case of a corrupt count.
+_MAX_IFD_ENTRIES = 512
+
+_EXIF_DATE_REGEX = re.compile(
+    r'^(\d{4}):(\d\d):(\d\d) (\d\d):(\d\d):(\d\d)')
+
+
+class ImageMetadata(object):
+  """Metadata read from the headers of an image.
+
+  Attributes:
+    width: Integer width in pixels, or None if unknown.
+    height: Integer height in pixels, or None if unknown.
+    orientation: Integer EXIF orientation (1-8), or None if the image has
+      none.
+    taken_at: Naive datetime the image was captured, or None if unknown.
+  """
+
+  def __init__(self, width=None, height=None, orientation=None,
+               taken_at=None):
+    self.width = width
+    self.height = height
+    self.orientation = orientation
+    self.taken_at = taken_at
+
+
+class _FormatError(Exception):
+  """Raised when a header can't be parsed any further."""
+
+
+def _Unpack(fmt, data, offset):
+  """Unpacks a struct from data at offset, checking the bounds."""
+  size = struct.calcsize(fmt)
+  if offset < 0 or offset + size > len(data):
+    raise _FormatError('Truncated header.')
+  return struct.unpack(fmt, data[offset:offset + size])
+
+
+def _ParseExifDate(value):
+  """Parses an EXIF 'YYYY:MM:DD HH:MM:SS' date, or returns None."""
+  match = _EXIF_DATE_REGEX.match(value)
+  if match is None:
+    return None
+  try:
+    return datetime.datetime(*[int(part) for part in match.groups()])
+  except ValueError:  # E.g. the '0000:00:00 00:00:00' placeholder.
+    return None
+
+
+def _ReadIfd(tiff, endian, offset):
+  """Reads the entries of a TIFF image file directory.
+
+  Args:
+    tiff: String; the TIFF structure, starting with its byte order mark.
+    endian: String; the struct byte order character, '<' or '>'.
+    offset: Integer offset of the IFD in tiff.
+
+  Returns:
+    Dictionary of tag to a (type, count, value offset) tuple, where the value
+      offset points into tiff.
+  """
+  count, = _Unpack(endian + 'H', tiff, offset)
+  entries = {}
+  for index in xrange(min(count, _MAX_IFD_ENTRIES)):
+    entry_offset = offset + 2 + 12 * index
+    tag, field_type, value_count = _Unpack(endian + 'HHI', tiff, entry_offset)
+    size = _TIFF_TYPE_SIZES.get(field_type, 1) * value_count
+    if size <= 4:
+      value_offset = entry_offset + 8
+    else:
+      value_offset, = _Unpack(endian + 'I', tiff, entry_offset + 8)
+    entries[tag] = (field_type, value_count, value_offset)
+  return entries
+
+
+def _IfdInteger(tiff, endian, entry):
+  """Gets the first value of a SHORT or LONG entry, or None."""
+  field_type, unused_count, value_offset = entry
+  if field_type == 3:
+    return _Unpack(endian + 'H', tiff, value_offset)[0]
+  elif field_type == 4:
+    return _Unpack(endian + 'I', tiff, value_offset)[0]
+  return None
+
+
+def _IfdString(tiff, entry):
+  """Gets the value of an ASCII entry, or None."""
+  field_type, count, value_offset = entry
+  if field_type != 2 or value_offset + count > len(tiff):
+    return None
+  return tiff[value_offset:value_offset + count].split('\x00', 1)[0]
+
+
+def _ParseTiff(tiff, metadata):
+  """Reads the orientation and capture date from EXIF data.
+
+  Args:
+    tiff: String; the TIFF structure holding the EXIF data, i.e. the
+      contents of a JPEG APP1 segment after the 'Exif' header.
+    metadata: ImageMetadata to be updated.
+  """
+  byte_order = tiff[:2]
+  if byte_order == 'II':
+    endian = '<'
+  elif byte_order == 'MM':
+    endian = '>'
+  else:
+    raise _FormatError('Unknown TIFF byte order.')
+  magic, ifd_offset = _Unpack(endian + 'HI', tiff, 2)
+  if magic != 42:
+    raise _FormatError('Not a TIFF structure.')
+
+  ifd0 = _ReadIfd(tiff, endian, ifd_offset)
+  if _TAG_ORIENTATION in ifd0:
+    orientation = _IfdInteger(tiff, endian, ifd0[_TAG_ORIENTATION])
+    if orientation in xrange(1, 9):
+      metadata.orientation = orientation
+
+  dates = []
+  if _TAG_EXIF_IFD in ifd0:
+    exif_offset = _IfdInteger(tiff, endian, ifd0[_TAG_EXIF_IFD])
+    if exif_offset is not None:
+      exif_ifd = _ReadIfd(tiff, endian, exif_offset)
+      dates.extend(exif_ifd.get(tag) for tag in (_TAG_DATE_TIME_ORIGINAL,
+                                                 _TAG_DATE_TIME_DIGITIZED))
+  dates.append(ifd0.get(_TAG_DATE_TIME))
+
+  for entry in dates:
+    if entry is not None:
+      taken_at = _ParseExifDate(_IfdString(tiff, entry) or '')
+      if taken_at is not None:
+        metadata.taken_at = taken_at
+        return
+
+
+def _ParseExif(tiff, metadata):
+  """Calls _ParseTiff, ignoring malformed EXIF data."""
+  try:
+    _ParseTiff(tiff, metadata)
+  except (_FormatError, struct.error):
+    pass
+
+
+def _ParseJpeg(data, metadata):
+  """Reads JPEG markers up to the frame header; see module docstring."""
+  offset = len(JPEG_SIGNATURE)
+  while True:
+    fill, marker = _Unpack('BB', data, offset)
+    if fill != 0xff:
+      raise _FormatError('Expected a JPEG marker.')
+    if marker == 0xff:  # Fill byte before a marker.
+      offset += 1
+      continue
+    offset += 2
+    if marker in _JPEG_STANDALONE_MARKERS:
+      continue
+    if marker in (_JPEG_SOS, _JPEG_EOI):
+      # Image data follows without a frame header; nothing more to read.
+      return
+
+    length, = _Unpack('>H', data, offset)
+    if length < 2:
+      raise _FormatError('Invalid JPEG segment length.')
+    if marker in _JPEG_SOF_MARKERS:
+      # EXIF data must precede the frame header, so this is the last segment
+      # needed.
+      metadata.height, metadata.width = _Unpack('>HH', data, offset + 3)
+      return
+    elif marker == _JPEG_APP1 and metadata.taken_at is None:
+      segment = data[offset + 2:offset + length]
+      if segment.startswith(EXIF_HEADER):
+        _ParseExif(segment[len(EXIF_HEADER):], metadata)
+    offset += length
+
+
+def _ParsePng(data, metadata):
+  """Reads the IHDR chunk and any eXIf chunk before the image data."""
+  offset = len(PNG_SIGNATURE)
+  while True:
+    length, chunk_type = _Unpack('>I4s', data, offset)
+    if chunk_type == 'IHDR':
+      metadata.width, metadata.height = _Unpack('>II', data, offset + 8)
+    elif chunk_type == 'eXIf':
+      _ParseExif(data[offset + 8:offset + 8 + length], metadata)
+    elif chunk_type in ('IDAT', 'IEND'):
+      return
+    # Length, type and CRC fields, plus the data.
+    offset += 12 + length
+
+
+def _ParseGif(data, metadata):
+  """Reads the logical screen size of a GIF."""
+  metadata.width, metadata.height = _Unpack('<HH', data, 6)
+
+
+def _ParseWebp(data, metadata):
+  """Reads the frame or canvas size and any EXIF chunk of a WebP."""
+  offset = 12
+  has_exif = False
+  while True:
+    chunk_type, length = _Unpack('<4sI', data, offset)
+    payload = offset + 8
+    if chunk_type == 'VP8X':
+      flags, = _Unpack('B', data, payload)
+      has_exif = bool(flags & _WEBP_EXIF_FLAG)
+      width = _Unpack('<I', data[payload + 4:payload + 7] + '\x00', 0)[0]
+      height = _Unpack('<I', data[payload + 7:payload + 10] + '\x00', 0)[0]
+      metadata.width, metadata.height = width + 1, height + 1
+    elif chunk_type in ('VP8 ', 'VP8L'):
+      if metadata.width is None:
+        if chunk_type == 'VP8 ':
+          width, height = _Unpack('<HH', data, payload + 6)
+          metadata.width, metadata.height = width & 0x3fff, height & 0x3fff
+        else:
+          bits, = _Unpack('<I', data, payload + 1)
+          metadata.width = (bits & 0x3fff) + 1
+          metadata.height = ((bits >> 14) & 0x3fff) + 1
+      if not has_exif:
+        return
+    elif chunk_type == 'EXIF':
+      tiff = data[payload:payload + length]
+      if tiff.startswith(EXIF_HEADER):
+        tiff = tiff[len(EXIF_HEADER):]
+      _ParseExif(tiff, metadata)
+      return
+    # The EXIF chunk follows the image data, which is skipped over. Chunks
+    # are padded to an even length.
+    offset = payload + length + (length & 1)
+
+
+def extract(data):
+  """Reads the metadata of an image from its headers.
+
+  Args:
+    data: String; the contents of a JPEG, PNG, GIF or WebP image.
+
+  Returns:
+    An ImageMetadata. Fields which could not be read (including all of them,
+      for other formats) are None.
+  """
+  metadata = ImageMetadata()
+  if data.startswith(JPEG_SIGNATURE):
+    parser = _ParseJpeg
+  elif data.startswith(PNG_SIGNATURE):
+    parser = _ParsePng
+  elif data.startswith(GIF_SIGNATURES):
+    parser = _ParseGif
+  elif data.startswith('RIFF') and data[8:12] == 'WEBP':
+    parser = _ParseWebp
+  else:
+    return metadata
+
+  try:
+    parser(data, metadata)
+  except (_FormatError, struct.error):
+    pass
+  return metadata
@@ -0,0 +1,270 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Tests for image_metadata.extract, on images built from their headers.
+
+image_metadata doesn't use any App Engine APIs, so this runs without the SDK.
+From the application root:
+
+  python image_metadata_test.py
+"""
+
+
+import datetime
+import struct
+import unittest
+import zlib
+
+import image_metadata
+
+
+TAKEN_AT = datetime.datetime(2013, 5, 15, 10, 30, 0)
+TAKEN_AT_STRING = '2013:05:15 10:30:00\x00'
+MODIFIED_AT = datetime.datetime(2013, 6, 1, 8, 0, 0)
+MODIFIED_AT_STRING = '2013:06:01 08:00:00\x00'
+
+WIDTH = 640
+HEIGHT = 480
+
+
+def _Ifd(endian, offset, entries):
+  """Builds a TIFF IFD at offset, with values over 4 bytes stored after it.
+
+  Args:
+    endian: String; the struct byte order character, '<' or '>'.
+    offset: Integer offset of the IFD in the TIFF structure.
+    entries: List of (tag, field type, count, packed value) tuples.
+
+  Returns:
+    String; the IFD followed by its values.
+  """
+  values_offset = offset + 2 + 12 * len(entries) + 4
+  ifd = struct.pack(endian + 'H', len(entries))
+  values = ''
+  for tag, field_type, count, value in entries:
+    ifd += struct.pack(endian + 'HHI', tag, field_type, count)
+    if len(value) <= 4:
+      ifd += value.ljust(4, '\x00')
+    else:
+      ifd += struct.pack(endian + 'I', values_offset + len(values))
+      values += value
+  return ifd + struct.pack(endian + 'I', 0) + values
+
+
+def _Tiff(endian='<', orientation=None, date_time=None,
+          date_time_original=None):
+  """Builds the TIFF structure of EXIF data with the given fields."""
+  ifd0_entries = []
+  if orientation is not None:
+    ifd0_entries.append((0x0112, 3, 1, struct.pack(endian + 'H',
+                                                   orientation)))
+  if date_time is not None:
+    ifd0_entries.append((0x0132, 2, len(date_time), date_time))
+
+  exif_ifd = ''
+  if date_time_original is not None:
+    # The EXIF IFD pointer is stored inline, so the size of IFD0 doesn't
+    # depend on where the EXIF IFD ends up.
+    ifd0_size = len(_Ifd(endian, 8, ifd0_entries + [(0x8769, 4, 1, '')]))
+    exif_offset = 8 + ifd0_size
+    ifd0_entries.append((0x8769, 4, 1, struct.pack(endian + 'I',
+                                                   exif_offset)))
+    exif_ifd = _Ifd(endian, exif_offset, [
+        (0x9003, 2, len(date_time_original), date_time_original)])
+
+  byte_order = 'II' if endian == '<' else 'MM'
+  return (byte_order + struct.pack(endian + 'HI', 42, 8) +
+          _Ifd(endian, 8, ifd0_entries) + exif_ifd)
+
+
+def _JpegSegment(marker, payload):
+  """Builds a JPEG segment with a length."""
+  return '\xff' + chr(marker) + struct.pack('>H', len(payload) + 2) + payload
+
+
+def _Jpeg(tiff=None, width=WIDTH, height=HEIGHT):
+  """Builds a JPEG with an optional EXIF block, up to its image data."""
+  data = image_metadata.JPEG_SIGNATURE
+  data += _JpegSegment(0xe0, 'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+  if tiff is not None:
+    data += _JpegSegment(0xe1, image_metadata.EXIF_HEADER + tiff)
+  data += _JpegSegment(0xc0, struct.pack('>BHHB', 8, height, width, 1) +
+                       '\x01\x11\x00')
+  data += _JpegSegment(0xda, '\x01\x01\x00\x00\x3f\x00')
+  return data + '\x12\x34\x56\xff\xd9'
+
+
+def _PngChunk(chunk_type, payload):
+  """Builds a PNG chunk, with its CRC."""
+  crc = zlib.crc32(chunk_type + payload) & 0xffffffff
+  return (struct.pack('>I', len(payload)) + chunk_type + payload +
+          struct.pack('>I', crc))
+
+
+def _PngHeader(width=WIDTH, height=HEIGHT):
+  """Builds the signature and IHDR chunk of an 8-bit RGB PNG."""
+  return image_metadata.PNG_SIGNATURE + _PngChunk(
+      'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+
+def _WebpChunk(chunk_type, payload):
+  """Builds a RIFF chunk, padded to an even length."""
+  return (chunk_type + struct.pack('<I', len(payload)) + payload +
+          '\x00' * (len(payload) & 1))
+
+
+def _Webp(*chunks):
+  """Builds a WebP file from its chunks."""
+  body = 'WEBP' + ''.join(chunks)
+  return 'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def _Vp8Chunk(width=WIDTH, height=HEIGHT, scale=0):
+  """Builds a lossy frame chunk; its length is odd, so it is padded."""
+  return _WebpChunk('VP8 ', '\x30\x01\x00\x9d\x01\x2a' +
+                    struct.pack('<HH', width | scale << 14,
+                                height | scale << 14) + '\x00')
+
+
+def _Vp8lChunk(width=WIDTH, height=HEIGHT):
+  """Builds a lossless frame chunk."""
+  bits = (width - 1) | (height - 1) << 14
+  return _WebpChunk('VP8L', '\x2f' + struct.pack('<I', bits) + '\x00' * 3)
+
+
+def _Vp8xChunk(width=WIDTH, height=HEIGHT, exif=False):
+  """Builds the extended header chunk of a WebP."""
+  flags = 0x08 if exif else 0
+  return _WebpChunk('VP8X', chr(flags) + '\x00' * 3 +
+                    struct.pack('<I', width - 1)[:3] +
+                    struct.pack('<I', height - 1)[:3])
+
+
+class ExtractTest(unittest.TestCase):
+  """Tests for image_metadata.extract."""
+
+  def assertMetadata(self, data, width=None, height=None, orientation=None,
+                     taken_at=None):
+    """Asserts that extract reads the given fields from data."""
+    metadata = image_metadata.extract(data)
+    self.assertEqual((width, height, orientation, taken_at),
+                     (metadata.width, metadata.height, metadata.orientation,
+                      metadata.taken_at))
+
+  def testUnknownFormat(self):
+    self.assertMetadata('')
+    self.assertMetadata('BM' + '\x00' * 64)
+
+  def testJpegFrameHeader(self):
+    self.assertMetadata(_Jpeg(), width=WIDTH, height=HEIGHT)
+
+  def testJpegExifLittleEndian(self):
+    tiff = _Tiff('<', orientation=6, date_time=MODIFIED_AT_STRING,
+                 date_time_original=TAKEN_AT_STRING)
+    self.assertMetadata(_Jpeg(tiff), width=WIDTH, height=HEIGHT,
+                        orientation=6, taken_at=TAKEN_AT)
+
+  def testJpegExifBigEndian(self):
+    tiff = _Tiff('>', orientation=8, date_time_original=TAKEN_AT_STRING)
+    self.assertMetadata(_Jpeg(tiff), width=WIDTH, height=HEIGHT,
+                        orientation=8, taken_at=TAKEN_AT)
+
+  def testJpegExifFallsBackToDateTime(self):
+    tiff = _Tiff('<', date_time=MODIFIED_AT_STRING)
+    self.assertMetadata(_Jpeg(tiff), width=WIDTH, height=HEIGHT,
+                        taken_at=MODIFIED_AT)
+
+  def testJpegExifInvalidValuesIgnored(self):
+    tiff = _Tiff('<', orientation=9,
+                 date_time_original='0000:00:00 00:00:00\x00')
+    self.assertMetadata(_Jpeg(tiff), width=WIDTH, height=HEIGHT)
+
+  def testJpegFillBytesAndStandaloneMarkers(self):
+    data = _Jpeg()
+    signature = len(image_metadata.JPEG_SIGNATURE)
+    data = data[:signature] + '\xff\xff\xd0' + data[signature:]
+    self.assertMetadata(data, width=WIDTH, height=HEIGHT)
+
+  def testJpegMalformedExifIgnored(self):
+    tiff = 'XX' + _Tiff('<', orientation=6)[2:]
+    self.assertMetadata(_Jpeg(tiff), width=WIDTH, height=HEIGHT)
+
+  def testJpegTruncatedExif(self):
+    tiff = _Tiff('<', orientation=6, date_time_original=TAKEN_AT_STRING)
+    # Cut the EXIF IFD off; IFD0 is still read.
+    tiff = tiff[:-30]
+    self.assertMetadata(_Jpeg(tiff), width=WIDTH, height=HEIGHT,
+                        orientation=6)
+
+  def testJpegTruncatedBeforeFrameHeader(self):
+    tiff = _Tiff('<', orientation=3, date_time_original=TAKEN_AT_STRING)
+    data = _Jpeg(tiff)
+    data = data[:data.index('\xff\xc0') + 5]
+    self.assertMetadata(data, orientation=3, taken_at=TAKEN_AT)
+    self.assertMetadata(image_metadata.JPEG_SIGNATURE)
+
+  def testJpegInvalidMarker(self):
+    self.assertMetadata(image_metadata.JPEG_SIGNATURE + '\x00\x00' + _Jpeg())
+
+  def testPngHeader(self):
+    self.assertMetadata(_PngHeader() + _PngChunk('IDAT', 'x' * 10) +
+                        _PngChunk('IEND', ''), width=WIDTH, height=HEIGHT)
+
+  def testPngExif(self):
+    tiff = _Tiff('>', orientation=6, date_time_original=TAKEN_AT_STRING)
+    data = (_PngHeader() + _PngChunk('tEXt', 'Comment\x00hello') +
+            _PngChunk('eXIf', tiff) + _PngChunk('IDAT', 'x' * 10))
+    self.assertMetadata(data, width=WIDTH, height=HEIGHT, orientation=6,
+                        taken_at=TAKEN_AT)
+
+  def testPngExifAfterImageDataIgnored(self):
+    tiff = _Tiff('>', orientation=6)
+    data = (_PngHeader() + _PngChunk('IDAT', 'x' * 10) +
+            _PngChunk('eXIf', tiff))
+    self.assertMetadata(data, width=WIDTH, height=HEIGHT)
+
+  def testPngTruncated(self):
+    self.assertMetadata(_PngHeader() + '\x00\x00', width=WIDTH,
+                        height=HEIGHT)
+    self.assertMetadata(image_metadata.PNG_SIGNATURE + '\x00\x00\x00\x0dIHDR')
+
+  def testGif(self):
+    self.assertMetadata('GIF89a' + struct.pack('<HH', WIDTH, HEIGHT),
+                        width=WIDTH, height=HEIGHT)
+    self.assertMetadata('GIF87a\x01')
+
+  def testWebpLossy(self):
+    self.assertMetadata(_Webp(_Vp8Chunk(scale=1)), width=WIDTH,
+                        height=HEIGHT)
+
+  def testWebpLossless(self):
+    self.assertMetadata(_Webp(_Vp8lChunk()), width=WIDTH, height=HEIGHT)
+
+  def testWebpExtendedWithExif(self):
+    tiff = _Tiff('<', orientation=6, date_time_original=TAKEN_AT_STRING)
+    # The lossy frame chunk has an odd length, so the EXIF chunk is only
+    # found if the padding is skipped.
+    data = _Webp(_Vp8xChunk(exif=True), _Vp8Chunk(width=1, height=1),
+                 _WebpChunk('EXIF', image_metadata.EXIF_HEADER + tiff))
+    self.assertMetadata(data, width=WIDTH, height=HEIGHT, orientation=6,
+                        taken_at=TAKEN_AT)
+
+  def testWebpExifWithoutHeader(self):
+    tiff = _Tiff('>', orientation=5)
+    data = _Webp(_Vp8xChunk(exif=True), _Vp8lChunk(),
+                 _WebpChunk('EXIF', tiff))
+    self.assertMetadata(data, width=WIDTH, height=HEIGHT, orientation=5)
+
+  def testWebpExtendedWithoutExifFlag(self):
+    tiff = _Tiff('<', orientation=6)
+    data = _Webp(_Vp8xChunk(), _Vp8lChunk(width=1, height=1),
+                 _WebpChunk('EXIF', tiff))
+    self.assertMetadata(data, width=WIDTH, height=HEIGHT)
+
+  def testWebpTruncated(self):
+    data = _Webp(_Vp8xChunk(exif=True), _Vp8Chunk())
+    self.assertMetadata(data[:-4], width=WIDTH, height=HEIGHT)
+    self.assertMetadata(_Webp(_Vp8Chunk())[:20])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,256 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module for per-method instrumentation of the Endpoints SPI application.
+
+InstrumentedApplication wraps a WSGI application and, for every request
+under a path prefix (the SPI, or background job tasks; see jobs.py),
+records the wall time, request and response sizes and the number of service
+RPCs (datastore, urlfetch, task queue, memcache) made while handling it.
+
+RPCs are counted by API proxy hooks which are installed once per instance.
+Since the application is threadsafe, the record for the request being handled
+is kept in a thread local, so concurrent requests are not mixed up.
+
+Each request is logged as a single structured line:
+
+  api_stats {"method": "PicturesqueApi.PhotoList", "wallMs": 12, ...}
+
+and folded into per-instance totals which are periodically added to shared
+memcache counters. get_stats reads those totals; they are served to admins
+by admin_stats.py.
+"""
+
+
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+
+LOG_PREFIX = 'api_stats'
+SPI_PREFIX = '/_ah/spi/'
+MEMCACHE_NAMESPACE = 'picturesque-stats'
+FLUSH_INTERVAL_SECONDS = 10
+
+# RPCs which are aggregated across requests. Every RPC is still counted in
+# the per-request log line.
+TRACKED_RPCS = (
+    'datastore_v3.Get',
+    'datastore_v3.Put',
+    'datastore_v3.Delete',
+    'datastore_v3.RunQuery',
+    'datastore_v3.Next',
+    'datastore_v3.BeginTransaction',
+    'datastore_v3.Commit',
+    'memcache.Get',
+    'memcache.Set',
+    'taskqueue.BulkAdd',
+    'urlfetch.Fetch',
+)
+COUNTERS = (
+    'calls',
+    'errors',
+    'wallMs',
+    'requestBytes',
+    'responseBytes',
+    'memcacheKeys',
+    'memcacheHits',
+) + TRACKED_RPCS
+
+
+_LOCAL = threading.local()
+
+
+class RequestRecord(object):
+  """Measurements for a single request.
+
+  Attributes:
+    method: String; the SPI method name, e.g. 'PicturesqueApi.PhotoList',
+      or job name.
+    rpcs: Dictionary of RPC counts keyed by 'service.Call'.
+    memcache_keys: Integer; number of keys requested via memcache Get.
+    memcache_hits: Integer; number of those keys which were found.
+  """
+
+  def __init__(self, method):
+    self.method = method
+    self.rpcs = {}
+    self.memcache_keys = 0
+    self.memcache_hits = 0
+
+  def AddRpc(self, service, call, request, response):
+    """Counts an RPC, including cache hits for memcache gets."""
+    name = '%s.%s' % (service, call)
+    self.rpcs[name] = self.rpcs.get(name, 0) + 1
+
+    if name == 'memcache.Get':
+      self.memcache_keys += request.key_size()
+      self.memcache_hits += response.item_size()
+
+
+def _post_call_hook(service, call, request, response):
+  """API proxy hook which adds the RPC to the current request record.
+
+  RPCs made outside of an instrumented request (including the ones made by
+  this module to flush counters) are ignored.
+  """
+  record = getattr(_LOCAL, 'record', None)
+  if record is not None:
+    record.AddRpc(service, call, request, response)
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'picturesque_instrumentation', _post_call_hook)
+
+
+class _Totals(object):
+  """Per-instance counter totals, periodically added to memcache."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._last_flush = time.time()
+
+  def Add(self, method, values):
+    """Adds counter values for a method.
+
+    Args:
+      method: String; the SPI method name.
+      values: Dictionary of counter name to integer increment.
+    """
+    with self._lock:
+      for name, value in values.iteritems():
+        if value:
+          key = '%s:%s' % (method, name)
+          self._counters[key] = self._counters.get(key, 0) + value
+
+  def MaybeFlush(self):
+    """Adds the totals to memcache if FLUSH_INTERVAL_SECONDS have passed."""
+    now = time.time()
+    with self._lock:
+      if now - self._last_flush < FLUSH_INTERVAL_SECONDS:
+        return
+      counters, self._counters = self._counters, {}
+      self._last_flush = now
+
+    if counters:
+      memcache.offset_multi(counters, namespace=MEMCACHE_NAMESPACE,
+                            initial_value=0)
+
+
+_TOTALS = _Totals()
+
+
+class InstrumentedApplication(object):
+  """WSGI middleware recording per-method stats for SPI requests.
+
+  Args:
+    application: The WSGI application to be wrapped.
+    prefix: String; only requests with paths starting with the prefix are
+      recorded, with the rest of the path as the method name. Defaults to
+      SPI_PREFIX.
+  """
+
+  def __init__(self, application, prefix=SPI_PREFIX):
+    self.application = application
+    self.prefix = prefix
+
+  def __call__(self, environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    if not path.startswith(self.prefix):
+      return self.application(environ, start_response)
+
+    record = RequestRecord(path[len(self.prefix):])
+    status_holder = []
+
+    def recording_start_response(status, *args, **kwargs):
+      status_holder.append(status)
+      return start_response(status, *args, **kwargs)
+
+    _LOCAL.record = record
+    start = time.time()
+    try:
+      # Endpoints returns a list of strings, so this doesn't change how the
+      # response is streamed.
+      body = list(self.application(environ, recording_start_response))
+    finally:
+      wall_ms = int(1000 * (time.time() - start))
+      _LOCAL.record = None
+
+    try:
+      request_bytes = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+      request_bytes = 0
+    status = status_holder[0] if status_holder else '500'
+    self._Report(record, status, wall_ms, request_bytes,
+                 sum(len(chunk) for chunk in body))
+    return body
+
+  @staticmethod
+  def _Report(record, status, wall_ms, request_bytes, response_bytes):
+    """Logs a request record and adds it to the totals."""
+    error = not status.startswith(('1', '2', '3'))
+    logging.info('%s %s', LOG_PREFIX, json.dumps({
+        'method': record.method,
+        'status': int(status.split(' ', 1)[0]),
+        'wallMs': wall_ms,
+        'requestBytes': request_bytes,
+        'responseBytes': response_bytes,
+        'memcacheKeys': record.memcache_keys,
+        'memcacheHits': record.memcache_hits,
+        'rpcs': record.rpcs,
+    }, sort_keys=True))
+
+    values = {
+        'calls': 1,
+        'errors': int(error),
+        'wallMs': wall_ms,
+        'requestBytes': request_bytes,
+        'responseBytes': response_bytes,
+        'memcacheKeys': record.memcache_keys,
+        'memcacheHits': record.memcache_hits,
+    }
+    for name in TRACKED_RPCS:
+      values[name] = record.rpcs.get(name, 0)
+
+    try:
+      _TOTALS.Add(record.method, values)
+      _TOTALS.MaybeFlush()
+    except Exception:  # Stats must never fail a request.
+      logging.exception('Failed to record API stats.')
+
+
+def get_stats(methods):
+  """Retrieves aggregated stats for the given methods from memcache.
+
+  Args:
+    methods: List of SPI method names, e.g. 'PicturesqueApi.PhotoList'.
+
+  Returns:
+    Dictionary keyed by method with a dictionary of counters plus derived
+      per-call averages and the memcache hit rate. Methods which have not
+      been called are omitted.
+  """
+  keys = ['%s:%s' % (method, name) for method in methods for name in COUNTERS]
+  values = memcache.get_multi(keys, namespace=MEMCACHE_NAMESPACE)
+
+  stats = {}
+  for method in methods:
+    counters = dict((name, values.get('%s:%s' % (method, name), 0))
+                    for name in COUNTERS)
+    calls = counters['calls']
+    if not calls:
+      continue
+
+    method_stats = {'counters': counters}
+    method_stats['perCall'] = dict(
+        (name, counters[name] / float(calls)) for name in COUNTERS
+        if name not in ('calls', 'errors', 'memcacheKeys', 'memcacheHits'))
+    if counters['memcacheKeys']:
+      method_stats['memcacheHitRate'] = (
+          counters['memcacheHits'] / float(counters['memcacheKeys']))
+    stats[method] = method_stats
+  return stats
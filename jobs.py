@@ -0,0 +1,430 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module for typed, batched background jobs run on task queues.
+
+A job type is a Job subclass registered with register. It declares a
+ProtoRPC message class for its payloads, the queue it runs on, how many
+payloads are handled per task and a RetryPolicy, and implements Run, which
+is given a list of payloads:
+
+  @jobs.register
+  class ExampleJob(jobs.Job):
+    name = 'example'
+    payload_class = ExamplePayload
+    batch_size = 20
+
+    def Run(self, payloads):
+      ...
+
+  jobs.enqueue(ExampleJob, [ExamplePayload(...), ...])
+
+Payloads are serialized as JSON with protojson rather than pickled, so queued
+tasks stay readable in the admin console and don't break when the code
+they'd have unpickled changes.
+
+enqueue splits the payloads into batches of batch_size, one task per batch,
+and adds the tasks with as few Queue.add calls as possible. Passing an
+idempotency_key names the tasks, so enqueueing the same work again (e.g. from
+a retried request) adds nothing. Independently, every task is marked as done
+in memcache once it has run, so a task delivered more than once is only run
+once (as long as the mark is not evicted; Run should still be idempotent).
+
+Tasks are POSTed to JOB_PREFIX + name and handled by application, which
+worker.py wraps in instrumentation.InstrumentedApplication so each job type
+gets the same stats as API methods (calls, errors, wall time and RPCs).
+
+For tests and tools, set_executor(LocalExecutor()) makes enqueue collect
+tasks in-process instead; LocalExecutor.RunAll then runs them (and any tasks
+they enqueue) applying the retry policy without waiting.
+"""
+
+
+import collections
+import json
+import logging
+import time
+
+from google.appengine.api import memcache
+from protorpc import protojson
+
+
+JOB_PREFIX = '/_ah/jobs/'
+MEMCACHE_NAMESPACE = 'picturesque-jobs'
+DONE_SECONDS = 24 * 60 * 60
+# Limits of a single Queue.add call.
+MAX_TASKS_PER_ADD = 100
+MAX_TRANSACTIONAL_TASKS = 5
+
+_JOBS = {}
+
+
+class PermanentJobError(Exception):
+  """Raised by Job.Run when retrying the task could never succeed."""
+
+
+class RetryPolicy(object):
+  """How often and how quickly a failed task is retried.
+
+  Args:
+    max_attempts: Integer; maximum number of times a task is run, or None to
+      retry until it succeeds.
+    min_backoff_seconds: Number; delay before the first retry.
+    max_backoff_seconds: Number; limit on the (doubling) delay between
+      retries.
+  """
+
+  def __init__(self, max_attempts=None, min_backoff_seconds=1,
+               max_backoff_seconds=600):
+    self.max_attempts = max_attempts
+    self.min_backoff_seconds = min_backoff_seconds
+    self.max_backoff_seconds = max_backoff_seconds
+
+  def TaskRetryOptions(self):
+    """Creates the equivalent task queue retry options."""
+    # Only needed here, so not imported when an instance starts.
+    from google.appengine.api import taskqueue
+
+    task_retry_limit = None
+    if self.max_attempts is not None:
+      task_retry_limit = self.max_attempts - 1
+    return taskqueue.TaskRetryOptions(
+        task_retry_limit=task_retry_limit,
+        min_backoff_seconds=self.min_backoff_seconds,
+        max_backoff_seconds=self.max_backoff_seconds)
+
+  def Delay(self, retry_count):
+    """Computes the delay before a retry.
+
+    Args:
+      retry_count: Integer; the number of failed attempts so far.
+
+    Returns:
+      Number of seconds to wait before the next attempt.
+    """
+    return min(self.min_backoff_seconds * 2 ** max(retry_count - 1, 0),
+               self.max_backoff_seconds)
+
+  def ShouldRetry(self, retry_count):
+    """Determines whether another attempt is allowed.
+
+    Args:
+      retry_count: Integer; the number of failed attempts so far.
+
+    Returns:
+      Boolean; True if the task should be run again.
+    """
+    return self.max_attempts is None or retry_count < self.max_attempts
+
+
+class Job(object):
+  """Base class for background job types.
+
+  Subclasses override the attributes below and Run, and are registered with
+  register. A new instance is created for every task, so Run can keep state
+  for the batch it's handling on self.
+
+  Attributes:
+    name: String; unique name of the job type, used in task URLs and stats.
+    payload_class: The ProtoRPC message class of the payloads.
+    queue_name: String; the task queue the job type runs on.
+    batch_size: Integer; maximum number of payloads handled per task.
+    retry_policy: A RetryPolicy.
+  """
+
+  name = None
+  payload_class = None
+  queue_name = 'default'
+  batch_size = 1
+  retry_policy = RetryPolicy()
+
+  def Run(self, payloads):
+    """Runs the job for a batch of payloads.
+
+    Raising any exception fails the task, so it is retried according to
+    retry_policy; raise PermanentJobError to drop the task instead.
+
+    Args:
+      payloads: List of payload_class instances; at most batch_size of them.
+    """
+    raise NotImplementedError
+
+
+def register(job_class):
+  """Class decorator registering a job type so its tasks can be handled.
+
+  Args:
+    job_class: A Job subclass.
+
+  Returns:
+    job_class, unchanged.
+
+  Raises:
+    ValueError: if the job type has no name or payload class or its name is
+      already registered for another class.
+  """
+  if not job_class.name or job_class.payload_class is None:
+    raise ValueError('Job %s needs a name and payload class.' %
+                     (job_class.__name__,))
+  existing = _JOBS.get(job_class.name)
+  if existing is not None and existing is not job_class:
+    raise ValueError('Job name %r is already registered.' % (job_class.name,))
+  _JOBS[job_class.name] = job_class
+  return job_class
+
+
+def registered_names():
+  """Returns the sorted names of all registered job types."""
+  return sorted(_JOBS)
+
+
+def encode_payloads(payloads):
+  """Serializes a batch of payloads as a JSON array."""
+  return '[%s]' % ','.join(protojson.encode_message(payload)
+                           for payload in payloads)
+
+
+def decode_payloads(payload_class, body):
+  """Parses a batch of payloads serialized by encode_payloads."""
+  return [protojson.decode_message(payload_class, json.dumps(value))
+          for value in json.loads(body)]
+
+
+def _Batches(job_class, payloads):
+  """Checks payloads and splits them into batches of job_class.batch_size.
+
+  Raises:
+    TypeError: if a payload is not an instance of job_class.payload_class.
+    protorpc.messages.ValidationError: if a payload is missing required
+      fields.
+  """
+  for payload in payloads:
+    if not isinstance(payload, job_class.payload_class):
+      raise TypeError('Job %s expects %s payloads, got %r.' %
+                      (job_class.name, job_class.payload_class.__name__,
+                       payload))
+    payload.check_initialized()
+  return [payloads[start:start + job_class.batch_size]
+          for start in xrange(0, len(payloads), job_class.batch_size)]
+
+
+def _TaskName(job_class, idempotency_key, index):
+  """Creates the name of a task from an idempotency key."""
+  return '%s-%s-%d' % (job_class.name, idempotency_key, index)
+
+
+class TaskQueueExecutor(object):
+  """Executor adding one push task per batch; the default."""
+
+  def Submit(self, job_class, batches, idempotency_key=None,
+             transactional=False, countdown=None):
+    """Adds the tasks for batches of payloads.
+
+    Args:
+      job_class: The registered Job subclass.
+      batches: List of lists of payloads; see _Batches.
+      idempotency_key: Optional string used to name the tasks.
+      transactional: Boolean; whether to add the tasks transactionally.
+      countdown: Optional number of seconds before the tasks run.
+
+    Raises:
+      ValueError: if the tasks are named and transactional, or there are too
+        many batches to add transactionally.
+    """
+    # Only needed here, so not imported when an instance starts.
+    from google.appengine.api import taskqueue
+
+    if transactional:
+      if idempotency_key is not None:
+        raise ValueError('Named tasks can\'t be added transactionally.')
+      if len(batches) > MAX_TRANSACTIONAL_TASKS:
+        raise ValueError('At most %d tasks can be added transactionally.' %
+                         (MAX_TRANSACTIONAL_TASKS,))
+
+    retry_options = job_class.retry_policy.TaskRetryOptions()
+    tasks = []
+    for index, batch in enumerate(batches):
+      name = None
+      if idempotency_key is not None:
+        name = _TaskName(job_class, idempotency_key, index)
+      tasks.append(taskqueue.Task(
+          url=JOB_PREFIX + job_class.name, payload=encode_payloads(batch),
+          name=name, countdown=countdown, retry_options=retry_options))
+
+    queue = taskqueue.Queue(job_class.queue_name)
+    for start in xrange(0, len(tasks), MAX_TASKS_PER_ADD):
+      try:
+        queue.add(tasks[start:start + MAX_TASKS_PER_ADD],
+                  transactional=transactional)
+      except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # The other tasks in the call are still added.
+        logging.info('Some %s tasks for %r were already added.',
+                     job_class.name, idempotency_key)
+
+
+class LocalExecutor(object):
+  """Executor running jobs in-process, for tests and tools.
+
+  Tasks are collected as they are enqueued (transactional or not) and run by
+  RunAll, so a test can enqueue, assert on what is pending and then run.
+
+  Attributes:
+    pending: Deque of (job_class, batch, task_name) tuples not yet run.
+    runs: Counter of successful runs keyed by job name.
+    retries: Counter of failed attempts that were retried, keyed by job name.
+    delays: List of (job name, seconds) the task queue would have waited
+      before each retry.
+    failures: List of (job name, batch, exception) for tasks given up on.
+  """
+
+  def __init__(self):
+    self.pending = collections.deque()
+    self.runs = collections.Counter()
+    self.retries = collections.Counter()
+    self.delays = []
+    self.failures = []
+    self._added_names = set()
+
+  def Submit(self, job_class, batches, idempotency_key=None,
+             transactional=False, countdown=None):
+    """Collects tasks for batches of payloads; see TaskQueueExecutor."""
+    for index, batch in enumerate(batches):
+      name = None
+      if idempotency_key is not None:
+        name = _TaskName(job_class, idempotency_key, index)
+        if name in self._added_names:
+          continue
+        self._added_names.add(name)
+      # Round trip through JSON, so unserializable payloads fail here too.
+      batch = decode_payloads(job_class.payload_class, encode_payloads(batch))
+      self.pending.append((job_class, batch, name))
+
+  def RunAll(self):
+    """Runs pending tasks, including ones they enqueue, until none are left.
+
+    Returns:
+      Integer; the number of tasks run.
+    """
+    count = 0
+    while self.pending:
+      job_class, batch, _ = self.pending.popleft()
+      self._RunTask(job_class, batch)
+      count += 1
+    return count
+
+  def _RunTask(self, job_class, batch):
+    """Runs a task, retrying it immediately as allowed by its policy."""
+    policy = job_class.retry_policy
+    retry_count = 0
+    while True:
+      try:
+        job_class().Run(batch)
+      except PermanentJobError as exc:
+        self.failures.append((job_class.name, batch, exc))
+        return
+      except Exception as exc:  # Same as the task queue: any error retries.
+        retry_count += 1
+        if not policy.ShouldRetry(retry_count):
+          logging.exception('Giving up on %s task.', job_class.name)
+          self.failures.append((job_class.name, batch, exc))
+          return
+        self.retries[job_class.name] += 1
+        self.delays.append((job_class.name, policy.Delay(retry_count)))
+      else:
+        self.runs[job_class.name] += 1
+        return
+
+
+_executor = TaskQueueExecutor()
+
+
+def set_executor(executor):
+  """Replaces the executor used by enqueue.
+
+  Args:
+    executor: A TaskQueueExecutor or LocalExecutor instance.
+
+  Returns:
+    The previous executor, so it can be restored.
+  """
+  global _executor
+  previous, _executor = _executor, executor
+  return previous
+
+
+def enqueue(job_class, payloads, idempotency_key=None, transactional=False,
+            countdown=None):
+  """Enqueues payloads for a job type, batch_size payloads per task.
+
+  Args:
+    job_class: A registered Job subclass.
+    payloads: List of job_class.payload_class instances.
+    idempotency_key: Optional string; if set, enqueueing with the same key
+      again (for the same payloads) adds no tasks. Can't be combined with
+      transactional. Must only contain characters allowed in task names.
+    transactional: Boolean; whether the tasks are only added if the current
+      datastore transaction commits. At most MAX_TRANSACTIONAL_TASKS batches.
+    countdown: Optional number of seconds before the tasks run.
+
+  Raises:
+    ValueError: if the job type is not registered.
+    TypeError: if a payload has the wrong type.
+  """
+  if _JOBS.get(job_class.name) is not job_class:
+    raise ValueError('Job %s is not registered.' % (job_class.__name__,))
+
+  batches = _Batches(job_class, list(payloads))
+  if batches:
+    _executor.Submit(job_class, batches, idempotency_key=idempotency_key,
+                     transactional=transactional, countdown=countdown)
+
+
+def _Respond(start_response, status, message=''):
+  """Sends a plain text response."""
+  start_response(status, [('Content-Type', 'text/plain')])
+  return [message]
+
+
+def application(environ, start_response):
+  """WSGI application handling job tasks POSTed to JOB_PREFIX + name.
+
+  Only admins (which includes the task queue) are allowed; see app.yaml.
+  Returns 200 when the task is done (or dropped) and 500 to have it retried.
+  """
+  name = environ.get('PATH_INFO', '')[len(JOB_PREFIX):]
+  job_class = _JOBS.get(name)
+  if job_class is None:
+    return _Respond(start_response, '404 Not Found', 'Unknown job.')
+  if environ.get('REQUEST_METHOD') != 'POST':
+    return _Respond(start_response, '405 Method Not Allowed')
+
+  task_name = environ.get('HTTP_X_APPENGINE_TASKNAME')
+  retry_count = int(environ.get('HTTP_X_APPENGINE_TASKRETRYCOUNT') or 0)
+  done_key = None
+  if task_name is not None:
+    done_key = '%s:%s' % (job_class.queue_name, task_name)
+    if memcache.get(done_key, namespace=MEMCACHE_NAMESPACE):
+      logging.info('Task %s already ran.', task_name)
+      return _Respond(start_response, '200 OK')
+
+  try:
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    payloads = decode_payloads(job_class.payload_class, body)
+  except Exception:  # Malformed payloads will never succeed.
+    logging.exception('Dropping %s task with bad payloads.', name)
+    return _Respond(start_response, '200 OK')
+
+  start = time.time()
+  try:
+    job_class().Run(payloads)
+  except PermanentJobError:
+    logging.exception('Dropping %s task.', name)
+    return _Respond(start_response, '200 OK')
+  except Exception:  # Any other error has the task queue retry.
+    logging.exception('%s task failed (attempt %d).', name, retry_count + 1)
+    return _Respond(start_response, '500 Internal Server Error')
+
+  logging.info('%s task ran %d payloads in %.3fs (attempt %d).', name,
+               len(payloads), time.time() - start, retry_count + 1)
+  if done_key is not None:
+    memcache.set(done_key, 1, time=DONE_SECONDS, namespace=MEMCACHE_NAMESPACE)
+  return _Respond(start_response, '200 OK')
@@ -0,0 +1,356 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module for bulk import, export and removal of a user's photo library.
+
+Photos are read and written one at a time as JSON payloads in the same format
+used by the API (title, description, base64Photo, mimeType), either as JSON
+lines (one payload per line) or, for import only, as a single JSON array such
+as demo-images/default-items.json. Only a bounded number of photos is held in
+memory at once, no matter how large the library is.
+
+Datastore writes are issued in batches of batch_size via put_multi_async /
+delete_multi_async, with up to max_in_flight batches outstanding at a time.
+Sharing (the photo ACL) is not carried across an export and import. The
+owner's storage usage counters (see models.UsageShard) are updated with each
+batch, but the storage quota is not enforced.
+
+Each operation accepts a progress_callback which is called as
+progress_callback(count, checkpoint) after every batch; the checkpoint can be
+passed back in to resume an interrupted run:
+
+  - import_library: the number of payloads committed; pass as skip.
+  - export_library: a urlsafe cursor string; pass as start_cursor and append
+    to the existing output.
+  - delete_library: None; deleting is naturally resumable by running again.
+
+To be run from the remote api shell, e.g.:
+
+  s~your-app-id> import library_io
+  s~your-app-id> with open('photos.jsonl', 'w') as fh:
+  ...   library_io.export_library(user, fh)
+"""
+
+
+import base64
+import collections
+import json
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import appengine_config  # For import path mangling
+import models
+import photo_storage
+
+
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_MAX_IN_FLIGHT = 4
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def log_progress(count, checkpoint):
+  """Default progress callback; logs the count and checkpoint."""
+  logging.info('Processed %d photos (checkpoint: %r)', count, checkpoint)
+
+
+def _iter_json_lines(fh, buffered):
+  """Yields parsed payloads from a JSON lines file.
+
+  Args:
+    fh: File-like object positioned after the buffered contents.
+    buffered: String; contents already read from fh.
+
+  Yields:
+    Dictionary for each non-blank line.
+  """
+  line_end = buffered.find('\n')
+  while line_end != -1:
+    line = buffered[:line_end].strip()
+    if line:
+      yield json.loads(line)
+    buffered = buffered[line_end + 1:]
+    line_end = buffered.find('\n')
+
+  # fh.readline would read the rest of the first line anyway.
+  buffered += fh.readline()
+  while buffered:
+    line = buffered.strip()
+    if line:
+      yield json.loads(line)
+    buffered = fh.readline()
+
+
+def _iter_json_array(fh, buffered):
+  """Yields parsed payloads from a file containing a single JSON array.
+
+  Decodes one element at a time, reading more of the file only when the
+  current element is incomplete.
+
+  Args:
+    fh: File-like object positioned after the buffered contents.
+    buffered: String; contents already read from fh, beginning with '['.
+
+  Yields:
+    Dictionary for each element of the array.
+
+  Raises:
+    ValueError: if the file ends before the array is closed.
+  """
+  decoder = json.JSONDecoder()
+  buffered = buffered.lstrip()[1:]
+  while True:
+    buffered = buffered.lstrip()
+    if buffered.startswith(','):
+      buffered = buffered[1:].lstrip()
+    if buffered.startswith(']'):
+      return
+
+    try:
+      if not buffered:
+        raise ValueError('Need more data.')
+      payload, end = decoder.raw_decode(buffered)
+    except ValueError:
+      chunk = fh.read(READ_CHUNK_SIZE)
+      if not chunk:
+        raise ValueError('Unexpected end of JSON array.')
+      buffered += chunk
+      continue
+
+    yield payload
+    buffered = buffered[end:]
+
+
+def iter_payloads(fh):
+  """Yields photo payloads from a JSON lines or JSON array file.
+
+  Args:
+    fh: File-like object open for reading.
+
+  Returns:
+    Iterator of dictionaries, one per photo.
+  """
+  buffered = fh.read(READ_CHUNK_SIZE)
+  if buffered.lstrip().startswith('['):
+    return _iter_json_array(fh, buffered)
+  return _iter_json_lines(fh, buffered)
+
+
+def payload_to_photo(payload, owner, parent=None):
+  """Creates a (not yet stored) Photo from an API style payload.
+
+  Args:
+    payload: Dictionary with keys 'title', 'base64Photo', 'mimeType' and
+      optionally 'description'.
+    owner: App Engine User to own the photo.
+    parent: Optional parent key for the photo; see import_library.
+
+  Returns:
+    A Photo instance, with metadata and the perceptual hash computed from its
+      contents.
+  """
+  photo = models.Photo(parent=parent, title=payload['title'],
+                       description=payload.get('description'),
+                       base64_photo=base64.b64decode(payload['base64Photo']),
+                       mime_type=payload['mimeType'],
+                       owner=owner)
+  photo.ExtractMetadata()
+  photo.ComputePerceptualHash()
+  return photo
+
+
+def photo_to_payload(photo):
+  """Creates an API style payload from a Photo.
+
+  Args:
+    photo: A Photo instance.
+
+  Returns:
+    Dictionary which can be serialized to JSON and read by payload_to_photo.
+  """
+  payload = {
+      'title': photo.title,
+      'base64Photo': base64.b64encode(photo.base64_photo),
+      'mimeType': photo.mime_type,
+  }
+  if photo.description is not None:
+    payload['description'] = photo.description
+  return payload
+
+
+class _BoundedBatches(object):
+  """Tracks outstanding batches of datastore futures.
+
+  Batches are waited on in the order they were added, so the completed
+  count only ever covers a prefix of the input; this is what makes the
+  count usable as a checkpoint.
+  """
+
+  def __init__(self, max_in_flight, progress_callback, completed=0):
+    self._in_flight = collections.deque()
+    self._max_in_flight = max_in_flight
+    self._progress_callback = progress_callback
+    self.completed = completed
+
+  def add(self, futures, count, checkpoint=None):
+    """Adds a batch, waiting for the oldest ones if over the limit.
+
+    Args:
+      futures: List of ndb futures for the batch.
+      count: Integer; number of photos in the batch.
+      checkpoint: Value to report once the batch completes. If None, the
+        completed count is reported.
+    """
+    self._in_flight.append((futures, count, checkpoint))
+    while len(self._in_flight) > self._max_in_flight:
+      self._wait_oldest()
+
+  def _wait_oldest(self):
+    """Waits for the oldest outstanding batch and reports progress."""
+    futures, count, checkpoint = self._in_flight.popleft()
+    for future in futures:
+      future.get_result()
+    self.completed += count
+    if checkpoint is None:
+      checkpoint = self.completed
+    self._progress_callback(self.completed, checkpoint)
+
+  def wait_all(self):
+    """Waits for all outstanding batches."""
+    while self._in_flight:
+      self._wait_oldest()
+
+
+def import_library(owner, fh, skip=0, batch_size=DEFAULT_BATCH_SIZE,
+                   max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                   progress_callback=log_progress, googleplus_user_id=None):
+  """Imports photos from a file into the library of a user.
+
+  Args:
+    owner: App Engine User to own the imported photos.
+    fh: File-like object open for reading; see iter_payloads.
+    skip: Integer; number of payloads at the start of the file to skip. Used
+      to resume from a checkpoint.
+    batch_size: Integer; number of photos per put_multi_async call.
+    max_in_flight: Integer; maximum number of outstanding batches.
+    progress_callback: Function called with (count, checkpoint) as batches
+      are committed.
+    googleplus_user_id: Optional string; the Google+ ID of the owner. Needed
+      if models.Photo.PARENT_UNDER_OWNER is set, since the photos are then
+      created under the owner's PicturesqueUser.
+
+  Returns:
+    Integer; the total number of payloads committed, including those skipped.
+
+  Raises:
+    ValueError: if the photos are to be parented under their owner, but no
+      googleplus_user_id is given.
+  """
+  parent = None
+  if models.Photo.PARENT_UNDER_OWNER:
+    if googleplus_user_id is None:
+      raise ValueError('googleplus_user_id is needed to create photos under '
+                       'their owner.')
+    parent = models.Photo.OwnerParent(googleplus_user_id)
+  batches = _BoundedBatches(max_in_flight, progress_callback, completed=skip)
+
+  def add_batch(photos):
+    futures = ndb.put_multi_async(photos)
+    # The contents may have been moved to the storage backend by now.
+    futures.append(models.UsageShard.AddAsync(
+        owner, len(photos), sum(photo.ContentSize() for photo in photos)))
+    batches.add(futures, len(photos))
+
+  current_batch = []
+  for index, payload in enumerate(iter_payloads(fh)):
+    if index < skip:
+      continue
+
+    current_batch.append(payload_to_photo(payload, owner, parent=parent))
+    if len(current_batch) == batch_size:
+      add_batch(current_batch)
+      current_batch = []
+
+  if current_batch:
+    add_batch(current_batch)
+  batches.wait_all()
+  return batches.completed
+
+
+def export_library(owner, fh, start_cursor=None, batch_size=DEFAULT_BATCH_SIZE,
+                   progress_callback=log_progress):
+  """Exports the library of a user to a file as JSON lines.
+
+  Args:
+    owner: App Engine User whose photos will be exported.
+    fh: File-like object open for writing (or appending, when resuming).
+    start_cursor: Optional urlsafe cursor string to resume from.
+    batch_size: Integer; number of photos fetched per page.
+    progress_callback: Function called with (count, checkpoint) after each
+      page is written.
+
+  Returns:
+    Integer; the number of photos written by this call.
+  """
+  query = models.Photo.query(models.Photo.owner == owner)
+  cursor = None
+  if start_cursor is not None:
+    cursor = Cursor(urlsafe=start_cursor)
+
+  count = 0
+  more_results = True
+  while more_results:
+    photos, cursor, more_results = query.fetch_page(batch_size,
+                                                    start_cursor=cursor)
+    models.Photo.LoadContents(photos)
+    for photo in photos:
+      fh.write(json.dumps(photo_to_payload(photo)))
+      fh.write('\n')
+    count += len(photos)
+
+    if photos:
+      fh.flush()
+      progress_callback(count, cursor.urlsafe() if cursor else None)
+
+  return count
+
+
+def delete_library(owner, batch_size=DEFAULT_BATCH_SIZE,
+                   max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                   progress_callback=log_progress):
+  """Deletes every photo in the library of a user.
+
+  Args:
+    owner: App Engine User whose photos will be deleted.
+    batch_size: Integer; number of keys fetched and deleted per batch.
+    max_in_flight: Integer; maximum number of outstanding delete batches.
+    progress_callback: Function called with (count, None) as batches are
+      deleted.
+
+  Returns:
+    Integer; the number of photos deleted.
+  """
+  query = models.Photo.query(models.Photo.owner == owner)
+  batches = _BoundedBatches(max_in_flight,
+                            lambda count, _: progress_callback(count, None))
+  # Contents in a storage backend are deleted once the photos are, so their
+  # keys are needed; otherwise only the photo keys are.
+  keys_only = photo_storage.get_storage() is None
+  content_keys = []
+  cursor = None
+  more_results = True
+  while more_results:
+    results, cursor, more_results = query.fetch_page(
+        batch_size, start_cursor=cursor, keys_only=keys_only)
+    if keys_only:
+      keys = results
+    else:
+      keys = [photo._key for photo in results]
+      content_keys.extend(photo.content_key for photo in results)
+    if keys:
+      batches.add(ndb.delete_multi_async(keys), len(keys))
+
+  batches.wait_all()
+  models.Photo.DeleteContents(content_keys)
+  models.UsageShard.Reset(owner)
+  return batches.completed
@@ -0,0 +1,48 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Generates the stored Endpoints API config used by api_config_cache.
+
+Run from the application root before deploying, after any change to the API
+or an update of the endpoints-proto-datastore submodule:
+
+  python make_api_config.py /path/to/google_appengine [hostname]
+
+The hostname defaults to the appspot.com hostname of the application in
+app.yaml.
+"""
+
+
+import os
+import sys
+
+
+def default_hostname():
+  """Determines the appspot.com hostname from the application in app.yaml."""
+  with open('app.yaml', 'r') as fh:
+    for line in fh:
+      if line.startswith('application:'):
+        return '%s.appspot.com' % line.split(':', 1)[1].strip()
+
+
+def main(sdk_path, hostname):
+  """Imports the API with the SDK on the path and writes its config."""
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  # Always generate the configs, even if a stored version exists.
+  os.environ['PICTURESQUE_DISABLE_API_CONFIG_CACHE'] = '1'
+  os.environ['DEFAULT_VERSION_HOSTNAME'] = hostname
+
+  import appengine_config  # For import path mangling
+  import api_config_cache
+  import services
+
+  api_config_cache.write_configs(services.api_list,
+                                 **services.API_SERVER_KWARGS)
+  print 'Wrote %s for %s' % (api_config_cache.API_CONFIG_FILE, hostname)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) not in (2, 3):
+    sys.exit(__doc__)
+  main(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else default_hostname())
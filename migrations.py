@@ -0,0 +1,620 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module for online schema migrations and reindexing of stored entities.
+
+A migration is a Migration subclass registered with register. It names the
+model class to walk and a version, and implements Transform, which updates a
+single entity in place and reports whether it changed:
+
+  @migrations.register
+  class ExampleMigration(migrations.Migration):
+    name = 'example'
+    version = 1
+    model_class = models.Photo
+
+    def Transform(self, photo):
+      ...
+      return True
+
+Running a migration (from the remote api shell, see README.md):
+
+  s~your-app-id> import migrations
+  s~your-app-id> migrations.start('example')
+  s~your-app-id> migrations.status('example')
+
+The kind is split into key ranges (shards) using the __scatter__ property,
+and each shard is walked in key order by a chain of MigrationBatchJob tasks:
+each task fetches a page of keys with fetch_page, then gets, transforms and
+(if it changed) puts each entity in a transaction of its own, and finally
+checkpoints the shard's cursor and counts. Since the entity is read in the
+same transaction it is written in, a user write made while the batch runs
+(e.g. removing someone from a photo ACL) is never overwritten with an older
+copy; the transaction is retried and transforms the new version instead.
+The tasks run on the 'migrations' queue, whose max_concurrent_requests (see
+queue.yaml) bounds how many batches run at once however many shards there
+are, so a migration doesn't starve serving traffic.
+
+Progress is stored in a MigrationState entity per name and version, with a
+MigrationShard child per shard. A batch is only applied if its step matches
+the shard's checkpoint, so redelivered tasks are skipped. Since a batch
+may still be written again if its task fails after some of its entities were
+written but before the checkpoint (and a transaction may run Transform more
+than once), Transform must be idempotent. A migration whose tasks were
+dropped (e.g. after a deploy changing its code) can be continued from the
+checkpoints with resume.
+"""
+
+
+import datetime
+import logging
+import time
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from protorpc import messages
+
+import jobs
+import models
+
+
+DEFAULT_SHARDS = 8
+# Number of __scatter__ samples taken per shard when splitting a kind.
+SAMPLES_PER_SHARD = 32
+
+RUNNING = 'running'
+DONE = 'done'
+
+_MIGRATIONS = {}
+
+
+class Migration(object):
+  """Base class for migrations.
+
+  Attributes:
+    name: String; unique name of the migration.
+    version: Integer; bumped whenever Transform changes in a way which means
+      already migrated entities need to be migrated again.
+    model_class: The ndb.Model subclass whose entities are migrated.
+    batch_size: Integer; number of entities fetched and written per task.
+    transactional: Boolean; whether each entity is read, transformed and
+      written in a transaction of its own. Only migrations which never
+      write the entity they are given (and run their own transactions in
+      Transform) turn this off.
+  """
+
+  name = None
+  version = 1
+  model_class = None
+  batch_size = 50
+  transactional = True
+
+  def Transform(self, entity):
+    """Migrates a single entity in place.
+
+    Must be idempotent; see the module docstring. Runs in a cross-group
+    transaction (unless transactional is off), so it may read one other
+    entity group, e.g. the contents of a photo in DatastoreStorage.
+
+    Args:
+      entity: An instance of model_class.
+
+    Returns:
+      Boolean; True if the entity changed and needs to be written.
+    """
+    raise NotImplementedError
+
+
+def register(migration_class):
+  """Class decorator registering a migration so it can be run.
+
+  Args:
+    migration_class: A Migration subclass.
+
+  Returns:
+    migration_class, unchanged.
+
+  Raises:
+    ValueError: if the migration has no name or model class or its name is
+      already registered for another class.
+  """
+  if not migration_class.name or migration_class.model_class is None:
+    raise ValueError('Migration %s needs a name and model class.' %
+                     (migration_class.__name__,))
+  existing = _MIGRATIONS.get(migration_class.name)
+  if existing is not None and existing is not migration_class:
+    raise ValueError('Migration name %r is already registered.' %
+                     (migration_class.name,))
+  _MIGRATIONS[migration_class.name] = migration_class
+  return migration_class
+
+
+def _GetMigration(name):
+  """Looks up a registered migration class by name.
+
+  Raises:
+    ValueError: if no migration is registered with the name.
+  """
+  migration_class = _MIGRATIONS.get(name)
+  if migration_class is None:
+    raise ValueError('Unknown migration %r.' % (name,))
+  return migration_class
+
+
+class MigrationState(ndb.Model):
+  """Overall progress of a migration; keyed by StateId.
+
+  Attributes:
+    name: String; the migration name.
+    version: Integer; the migration version.
+    status: String; RUNNING or DONE.
+    run: Integer; incremented each time the migration is resumed, so resumed
+      tasks don't collide with the names of earlier ones.
+    shard_count: Integer; number of MigrationShard children.
+    started: Date time the migration was started.
+    finished: Date time the last shard finished, if done.
+  """
+
+  name = ndb.StringProperty()
+  version = ndb.IntegerProperty()
+  status = ndb.StringProperty()
+  run = ndb.IntegerProperty(default=0, indexed=False)
+  shard_count = ndb.IntegerProperty(indexed=False)
+  started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+  finished = ndb.DateTimeProperty(indexed=False)
+
+  @staticmethod
+  def StateId(name, version):
+    """Creates the ID of the state for a migration name and version."""
+    return '%s-v%d' % (name, version)
+
+
+class MigrationShard(ndb.Model):
+  """Checkpoint of one key range of a migration; a child of MigrationState.
+
+  Attributes:
+    start_key: Key the range starts at (inclusive), or None for the start.
+    end_key: Key the range ends at (exclusive), or None for the end.
+    cursor: Urlsafe cursor string to continue the range from.
+    step: Integer; number of batches checkpointed so far.
+    processed: Integer; number of entities read so far.
+    modified: Integer; number of entities written so far.
+    seconds: Float; time spent in batches so far.
+    done: Boolean; whether the whole range has been migrated.
+  """
+
+  start_key = ndb.KeyProperty(indexed=False)
+  end_key = ndb.KeyProperty(indexed=False)
+  cursor = ndb.StringProperty(indexed=False)
+  step = ndb.IntegerProperty(default=0, indexed=False)
+  processed = ndb.IntegerProperty(default=0, indexed=False)
+  modified = ndb.IntegerProperty(default=0, indexed=False)
+  seconds = ndb.FloatProperty(default=0.0, indexed=False)
+  done = ndb.BooleanProperty(default=False, indexed=False)
+
+
+class MigrationBatch(messages.Message):
+  """Payload of MigrationBatchJob; one batch of one migration shard.
+
+  Attributes:
+    name: String; the migration name.
+    version: Integer; the migration version.
+    shard: Integer; the ID of the MigrationShard.
+    step: Integer; the shard step the batch continues from.
+    run: Integer; the MigrationState run the batch belongs to.
+  """
+
+  name = messages.StringField(1, required=True)
+  version = messages.IntegerField(2, required=True)
+  shard = messages.IntegerField(3, required=True)
+  step = messages.IntegerField(4, default=0)
+  run = messages.IntegerField(5, default=0)
+
+
+def _Enqueue(batches):
+  """Enqueues MigrationBatchJob tasks, named after their shard and step."""
+  for batch in batches:
+    idempotency_key = '%s-v%d-%d-%d-%d' % (batch.name, batch.version,
+                                           batch.run, batch.shard, batch.step)
+    jobs.enqueue(MigrationBatchJob, [batch], idempotency_key=idempotency_key)
+
+
+def _SplitKeys(model_class, shard_count):
+  """Chooses keys splitting a kind into ranges of similar size.
+
+  Uses the __scatter__ property, which the datastore sets on a random sample
+  of entities, as the mapreduce library does.
+
+  Args:
+    model_class: An ndb.Model subclass.
+    shard_count: Integer; the desired number of ranges.
+
+  Returns:
+    Sorted list of up to shard_count - 1 keys. Fewer are returned for kinds
+      too small to have enough scattered entities.
+  """
+  # Only needed here, so not imported when an instance starts.
+  from google.appengine.api import datastore
+
+  query = datastore.Query(model_class._get_kind(), keys_only=True)
+  query.Order('__scatter__')
+  sample = sorted(ndb.Key.from_old_key(key) for key in
+                  query.Get(shard_count * SAMPLES_PER_SHARD))
+  if len(sample) < shard_count:
+    return []
+
+  step = len(sample) / float(shard_count)
+  split_keys = []
+  for index in xrange(1, shard_count):
+    key = sample[int(index * step)]
+    if not split_keys or split_keys[-1] != key:
+      split_keys.append(key)
+  return split_keys
+
+
+def start(name, shard_count=DEFAULT_SHARDS):
+  """Starts the current version of a migration.
+
+  Args:
+    name: String; the migration name.
+    shard_count: Integer; the number of key ranges to split the kind into.
+
+  Returns:
+    The status of the migration; see status.
+
+  Raises:
+    ValueError: if the migration is unknown or has already been started.
+  """
+  migration_class = _GetMigration(name)
+  state_id = MigrationState.StateId(name, migration_class.version)
+  if MigrationState.get_by_id(state_id) is not None:
+    raise ValueError('Migration %s was already started; see resume.' %
+                     (state_id,))
+
+  split_keys = _SplitKeys(migration_class.model_class, shard_count)
+  boundaries = [None] + split_keys + [None]
+  state = MigrationState(id=state_id, name=name,
+                         version=migration_class.version, status=RUNNING,
+                         shard_count=len(boundaries) - 1)
+  shards = [MigrationShard(parent=state.key, id=index + 1,
+                           start_key=boundaries[index],
+                           end_key=boundaries[index + 1])
+            for index in xrange(len(boundaries) - 1)]
+  ndb.put_multi([state] + shards)
+
+  _Enqueue(MigrationBatch(name=name, version=migration_class.version,
+                          shard=shard.key.integer_id())
+           for shard in shards)
+  return status(name)
+
+
+def resume(name):
+  """Continues a started migration from its checkpoints.
+
+  Only needed if its tasks were dropped, e.g. after exhausting retries.
+
+  Args:
+    name: String; the migration name.
+
+  Returns:
+    The status of the migration; see status.
+
+  Raises:
+    ValueError: if the migration is unknown or hasn't been started.
+  """
+  migration_class = _GetMigration(name)
+  state_key = ndb.Key(MigrationState, MigrationState.StateId(
+      name, migration_class.version))
+
+  @ndb.transactional
+  def next_run():
+    state = state_key.get()
+    if state is None:
+      raise ValueError('Migration %s was not started.' % (state_key.id(),))
+    state.run += 1
+    state.put()
+    return state
+
+  state = next_run()
+  shards = MigrationShard.query(ancestor=state_key).fetch()
+  _Enqueue(MigrationBatch(name=name, version=state.version,
+                          shard=shard.key.integer_id(), step=shard.step,
+                          run=state.run)
+           for shard in shards if not shard.done)
+  return status(name)
+
+
+def status(name, version=None):
+  """Reports the progress and throughput of a migration.
+
+  Args:
+    name: String; the migration name.
+    version: Optional integer; defaults to the current version.
+
+  Returns:
+    Dictionary with the status, the counts of shards (done and total) and of
+      entities (processed and modified), the elapsed seconds and entities
+      processed per second, or None if the migration was not started.
+  """
+  if version is None:
+    version = _GetMigration(name).version
+  state = MigrationState.get_by_id(MigrationState.StateId(name, version))
+  if state is None:
+    return None
+
+  shards = MigrationShard.query(ancestor=state.key).fetch()
+  processed = sum(shard.processed for shard in shards)
+  end = state.finished or datetime.datetime.utcnow()
+  elapsed = max((end - state.started).total_seconds(), 0.001)
+  return {
+      'status': state.status,
+      'shards': len(shards),
+      'shardsDone': sum(1 for shard in shards if shard.done),
+      'processed': processed,
+      'modified': sum(shard.modified for shard in shards),
+      'elapsedSeconds': elapsed,
+      'perSecond': processed / elapsed,
+      # Throughput of the batches themselves, excluding time spent queued.
+      'perBatchSecond': processed / max(
+          sum(shard.seconds for shard in shards), 0.001),
+  }
+
+
+@jobs.register
+class MigrationBatchJob(jobs.Job):
+  """Job migrating one batch of a shard and enqueueing the next."""
+
+  name = 'migration-batch'
+  payload_class = MigrationBatch
+  queue_name = 'migrations'
+  retry_policy = jobs.RetryPolicy(max_attempts=10, min_backoff_seconds=5,
+                                  max_backoff_seconds=600)
+
+  def Run(self, payloads):
+    """Runs each batch.
+
+    Raises:
+      jobs.PermanentJobError: if the migration is no longer registered with
+        the version of the batch. This results in the task being dropped.
+    """
+    for batch in payloads:
+      migration_class = _MIGRATIONS.get(batch.name)
+      if migration_class is None or migration_class.version != batch.version:
+        raise jobs.PermanentJobError('Migration %s-v%d is not registered.' %
+                                     (batch.name, batch.version))
+      self._RunBatch(migration_class(), batch)
+
+  def _RunBatch(self, migration, batch):
+    """Migrates one page of a shard's key range and checkpoints it."""
+    state_key = ndb.Key(MigrationState,
+                        MigrationState.StateId(batch.name, batch.version))
+    shard_key = ndb.Key(MigrationShard, batch.shard, parent=state_key)
+    shard = shard_key.get()
+    if shard is None or shard.done or shard.step != batch.step:
+      logging.info('Skipping stale batch %r.', batch)
+      return
+
+    start = time.time()
+    model_class = migration.model_class
+    query = model_class.query()
+    if shard.start_key is not None:
+      query = query.filter(model_class._key >= shard.start_key)
+    if shard.end_key is not None:
+      query = query.filter(model_class._key < shard.end_key)
+    cursor = None
+    if shard.cursor is not None:
+      cursor = Cursor(urlsafe=shard.cursor)
+    keys, next_cursor, more = query.order(model_class._key).fetch_page(
+        migration.batch_size, start_cursor=cursor, keys_only=True)
+
+    modified = 0
+    for key in keys:
+      if migration.transactional:
+        changed = ndb.transaction(lambda: self._MigrateEntity(migration, key),
+                                  xg=True)
+      else:
+        changed = self._MigrateEntity(migration, key)
+      if changed:
+        modified += 1
+    seconds = time.time() - start
+
+    @ndb.transactional
+    def checkpoint():
+      current = shard_key.get()
+      if current.step != batch.step:
+        return None  # Another run of the same batch got here first.
+      current.step += 1
+      current.processed += len(keys)
+      current.modified += modified
+      current.seconds += seconds
+      current.cursor = next_cursor.urlsafe() if next_cursor else None
+      current.done = not more
+      current.put()
+
+      if current.done:
+        remaining = [other for other in
+                     MigrationShard.query(ancestor=state_key).fetch()
+                     if not other.done and other.key != shard_key]
+        if not remaining:
+          state = state_key.get()
+          state.status = DONE
+          state.finished = datetime.datetime.utcnow()
+          state.put()
+      return current
+
+    current = checkpoint()
+    if current is None:
+      return
+    logging.info('Migration %s shard %d: %d processed, %d modified, '
+                 '%.1f entities/s in batch.', state_key.id(), batch.shard,
+                 current.processed, current.modified,
+                 len(keys) / max(seconds, 0.001))
+    if more:
+      _Enqueue([MigrationBatch(name=batch.name, version=batch.version,
+                               shard=batch.shard, step=current.step,
+                               run=batch.run)])
+
+  @staticmethod
+  def _MigrateEntity(migration, key):
+    """Gets, transforms and (if it changed) puts a single entity.
+
+    Returns:
+      Boolean; True if the entity was written.
+    """
+    entity = key.get()
+    if entity is None:  # Deleted since the page was fetched.
+      return False
+    if not migration.Transform(entity):
+      return False
+    entity.put()
+    return True
+
+
+@register
+class ReindexPhotos(Migration):
+  """Rewrites every photo, so that its indexes match the current model.
+
+  Needed whenever indexing changes: a property becoming indexed or not, or
+  the parsing behind a computed property such as tags changing.
+
+  Photos keep their 'updated' stamp, since otherwise every client syncing
+  with lastUpdated would download every photo (with its contents) again. If
+  the rewrite changes what clients see, e.g. the tags parsed from
+  descriptions, set KEEP_UPDATED to False (and bump version) before running
+  it, so clients pick up the change.
+  """
+
+  name = 'reindex-photos'
+  version = 1
+  model_class = models.Photo
+  KEEP_UPDATED = True
+
+  def Transform(self, photo):
+    """Marks every photo as changed."""
+    photo._keep_updated = self.KEEP_UPDATED
+    return True
+
+
+@register
+class ExtractPhotoMetadata(Migration):
+  """Backfills the capture date, dimensions and orientation of photos.
+
+  Photos stored before these were extracted on write have none. Only photos
+  whose metadata changes are written, so running this again (e.g. after the
+  parsing in image_metadata.py improves) is cheap for the rest. Unlike with
+  ReindexPhotos, a photo which is written gets a new 'updated' stamp, so
+  clients syncing with lastUpdated pick up its metadata.
+  """
+
+  name = 'photo-metadata'
+  version = 1
+  model_class = models.Photo
+
+  def Transform(self, photo):
+    """Extracts the metadata of a photo from its contents."""
+    models.Photo.LoadContents([photo])
+    return photo.ExtractMetadata()
+
+
+@register
+class ComputePhotoHashes(Migration):
+  """Backfills the perceptual hashes of photos.
+
+  Photos stored before hashes were computed on write have none, so
+  photo.similar and duplicate searches can't find them. As with
+  ExtractPhotoMetadata, only photos whose hash changes are written.
+  """
+
+  name = 'photo-hash'
+  version = 1
+  model_class = models.Photo
+  # Each photo is shrunk with an Images API call.
+  batch_size = 20
+
+  def Transform(self, photo):
+    """Computes the perceptual hash of a photo from its contents."""
+    models.Photo.LoadContents([photo])
+    return photo.ComputePerceptualHash()
+
+
+@register
+class ParentPhotos(Migration):
+  """Moves every photo under its owner's PicturesqueUser.
+
+  Needed before setting Photo.OWNER_ANCESTOR_QUERIES, once
+  Photo.PARENT_UNDER_OWNER is set so that new photos get a parent. Photos
+  have no indexed link to their owner's Google+ ID, so this walks the
+  PicturesqueUser entities and moves the root photos of each (found by
+  'owner') in cross-group transactions of photos_per_transaction photos,
+  which copy them under new IDs allocated in the owner's group and delete the
+  originals.
+
+  A photo's key (and its 'updated' stamp) changes when it is moved, so
+  clients syncing with lastUpdated get it under the new key. Already moved
+  photos are skipped, so running this again only moves photos created
+  without a parent in the meantime. The users themselves are not written, so
+  the status reports none as modified, and Transform isn't run in a
+  transaction of the batch, since it runs its own.
+  """
+
+  name = 'parent-photos'
+  version = 1
+  model_class = models.PicturesqueUser
+  batch_size = 5
+  transactional = False
+  # With the owner's group, a transaction stays within the limit of 25
+  # entity groups. Photos with inline contents move them to the storage
+  # backend (if one is set) when they are put, but backends store contents
+  # outside of the transaction (see photo_storage.py), so PhotoContent
+  # entities don't count towards the limit.
+  photos_per_transaction = 20
+
+  def Transform(self, picturesque_user):
+    """Moves the root photos of a user; see the class docstring."""
+    if picturesque_user.user_object is None:
+      return False  # A partial account owns no photos.
+
+    parent = picturesque_user.key
+    query = models.Photo.query(
+        models.Photo.owner == picturesque_user.user_object)
+    cursor = None
+    more = True
+    moved = 0
+    while more:
+      keys, cursor, more = query.fetch_page(
+          self.photos_per_transaction, start_cursor=cursor, keys_only=True)
+      root_keys = [key for key in keys if key.parent() is None]
+      if root_keys:
+        # Allocated outside of the transaction; IDs left unused by a retry
+        # or a photo deleted meanwhile are just skipped.
+        first_id, _ = models.Photo.allocate_ids(size=len(root_keys),
+                                                parent=parent)
+        moved += ndb.transaction(
+            lambda: self._MovePhotos(root_keys, parent, first_id), xg=True)
+
+    if moved:
+      logging.info('Moved %d photos under %s.', moved, parent)
+    return False
+
+  @staticmethod
+  def _MovePhotos(keys, parent, first_id):
+    """Moves root photos under a parent; run in a transaction.
+
+    Args:
+      keys: List of keys of root photos.
+      parent: Key of the owner's PicturesqueUser.
+      first_id: Integer; the first of len(keys) IDs allocated under parent.
+
+    Returns:
+      Integer; the number of photos moved.
+    """
+    photos = [photo for photo in ndb.get_multi(keys) if photo is not None]
+    if not photos:
+      return 0
+
+    old_keys = []
+    for offset, photo in enumerate(photos):
+      old_keys.append(photo._key)
+      photo._key = ndb.Key(models.Photo, first_id + offset, parent=parent)
+    ndb.put_multi(photos)
+    ndb.delete_multi(old_keys)
+    return len(photos)
@@ -3,21 +3,31 @@
 """Module containing model definitions for API data."""
 
 
+import collections
 import datetime
+import random
 import re
+import uuid
 
 from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import endpoints
 from google.appengine.ext import ndb
+from protorpc import message_types
 from protorpc import messages
 
 from endpoints_proto_datastore.ndb import EndpointsAliasProperty
 from endpoints_proto_datastore.ndb import EndpointsComputedProperty
 from endpoints_proto_datastore.ndb import EndpointsModel
+from endpoints_proto_datastore.ndb.model import ToValue
 from endpoints_proto_datastore import MessageFieldsSchema
 from endpoints_proto_datastore import utils
 
 import auth_util
+import image_hash
+import image_metadata
+import jobs
+import photo_storage
 
 
 TAG_REGEX = re.compile('^#(?P<tag>([a-zA-Z0-9_]+))$')
@@ -42,6 +52,10 @@ class PicturesqueUser(EndpointsModel):
   INVALID_TOKEN = 'Invalid token.'
   NO_ACCOUNT = 'You don\'t have a Picturesque account.'
   NO_GPLUS_ID = 'Insufficient Permission.'
+  # Number of query results checked by _StillShared.
+  STILL_SHARED_CHECK_LIMIT = 10
+  # Delay before RemoveFromInList is checked again; see RecheckInList.
+  IN_LIST_RECHECK_SECONDS = 60
 
   user_object = ndb.UserProperty('userObject', indexed=False)
   in_users_acl_list = ndb.StringProperty('inUsersAclList',
@@ -126,7 +140,9 @@ class PicturesqueUser(EndpointsModel):
     if the current user is the owner of the passed in photo entity.
 
     Args:
-      photo_entity: A Photo entity parsed from a request.
+      photo_entity: A Photo (or ShareGroup) entity parsed from a request. The
+        error messages used are the NOT_FOUND_ERROR and FORBIDDEN_ERROR of its
+        class.
 
     Returns:
       The PicturesqueUser entity corresponding to the token user from the
@@ -139,12 +155,12 @@ class PicturesqueUser(EndpointsModel):
         results in a 403 response.
     """
     if not photo_entity.from_datastore:
-      raise endpoints.NotFoundException(Photo.NOT_FOUND_ERROR)
+      raise endpoints.NotFoundException(photo_entity.NOT_FOUND_ERROR)
 
     current_picturesque_user = cls.RequirePicturesqueUser()
 
     if photo_entity.owner != current_picturesque_user.user_object:
-      raise endpoints.ForbiddenException(Photo.FORBIDDEN_ERROR)
+      raise endpoints.ForbiddenException(photo_entity.FORBIDDEN_ERROR)
 
     return current_picturesque_user
 
@@ -196,8 +212,138 @@ class PicturesqueUser(EndpointsModel):
       shared_with_user.in_users_acl_list.append(sharing_user_id)
       shared_with_user.put()
 
+  @classmethod
+  def _StillShared(cls, shared_with_user_id, sharing_user_object):
+    """Determines whether a user still shares anything with another.
+
+    The checks are (global, so eventually consistent) queries. Right after an
+    ACL change, the index may still list photos or groups which no longer
+    have the shared-with user, so the entities found are fetched (which is
+    strongly consistent) and checked. Entities which gained the user but are
+    not yet in the index are missed; RecheckInList covers those.
+
+    Args:
+      shared_with_user_id: String; the Google+ ID of a user.
+      sharing_user_object: The App Engine User who may be sharing.
+
+    Returns:
+      Boolean; True if one of the sharing user's photos has the shared-with
+        user in its ACL, or one of their share groups has them as a member.
+    """
+    photo_keys = Photo.query(Photo.owner == sharing_user_object,
+                             Photo.acl == shared_with_user_id).fetch(
+                                 cls.STILL_SHARED_CHECK_LIMIT, keys_only=True)
+    group_keys = ShareGroup.query(
+        ShareGroup.owner == sharing_user_object,
+        ShareGroup.member_ids == shared_with_user_id).fetch(
+            cls.STILL_SHARED_CHECK_LIMIT, keys_only=True)
+    for entity in ndb.get_multi(photo_keys + group_keys):
+      if isinstance(entity, Photo) and shared_with_user_id in entity.acl:
+        return True
+      if (isinstance(entity, ShareGroup) and
+          shared_with_user_id in entity.member_ids):
+        return True
+    return False
+
+  @classmethod
+  def RemoveFromInList(cls, shared_with_user_id, sharing_user_id,
+                       sharing_user_object):
+    """Stops tracking the sharing user in an ACL list for a shared-with user.
+
+    This is the inverse of UpdateInList, used after the shared-with user has
+    been removed from one or more photo ACLs or share groups. The sharing user
+    is only removed from the list if none of their photos still have the
+    shared-with user in the ACL and none of their share groups still have them
+    as a member. Since those checks are (global) queries, they are made
+    outside of the transaction; a photo shared (and tracked by UpdateInList)
+    between the check and the transaction, or missing from the index, is
+    caught by RecheckInList, which the caller must enqueue (with a countdown
+    of IN_LIST_RECHECK_SECONDS) when this returns True.
+
+    Args:
+      shared_with_user_id: String; the Google+ ID of a user removed from a
+        photo ACL.
+      sharing_user_id: String; the Google+ ID of the user who owns the photo.
+      sharing_user_object: The App Engine User who owns the photo.
+
+    Returns:
+      Boolean; True if the sharing user was removed from the list.
+    """
+    if cls._StillShared(shared_with_user_id, sharing_user_object):
+      return False
+    return cls._RemoveFromInList(shared_with_user_id, sharing_user_id)
+
+  @classmethod
+  def RecheckInList(cls, shared_with_user_id, sharing_user_id,
+                    sharing_user_object):
+    """Tracks the sharing user again if RemoveFromInList was wrong to remove.
+
+    Run once the index has caught up with the ACL changes made around the
+    removal; if the sharing user does share with the shared-with user after
+    all, this is the same as UpdateInList.
+
+    Args:
+      shared_with_user_id: String; the Google+ ID of a user.
+      sharing_user_id: String; the Google+ ID of the user who owns the photo.
+      sharing_user_object: The App Engine User who owns the photo.
+    """
+    if cls._StillShared(shared_with_user_id, sharing_user_object):
+      cls.UpdateInList(shared_with_user_id, sharing_user_id)
+
   @classmethod
   @ndb.transactional
+  def _RemoveFromInList(cls, shared_with_user_id, sharing_user_id):
+    """Transactionally removes the sharing user from the ACL list.
+
+    Returns:
+      Boolean; True if the sharing user was in the list.
+    """
+    shared_with_user = cls.get_by_id(shared_with_user_id)
+    if (shared_with_user is not None and
+        sharing_user_id in shared_with_user.in_users_acl_list):
+      shared_with_user.in_users_acl_list.remove(sharing_user_id)
+      shared_with_user.put()
+      return True
+    return False
+
+  @classmethod
+  def EnqueueInListUpdates(cls, added_ids, removed_ids, sharing_user_id,
+                           idempotency_key=None, transactional=False):
+    """Enqueues InListUpdateJob tasks for users shared with or unshared.
+
+    Args:
+      added_ids: Iterable of Google+ IDs of users the owner started sharing
+        with; see UpdateInList.
+      removed_ids: Iterable of Google+ IDs of users the owner may have stopped
+        sharing with; see RemoveFromInList.
+      sharing_user_id: String; the Google+ ID of the sharing user.
+      idempotency_key: Optional string; passed to jobs.enqueue.
+      transactional: Boolean; passed to jobs.enqueue. Only
+        jobs.MAX_TRANSACTIONAL_TASKS tasks of InListUpdateJob.batch_size IDs
+        can be added transactionally; for more IDs, a single InListFanOutJob
+        task is added instead, which enqueues the updates when it runs.
+    """
+    added_ids = sorted(added_ids)
+    removed_ids = sorted(removed_ids)
+    if transactional and (
+        len(added_ids) + len(removed_ids) >
+        jobs.MAX_TRANSACTIONAL_TASKS * InListUpdateJob.batch_size):
+      fan_out = InListFanOut(fanOutId=uuid.uuid4().hex,
+                             sharingUserId=sharing_user_id,
+                             addedIds=added_ids, removedIds=removed_ids)
+      jobs.enqueue(InListFanOutJob, [fan_out], transactional=True)
+      return
+
+    payloads = [InListUpdate(sharedWithUserId=added_id,
+                             sharingUserId=sharing_user_id, added=True)
+                for added_id in added_ids]
+    payloads.extend(InListUpdate(sharedWithUserId=removed_id,
+                                 sharingUserId=sharing_user_id, added=False)
+                    for removed_id in removed_ids)
+    jobs.enqueue(InListUpdateJob, payloads, idempotency_key=idempotency_key,
+                 transactional=transactional)
+
+  @classmethod
   def GetOrCreateAccount(cls, current_user, googleplus_user_id):
     """Gets or creates a Picturesque user account for current user.
 
@@ -206,6 +352,12 @@ class PicturesqueUser(EndpointsModel):
     Picturesque user. This is because we allow partial accounts to be created by
     UpdateInList for ACL purposes.
 
+    Since clients sign up on every start, the account is first looked up
+    outside of a transaction, where ndb can serve it from memcache. An
+    account's user object only ever changes from None to a user, so a
+    complete account found this way can be used (or rejected) as is; only
+    new and partial accounts need the transaction.
+
     Args:
       current_user: The current user in the environment, validated from the
         caller.
@@ -221,6 +373,18 @@ class PicturesqueUser(EndpointsModel):
         user. This results in a 403 response.
     """
     existing_user = cls.get_by_id(googleplus_user_id)
+    if existing_user is not None and existing_user.user_object is not None:
+      if existing_user.user_object != current_user:
+        raise endpoints.ForbiddenException(cls.BAD_USER)
+      return existing_user
+
+    return cls._GetOrCreateAccount(current_user, googleplus_user_id)
+
+  @classmethod
+  @ndb.transactional
+  def _GetOrCreateAccount(cls, current_user, googleplus_user_id):
+    """Transactionally gets, completes or creates an account; see above."""
+    existing_user = cls.get_by_id(googleplus_user_id)
     if existing_user is not None:
       if existing_user.user_object is None:
         # This is to support users who had their G+ ID added to an ACL before
@@ -244,30 +408,60 @@ class Photo(EndpointsModel):
     _message_fields_schema: List of fields which appear in API requests.
     title: String; title for photo.
     description: String; long description of what is in photo.
-    base64_photo: String; contents of photo from a base64 data url.
+    base64_photo: String; contents of photo from a base64 data url. If a
+      storage backend is set (see photo_storage.py), the contents are kept
+      there instead and only loaded by LoadContents.
+    content_key: String; key of the contents in the storage backend, if they
+      are stored there.
+    content_size: Integer size of the contents in bytes, so that usage can be
+      counted without loading them.
     mime_type: String; MIME type of photo.
     updated: Date time corresponding to last update of stored photo.
+    taken_at: Date time the photo was captured (in the camera's local time),
+      from its EXIF data, if any.
+    width: Integer width of the photo in pixels, if known.
+    height: Integer height of the photo in pixels, if known.
+    orientation: Integer EXIF orientation of the photo, if any. For values
+      5-8, the photo is displayed rotated and width and height are swapped.
+    perceptual_hash: String; the difference hash of the photo (see
+      image_hash.py), if its contents could be read.
     owner: App Engine User Property corresponding to the owner of the Photo.
     acl: List of Google+ User IDs (as strings) that the owner has shared the
-      photo with.
+      photo with, and ACL entries (see ShareGroup.acl_entry) of share groups
+      the photo is shared with.
     tags: List of strings, parsed hashtags from description.
+    hash_segments: List of strings indexing the perceptual hash, so photos
+      with a similar hash can be found; see FindSimilarAsync.
     key: String version of the integer ID automatically allocated from the
       datastore. We use a string since Python long() values can exceed 2**53,
-      which is the maximum precision for JavaScript integers.
+      which is the maximum precision for JavaScript integers. For photos
+      stored as children of their owner's PicturesqueUser (see
+      PARENT_UNDER_OWNER), the ID is prefixed by the owner's Google+ ID and
+      KEY_SEPARATOR.
     last_updated: String containing a timestamp. This is used as a helper
       property for queries to allow getting entities after a certain time.
-    acl_user_ids: List of string Google+ IDs of user IDs to be added to an ACL.
-      This is not stored anywhere and is only meant for the request.
+    acl_user_ids: List of string Google+ IDs of user IDs (or share group ACL
+      entries) to be added to an ACL. This is not stored anywhere and is only
+      meant for the request.
     is_mine: Boolean representing whether the entity is owned by the current
       user. This is for entities owned by someone else with the current user in
       the ACL.
     owner_googleplus_user_id: String containing a Google+ ID. This is used as a
       helper property for queries to allow searching for all photos owned by
       a user which have the current user in an ACL.
+    order_by: String; name of the property ('updated' or 'takenAt') photo.list
+      results are sorted by. This is only meant for the request.
+    taken_after: String containing a timestamp. This is used as a helper
+      property for queries to allow getting photos captured at or after a
+      certain time.
+    taken_before: String containing a timestamp. This is used as a helper
+      property for queries to allow getting photos captured before a certain
+      time.
 
     NewPhotoSchema: The schema (for the Discovery Document) used for new photos.
     AddAclSchema: The schema to be used for add ACL requests. Though the number
       of fields is small, having a distinct name is more relevant for discovery.
+    RemoveAclSchema: The schema to be used for remove ACL requests.
     AclResponseSchema: The schema to be used for ACL responses. Though the
       number of fields is small, having a distinct name is more relevant for
       discovery.
@@ -275,12 +469,49 @@ class Photo(EndpointsModel):
       MessageFieldsSchema is not needed since queries only use parameters.
   """
 
+  ACL_IDS_NEEDED = 'ACL user IDs required.'
+  BATCH_TOO_LARGE = 'Too many operations in batch.'
+  DISTANCE_INVALID = 'maxDistance must be between 0 and %d.' % (
+      image_hash.MAX_DISTANCE,)
   FORBIDDEN_ERROR = 'You do not have access to this photo.'
-  KEY_WRONG_FORMAT = 'Key must be a string value of integer.'
+  KEY_WRONG_FORMAT = ('Key must be a string value of integer, optionally '
+                      'prefixed by the owner\'s Google+ ID and \'-\'.')
+  LIST_ORDER_CONFLICT = ('Can\'t combine lastUpdated with takenAt order or '
+                         'filters.')
   MIME_TYPE_NEEDED = 'Photo MIME type must be described.'
   NOT_FOUND_ERROR = 'Photo not found.'
   PHOTO_NEEDED = 'Base64 Photo contents required.'
   TITLE_NEEDED = 'Photo must have a title.'
+  TOO_MANY_ACL_IDS = 'Too many ACL user IDs.'
+
+  MAX_BATCH_SIZE = 10
+  # Maximum number of aclUserIds per request; keeps the InListFanOutJob task
+  # for the request well below the task size limit.
+  MAX_ACL_USER_IDS = 1000
+  # Number of photos updated per task by bulk ACL updates.
+  ACL_JOB_BATCH_SIZE = 20
+  # Whether photo.list responses are built with PhotoMessageSerializer.
+  FAST_LIST_SERIALIZATION = True
+  # Whether new photos are stored as children of their owner's
+  # PicturesqueUser, so an owner's photos are one entity group.
+  PARENT_UNDER_OWNER = False
+  # Whether photo.list finds an owner's photos with an ancestor query rather
+  # than an 'owner' filter. Only to be set once every photo has a parent,
+  # i.e. after running the 'parent-photos' migration (see migrations.py).
+  OWNER_ANCESTOR_QUERIES = False
+  # Separates the owner's Google+ ID from the ID in keys of child photos.
+  KEY_SEPARATOR = '-'
+  # Default Hamming distances between perceptual hashes for photo.similar and
+  # duplicate searches; at most image_hash.MAX_DISTANCE.
+  SIMILAR_DISTANCE = 6
+  DUPLICATE_DISTANCE = 3
+  MAX_SIMILAR_RESULTS = 50
+  # Photos fetched per page of a probe query, and probe queries run at once,
+  # by FindSimilarAsync.
+  PROBE_PAGE_SIZE = 500
+  MAX_CONCURRENT_PROBES = 20
+  # Number of photos searched per task by duplicate searches.
+  DUPLICATE_JOB_BATCH_SIZE = 50
 
   # Non-default schemas
   NewPhotoSchema = MessageFieldsSchema(
@@ -289,26 +520,40 @@ class Photo(EndpointsModel):
       ('key', 'title', 'description'), name='PhotoPatch')
   AddAclSchema = MessageFieldsSchema(
       ('key', 'aclUserIds'), name='NewAcl')
+  RemoveAclSchema = MessageFieldsSchema(
+      ('key', 'aclUserIds'), name='RemoveAcl')
   AclSchema = MessageFieldsSchema(
       ('key', 'acl'), name='Acl')
   QueryFields = (  # Don't need a schema since GET doesn't use schema
     'lastUpdated',
     'limit',
+    'orderBy',
     'ownerGoogleplusUserId',
     'pageToken',
     'tags',
+    'takenAfter',
+    'takenBefore',
     'title',
   )
 
   # Default schema
   _message_fields_schema = ('key', 'title', 'description', 'base64Photo',
-                            'mimeType', 'updated', 'tags', 'isMine')
+                            'mimeType', 'updated', 'takenAt', 'width',
+                            'height', 'orientation', 'tags', 'isMine')
 
   title = ndb.StringProperty()
   description = ndb.StringProperty(indexed=False)
   base64_photo = ndb.BlobProperty('base64Photo', indexed=False)
+  content_key = ndb.StringProperty('contentKey', indexed=False)
+  content_size = ndb.IntegerProperty('contentSize', indexed=False)
   mime_type = ndb.StringProperty('mimeType', indexed=False)
   updated = ndb.DateTimeProperty(auto_now=True)
+  taken_at = ndb.DateTimeProperty('takenAt')
+  width = ndb.IntegerProperty(indexed=False)
+  height = ndb.IntegerProperty(indexed=False)
+  orientation = ndb.IntegerProperty(indexed=False)
+  # Indexed so that similar photos can be checked with projection queries.
+  perceptual_hash = ndb.StringProperty('perceptualHash')
   owner = ndb.UserProperty(required=True)
   acl = ndb.StringProperty(repeated=True)
 
@@ -325,6 +570,77 @@ class Photo(EndpointsModel):
         tags.append(match.group('tag'))
     return tags
 
+  @EndpointsComputedProperty(name='hashSegments', repeated=True)
+  def hash_segments(self):
+    """Computed property with the segment keys of the perceptual hash."""
+    return image_hash.segment_keys(self.perceptual_hash)
+
+  @classmethod
+  def KeyFromString(cls, value):
+    """Parses the string form of a photo key; the inverse of 'key'.
+
+    Args:
+      value: String; an integer ID, optionally prefixed by the owner's Google+
+        ID and KEY_SEPARATOR.
+
+    Returns:
+      The ndb.Key of the photo, a child of the owner's PicturesqueUser if the
+        value has a prefix.
+
+    Raises:
+      endpoints.BadRequestException: if the value is not in one of the above
+        forms. This results in a 400 response.
+    """
+    try:
+      parent_id, separator, photo_id = value.rpartition(cls.KEY_SEPARATOR)
+      photo_id = long(photo_id)
+    except (AttributeError, TypeError, ValueError):
+      raise endpoints.BadRequestException(cls.KEY_WRONG_FORMAT)
+
+    if not separator:
+      return ndb.Key(cls, photo_id)
+    if not parent_id:
+      raise endpoints.BadRequestException(cls.KEY_WRONG_FORMAT)
+    return ndb.Key(PicturesqueUser, parent_id, cls, photo_id)
+
+  @classmethod
+  def KeyToString(cls, key):
+    """Formats a complete photo key as in 'key'."""
+    parent = key.parent()
+    if parent is None:
+      return str(key.integer_id())
+    return '%s%s%d' % (parent.string_id(), cls.KEY_SEPARATOR,
+                       key.integer_id())
+
+  @classmethod
+  def OwnerParent(cls, googleplus_user_id):
+    """Gets the parent key for new photos of an owner.
+
+    Args:
+      googleplus_user_id: String; the Google+ ID of the owner.
+
+    Returns:
+      The key of the owner's PicturesqueUser if PARENT_UNDER_OWNER is set,
+        else None.
+    """
+    if cls.PARENT_UNDER_OWNER:
+      return ndb.Key(PicturesqueUser, googleplus_user_id)
+
+  @classmethod
+  def OwnerQuery(cls, picturesque_user):
+    """Creates a query for the photos of an owner.
+
+    Args:
+      picturesque_user: The PicturesqueUser who owns the photos.
+
+    Returns:
+      An ndb.Query with the owner's PicturesqueUser as ancestor if
+        OWNER_ANCESTOR_QUERIES is set, else with an 'owner' filter.
+    """
+    if cls.OWNER_ANCESTOR_QUERIES:
+      return cls.query(ancestor=picturesque_user.key)
+    return cls.query(cls.owner == picturesque_user.user_object)
+
   def KeySet(self, value):
     """Setter for 'key' property.
 
@@ -332,28 +648,24 @@ class Photo(EndpointsModel):
     values from the datastore if an entity is stored there using the key.
 
     Args:
-      value: String (of integer value), the value attempting to be set.
+      value: String (see KeyFromString), the value attempting to be set.
 
     Raises:
-      endpoints.BadRequestException: if the value was not able to be cast into
-        a long. This results in a 400 response.
+      endpoints.BadRequestException: if the value is not a valid key string.
+        This results in a 400 response.
     """
-    try:
-      value = long(value)
-    except (TypeError, ValueError):
-      raise endpoints.BadRequestException(Photo.KEY_WRONG_FORMAT)
-
-    self.UpdateFromKey(ndb.Key(Photo, value))
+    self.UpdateFromKey(Photo.KeyFromString(value))
 
   @EndpointsAliasProperty(setter=KeySet)
   def key(self):
     """The key of the Photo.
 
     Returns:
-      Integer ID as a string if there is a key and the key has an integer ID.
+      Integer ID as a string if there is a key and the key has an integer ID,
+        prefixed by the owner's Google+ ID if the photo has a parent.
     """
     if self._key is not None and self._key.integer_id() is not None:
-      return str(self._key.integer_id())
+      return self.KeyToString(self._key)
 
   def LastUpdatedSet(self, value):
     """Setter for 'lastUpdated' property.
@@ -376,6 +688,7 @@ class Photo(EndpointsModel):
     except TypeError:
       raise endpoints.BadRequestException('Invalid timestamp for lastUpdated.')
 
+    self._RequireListOrder(Photo.updated)
     self._endpoints_query_info._filters.add(Photo.updated >= last_updated)
 
   @EndpointsAliasProperty(name='lastUpdated', setter=LastUpdatedSet)
@@ -391,21 +704,151 @@ class Photo(EndpointsModel):
     raise endpoints.BadRequestException(
         'lastUpdated value should never be accessed.')
 
+  _list_order = None
+
+  def _RequireListOrder(self, prop):
+    """Sets the property the photo.list query is sorted by.
+
+    A query with an inequality filter on a property must be sorted by that
+    property first, so the setters of 'orderBy' and the timestamp filters all
+    go through here to make sure they agree.
+
+    Args:
+      prop: Photo.updated or Photo.taken_at.
+
+    Raises:
+      endpoints.BadRequestException: if the query is already sorted by the
+        other property. This results in a 400 response.
+    """
+    if self._list_order is not None and self._list_order is not prop:
+      raise endpoints.BadRequestException(self.LIST_ORDER_CONFLICT)
+    self._list_order = prop
+    self._endpoints_query_info._order_attrs = (prop,)
+
+  def OrderBySet(self, value):
+    """Setter for 'orderBy' property.
+
+    Args:
+      value: String; 'updated' (the default) or 'takenAt'.
+
+    Raises:
+      endpoints.BadRequestException: if the value is not one of the above or
+        conflicts with the filters. This results in a 400 response.
+    """
+    if value == 'updated':
+      self._RequireListOrder(Photo.updated)
+    elif value == 'takenAt':
+      self._RequireListOrder(Photo.taken_at)
+    else:
+      raise endpoints.BadRequestException(
+          'orderBy must be \'updated\' or \'takenAt\'.')
+
+  @EndpointsAliasProperty(name='orderBy', setter=OrderBySet)
+  def order_by(self):
+    """Getter for 'orderBy' property.
+
+    This is not meant to be accessed so will always fail. The setter is in place
+    to set the query info.
+
+    Raises:
+      endpoints.BadRequestException: Always. This results in a 400 response.
+    """
+    raise endpoints.BadRequestException(
+        'orderBy value should never be accessed.')
+
+  def _TakenAtFilter(self, value, name):
+    """Parses a timestamp filter on 'takenAt' and sorts the query by it.
+
+    Args:
+      value: String (of timestamp), the value attempting to be set.
+      name: String; name of the query field, for errors.
+
+    Returns:
+      The parsed datetime.
+
+    Raises:
+      endpoints.BadRequestException: if the value was not able to be cast into
+        a datetime stamp or the query is sorted by 'updated'. This results in
+        a 400 response.
+    """
+    try:
+      taken_at = utils.DatetimeValueFromString(value)
+      if not isinstance(taken_at, datetime.datetime):
+        raise TypeError('Not a datetime stamp.')
+    except TypeError:
+      raise endpoints.BadRequestException('Invalid timestamp for %s.' % (name,))
+
+    self._RequireListOrder(Photo.taken_at)
+    return taken_at
+
+  def TakenAfterSet(self, value):
+    """Setter for 'takenAfter' property.
+
+    Updates the query info of the current entity with a query for photos
+    captured **AT OR AFTER** the parsed timestamp, sorted by capture time.
+
+    Args:
+      value: String (of timestamp), the value attempting to be set.
+    """
+    taken_after = self._TakenAtFilter(value, 'takenAfter')
+    self._endpoints_query_info._filters.add(Photo.taken_at >= taken_after)
+
+  @EndpointsAliasProperty(name='takenAfter', setter=TakenAfterSet)
+  def taken_after(self):
+    """Getter for 'takenAfter' property.
+
+    This is not meant to be accessed so will always fail. The setter is in place
+    to set the query info.
+
+    Raises:
+      endpoints.BadRequestException: Always. This results in a 400 response.
+    """
+    raise endpoints.BadRequestException(
+        'takenAfter value should never be accessed.')
+
+  def TakenBeforeSet(self, value):
+    """Setter for 'takenBefore' property.
+
+    Updates the query info of the current entity with a query for photos
+    captured **BEFORE** the parsed timestamp, sorted by capture time. Photos
+    without a capture date store None, which sorts before any timestamp, so
+    they are filtered out explicitly.
+
+    Args:
+      value: String (of timestamp), the value attempting to be set.
+    """
+    taken_before = self._TakenAtFilter(value, 'takenBefore')
+    self._endpoints_query_info._filters.add(Photo.taken_at < taken_before)
+    self._endpoints_query_info._filters.add(Photo.taken_at > None)
+
+  @EndpointsAliasProperty(name='takenBefore', setter=TakenBeforeSet)
+  def taken_before(self):
+    """Getter for 'takenBefore' property.
+
+    This is not meant to be accessed so will always fail. The setter is in place
+    to set the query info.
+
+    Raises:
+      endpoints.BadRequestException: Always. This results in a 400 response.
+    """
+    raise endpoints.BadRequestException(
+        'takenBefore value should never be accessed.')
+
   _acl_user_ids = None
 
   def SetAclUserIds(self, value):
     """Setter for 'aclUserIds' property.
 
-    This checks that the value is a list and all the values are non-empty
-    strings.
+    This checks that the value is a list of at most MAX_ACL_USER_IDS
+    non-empty strings.
 
     Args:
       value: List of Google+ IDs as strings.
 
     Raises:
-      endpoints.BadRequestException: If the value is not a list or one of the
-        values in the list is not a non-empty string. This results in a
-        400 response.
+      endpoints.BadRequestException: If the value is not a list, has too many
+        values or one of the values in the list is not a non-empty string.
+        This results in a 400 response.
     """
     valid_input = True
     if not isinstance(value, list):
@@ -419,6 +862,8 @@ class Photo(EndpointsModel):
     if not valid_input:
       raise endpoints.BadRequestException(
           'ACL user IDs must be non-empty strings.')
+    if len(value) > self.MAX_ACL_USER_IDS:
+      raise endpoints.BadRequestException(self.TOO_MANY_ACL_IDS)
 
     self._acl_user_ids = value
 
@@ -469,6 +914,14 @@ class Photo(EndpointsModel):
     user which the current user in an ACL by adding query filters on the 'owner'
     and 'acl' properties.
 
+    If the current user is a member of any of the owner's share groups, the
+    'acl' filter also matches photos shared with one of those groups. This is
+    an IN filter, which can't be added through the query info's _AddFilter.
+
+    If OWNER_ANCESTOR_QUERIES is set, the owner's PicturesqueUser is used as
+    the query ancestor instead of filtering on 'owner', so the results are
+    strongly consistent and the indexes needed don't include 'owner'.
+
     Args:
       value: Google+ ID as string, the value attempting to be set.
 
@@ -479,18 +932,27 @@ class Photo(EndpointsModel):
     current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
 
     if value == OWNER_GOOGLEPLUS_USER_ID_DEFAULT:
-      owner_filter = (Photo.owner == current_picturesque_user.user_object)
+      owner_picturesque_user = current_picturesque_user
     else:
-      acl_filter = (Photo.acl == current_picturesque_user.googleplus_user_id)
-      self._endpoints_query_info._AddFilter(acl_filter)
-
       owner_picturesque_user = PicturesqueUser.ExistingAccount(value)
       if owner_picturesque_user is None:
         raise endpoints.NotFoundException(
             'Account for Google+ Owner ID not found.')
-      owner_filter = (Photo.owner == owner_picturesque_user.user_object)
 
-    self._endpoints_query_info._AddFilter(owner_filter)
+      googleplus_user_id = current_picturesque_user.googleplus_user_id
+      acl_entries = ShareGroup.AclEntriesFor(
+          owner_picturesque_user.user_object, googleplus_user_id)
+      if acl_entries:
+        acl_entries.append(googleplus_user_id)
+        self._endpoints_query_info._filters.add(Photo.acl.IN(acl_entries))
+      else:
+        self._endpoints_query_info._AddFilter(Photo.acl == googleplus_user_id)
+
+    if self.OWNER_ANCESTOR_QUERIES:
+      self._endpoints_query_info.ancestor = owner_picturesque_user.key
+    else:
+      self._endpoints_query_info._AddFilter(
+          Photo.owner == owner_picturesque_user.user_object)
 
 
   @EndpointsAliasProperty(name='ownerGoogleplusUserId',
@@ -508,6 +970,432 @@ class Photo(EndpointsModel):
     raise endpoints.BadRequestException(
         'ownerGoogleplusUserId value should never be accessed.')
 
+  def IsSharedWith(self, googleplus_user_id):
+    """Determines whether the photo is shared with a user.
+
+    Args:
+      googleplus_user_id: String; the Google+ ID of a user.
+
+    Returns:
+      Boolean; True if the user is in the ACL, either directly or as a member
+        of a share group in the ACL.
+    """
+    if googleplus_user_id in self.acl:
+      return True
+    return ShareGroup.AnyHasMember(self.acl, googleplus_user_id)
+
+  def ExtractMetadata(self):
+    """Sets the capture date, dimensions and orientation from the contents.
+
+    Only the image headers are read; see image_metadata.py. Properties which
+    can't be read from the headers are cleared.
+
+    Returns:
+      Boolean; True if any of the properties changed.
+    """
+    metadata = image_metadata.extract(self.base64_photo or '')
+    values = (metadata.taken_at, metadata.width, metadata.height,
+              metadata.orientation)
+    if values == (self.taken_at, self.width, self.height, self.orientation):
+      return False
+    self.taken_at, self.width, self.height, self.orientation = values
+    return True
+
+  def ComputePerceptualHash(self):
+    """Sets the perceptual hash from the contents.
+
+    This shrinks the photo with the Images API; see image_hash.py. The hash
+    is cleared if the contents can't be read as an image.
+
+    Returns:
+      Boolean; True if the hash changed.
+    """
+    value = image_hash.dhash(self.base64_photo)
+    hash_string = None if value is None else image_hash.to_string(value)
+    if hash_string == self.perceptual_hash:
+      return False
+    self.perceptual_hash = hash_string
+    return True
+
+  @classmethod
+  def RequireDistance(cls, max_distance):
+    """Makes sure a requested Hamming distance can be searched.
+
+    Raises:
+      endpoints.BadRequestException: if the distance is negative or more than
+        image_hash.MAX_DISTANCE. This results in a 400 response.
+    """
+    if not 0 <= max_distance <= image_hash.MAX_DISTANCE:
+      raise endpoints.BadRequestException(cls.DISTANCE_INVALID)
+
+  @classmethod
+  @ndb.tasklet
+  def _ProbeAsync(cls, owner_query, probe_key):
+    """Finds all of an owner's photos with a hash segment key.
+
+    Args:
+      owner_query: An ndb.Query for the owner's photos; see OwnerQuery.
+      probe_key: String; a segment key (see image_hash.segment_keys).
+
+    Returns:
+      A Future for a list of (ndb.Key, hash string) tuples.
+    """
+    query = owner_query.filter(cls.hash_segments == probe_key)
+    matches = []
+    cursor = None
+    more = True
+    while more:
+      photos, cursor, more = yield query.fetch_page_async(
+          cls.PROBE_PAGE_SIZE, start_cursor=cursor,
+          projection=[cls.perceptual_hash])
+      matches.extend((photo._key, photo.perceptual_hash) for photo in photos)
+    raise ndb.Return(matches)
+
+  @classmethod
+  @ndb.tasklet
+  def FindSimilarAsync(cls, owner_query, hash_string, max_distance,
+                       probes=None):
+    """Finds an owner's photos whose perceptual hash is near a given one.
+
+    Runs one projection query (returning just the key and hash) per probe key
+    of the hash (see image_hash.py), MAX_CONCURRENT_PROBES at a time, so only
+    photos sharing nearly a whole hash segment are read rather than the whole
+    library. Each query is paged through to the end, since it is sorted by
+    hash rather than distance; the distances of the photos found are then
+    checked.
+
+    Args:
+      owner_query: An ndb.Query for the owner's photos; see OwnerQuery.
+      hash_string: String; the perceptual hash to search near.
+      max_distance: Integer; the maximum Hamming distance, at most
+        image_hash.MAX_DISTANCE.
+      probes: Optional dictionary of probe key to the Future of its
+        _ProbeAsync results, shared by the searches of a batch so that
+        photos with similar hashes don't run the same query twice.
+
+    Returns:
+      A Future for a list of (distance, ndb.Key) tuples of the photos within
+        max_distance, sorted by distance. A photo with the hash itself is
+        included.
+    """
+    if probes is None:
+      probes = {}
+    value = image_hash.from_string(hash_string)
+    probe_keys = image_hash.probe_keys(value, max_distance)
+
+    distances = {}
+    for start in xrange(0, len(probe_keys), cls.MAX_CONCURRENT_PROBES):
+      round_keys = probe_keys[start:start + cls.MAX_CONCURRENT_PROBES]
+      for probe_key in round_keys:
+        if probe_key not in probes:
+          probes[probe_key] = cls._ProbeAsync(owner_query, probe_key)
+      results = yield [probes[probe_key] for probe_key in round_keys]
+      for matches in results:
+        for key, match_hash in matches:
+          distance = image_hash.hamming_distance(
+              value, image_hash.from_string(match_hash))
+          if distance <= max_distance:
+            distances[key] = distance
+    raise ndb.Return(sorted((distance, key)
+                            for key, distance in distances.iteritems()))
+
+  @classmethod
+  def FindSimilarPhotos(cls, similar_request, current_picturesque_user):
+    """Finds the current user's photos which look like one of theirs.
+
+    Args:
+      similar_request: A SimilarPhotosRequest message.
+      current_picturesque_user: The PicturesqueUser making the request, who
+        must own the photo.
+
+    Returns:
+      A SimilarPhotosResponse with up to MAX_SIMILAR_RESULTS other photos,
+        closest first. Photos whose contents couldn't be hashed have none.
+
+    Raises:
+      endpoints.BadRequestException: if the key or distance is invalid. This
+        results in a 400 response.
+      endpoints.NotFoundException: if the photo doesn't exist. This results in
+        a 404 response.
+      endpoints.ForbiddenException: if the current user doesn't own the
+        photo. This results in a 403 response.
+    """
+    cls.RequireDistance(similar_request.maxDistance)
+    key = cls.KeyFromString(similar_request.key)
+    photo = key.get()
+    if photo is None:
+      raise endpoints.NotFoundException(cls.NOT_FOUND_ERROR)
+    if photo.owner != current_picturesque_user.user_object:
+      raise endpoints.ForbiddenException(cls.FORBIDDEN_ERROR)
+    if photo.perceptual_hash is None:
+      return SimilarPhotosResponse()
+
+    matches = cls.FindSimilarAsync(
+        cls.OwnerQuery(current_picturesque_user), photo.perceptual_hash,
+        similar_request.maxDistance).get_result()
+    items = [SimilarPhoto(key=cls.KeyToString(match_key), distance=distance)
+             for distance, match_key in matches if match_key != key]
+    return SimilarPhotosResponse(items=items[:cls.MAX_SIMILAR_RESULTS])
+
+  @classmethod
+  def StartDuplicateSearch(cls, duplicates_request, current_picturesque_user):
+    """Starts a background search for groups of similar photos.
+
+    Replaces the user's DuplicateReport with an empty one for the new search.
+
+    Args:
+      duplicates_request: A FindDuplicatesRequest message.
+      current_picturesque_user: The PicturesqueUser making the request.
+
+    Raises:
+      endpoints.BadRequestException: if the distance is invalid. This results
+        in a 400 response.
+    """
+    cls.RequireDistance(duplicates_request.maxDistance)
+    googleplus_user_id = current_picturesque_user.googleplus_user_id
+    step = DuplicateSearchStep(jobId=uuid.uuid4().hex,
+                               ownerGoogleplusUserId=googleplus_user_id,
+                               maxDistance=duplicates_request.maxDistance)
+
+    def start_search():
+      DuplicateReport(id=googleplus_user_id, job_id=step.jobId,
+                      max_distance=step.maxDistance).put()
+      jobs.enqueue(FindDuplicatesJob, [step], transactional=True)
+
+    ndb.transaction(start_search)
+
+  @classmethod
+  def FindDuplicatesBatch(cls, step, owner):
+    """Runs one batch of a duplicate search and enqueues the next one.
+
+    Pages through the owner's photos (as a projection on the perceptual hash)
+    and looks up the similar photos of each with FindSimilarAsync, one photo
+    at a time so the number of concurrent queries stays bounded. Photos in a
+    batch are sorted by hash, so they share many probe keys, whose queries
+    are only run once. The pairs found are merged into the groups of the owner's
+    DuplicateReport, in a transaction which only applies the batch if the
+    report is still at its step, so a retried batch isn't counted twice.
+
+    Args:
+      step: A DuplicateSearchStep message describing the batch.
+      owner: The PicturesqueUser who owns the photos.
+    """
+    owner_query = cls.OwnerQuery(owner)
+    cursor = None
+    if step.cursor is not None:
+      cursor = Cursor(urlsafe=step.cursor)
+    # Sorted by hash, which the projection's index is sorted by anyway.
+    photos, next_cursor, more = owner_query.order(
+        cls.perceptual_hash).fetch_page(
+            cls.DUPLICATE_JOB_BATCH_SIZE, start_cursor=cursor,
+            projection=[cls.perceptual_hash])
+
+    probes = {}
+    pairs = []
+    for photo in photos:
+      if photo.perceptual_hash is None:
+        continue
+      matches = cls.FindSimilarAsync(owner_query, photo.perceptual_hash,
+                                     step.maxDistance,
+                                     probes=probes).get_result()
+      pairs.extend((cls.KeyToString(photo._key), cls.KeyToString(match_key))
+                   for _, match_key in matches if match_key != photo._key)
+
+    report_key = ndb.Key(DuplicateReport, step.ownerGoogleplusUserId)
+
+    @ndb.transactional
+    def checkpoint():
+      report = report_key.get()
+      if (report is None or report.job_id != step.jobId or
+          report.step != step.step):
+        return False  # A newer search, or another run of the same batch.
+      report.AddPairs(pairs)
+      report.step += 1
+      report.done = not more
+      report.put()
+      if more:
+        next_step = DuplicateSearchStep(
+            jobId=step.jobId, step=step.step + 1,
+            ownerGoogleplusUserId=step.ownerGoogleplusUserId,
+            maxDistance=step.maxDistance, cursor=next_cursor.urlsafe())
+        # Transactional, so only the run which checkpoints enqueues it.
+        jobs.enqueue(FindDuplicatesJob, [next_step], transactional=True)
+      return True
+
+    checkpoint()
+
+  # Contents as last loaded from or written to the storage backend, so that
+  # puts only store them again if they were replaced.
+  _stored_contents = None
+  # Contents taken out of the entity while it is being put.
+  _putting_contents = None
+  # Key of contents replaced by a put, to be deleted once a put commits. Kept
+  # until then, since a transaction may put the photo again after a rolled
+  # back attempt.
+  _replaced_content_key = None
+  # Set to keep the 'updated' stamp when the photo is put, for rewrites
+  # clients don't need to see (e.g. reindexing); see _prepare_for_put.
+  _keep_updated = False
+
+  def ContentSize(self):
+    """Gets the size of the contents in bytes, without loading them."""
+    if self.base64_photo is not None:
+      return len(self.base64_photo)
+    return self.content_size or 0
+
+  @classmethod
+  def LoadContents(cls, photos):
+    """Loads the contents of photos which are kept in the storage backend.
+
+    Photos with inline or already loaded contents are skipped; the rest are
+    read with a single GetMulti.
+
+    Args:
+      photos: List of Photo entities; None values are skipped.
+
+    Raises:
+      ValueError: if a photo has contents in a storage backend but none is
+        set.
+    """
+    to_load = [photo for photo in photos
+               if photo is not None and photo.base64_photo is None and
+               photo.content_key is not None]
+    if not to_load:
+      return
+
+    storage = photo_storage.get_storage()
+    if storage is None:
+      raise ValueError('Photo contents are in a storage backend, but no '
+                       'backend is set.')
+    all_contents = storage.GetMulti([photo.content_key for photo in to_load])
+    for photo, contents in zip(to_load, all_contents):
+      photo.base64_photo = contents
+      photo._stored_contents = contents
+
+  @classmethod
+  def DeleteContents(cls, content_keys):
+    """Deletes contents from the storage backend.
+
+    Meant to be called once the photos using the contents have been deleted.
+
+    Args:
+      content_keys: List of content keys of photos; None values (for photos
+        with inline contents) are skipped.
+    """
+    storage = photo_storage.get_storage()
+    for content_key in content_keys:
+      if content_key is not None and storage is not None:
+        storage.Delete(content_key)
+
+  def _prepare_for_put(self):
+    """Sets the automatic properties for a put, unless _keep_updated is set.
+
+    ndb sets 'updated' (auto_now) here; a photo which has a stamp and
+    _keep_updated set gets the stamp back afterwards.
+    """
+    updated = self.updated
+    super(Photo, self)._prepare_for_put()
+    if self._keep_updated and updated is not None:
+      self.updated = updated
+
+  def _pre_put_hook(self):
+    """Moves new contents to the storage backend, if one is set.
+
+    Contents which were not loaded are left as they are. Otherwise, unless
+    they are the ones last stored, they are stored under a new key, and the
+    previous key is deleted once the put commits (see _post_put_hook). The
+    contents are taken out of the entity for the put and put back after it.
+
+    Storage backends store contents at once, outside of any transaction, so
+    when a transaction is retried and puts this photo again, the contents
+    stored by the rolled back attempt are still there to be used.
+    """
+    contents = self.base64_photo
+    if contents is None:
+      return
+
+    self.content_size = len(contents)
+    storage = photo_storage.get_storage()
+    if storage is None:
+      # Stored inline, so contents in a backend which is no longer set
+      # can't be deleted.
+      self.content_key = None
+      return
+
+    if contents is not self._stored_contents or self.content_key is None:
+      if self._replaced_content_key is None:
+        self._replaced_content_key = self.content_key
+      self.content_key = storage.NewKey()
+      storage.Put(self.content_key, contents, mime_type=self.mime_type)
+      self._stored_contents = contents
+    self._putting_contents = contents
+    self.base64_photo = None
+
+  def _post_put_hook(self, future):
+    """Puts the contents back and deletes replaced contents on commit."""
+    if self._putting_contents is not None:
+      self.base64_photo = self._putting_contents
+      self._putting_contents = None
+
+    replaced_content_key = self._replaced_content_key
+    if replaced_content_key is None or future.get_exception() is not None:
+      return
+
+    def delete_replaced():
+      if self._replaced_content_key == replaced_content_key:
+        self._replaced_content_key = None
+      Photo.DeleteContents([replaced_content_key])
+
+    # Runs at once outside of a transaction. Dropped if the transaction
+    # is rolled back, in which case a retry registers it again.
+    ndb.get_context().call_on_commit(delete_replaced)
+
+  _serializers = {}
+
+  @classmethod
+  def Serializer(cls, fields=None):
+    """Gets the (cached) PhotoMessageSerializer for a set of fields.
+
+    Args:
+      fields: Optional fields, defaults to None. As in ProtoModel.
+
+    Returns:
+      A PhotoMessageSerializer instance.
+    """
+    if fields is None:
+      fields = cls._message_fields_schema
+    serializer = cls._serializers.get(fields)
+    if serializer is None:
+      serializer = PhotoMessageSerializer(fields)
+      cls._serializers[fields] = serializer
+    return serializer
+
+  @classmethod
+  def ToMessageCollection(cls, items, collection_fields=None,
+                          next_cursor=None):
+    """Converts a list of photos and cursor to a collection message.
+
+    Overrides EndpointsModel.ToMessageCollection to use PhotoMessageSerializer
+    (if FAST_LIST_SERIALIZATION is set) so that the current user is only
+    looked up once per page rather than once per photo for 'isMine'.
+
+    Args:
+      items: A list of Photo entities.
+      collection_fields: Optional fields, defaults to None.
+      next_cursor: An optional query cursor, defaults to None.
+
+    Returns:
+      The ProtoRPC collection message.
+    """
+    cls.LoadContents(items)
+    if not cls.FAST_LIST_SERIALIZATION:
+      return super(Photo, cls).ToMessageCollection(
+          items, collection_fields=collection_fields, next_cursor=next_cursor)
+
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    return cls.Serializer(collection_fields).ToMessageCollection(
+        items, current_picturesque_user.user_object, next_cursor=next_cursor)
+
   @classmethod
   @ndb.transactional(xg=True)
   def UpdatePhotoFromProto(cls, photo_request):
@@ -519,6 +1407,7 @@ class Photo(EndpointsModel):
 
     In doing this, we again validate the title and base64 photo contents (as in
     create), we require the current user has a valid account and is the owner.
+    The owner's storage usage is updated in the same transaction.
 
     Args:
       photo_request: A protorpc message corresponding to the Photo model.
@@ -527,19 +1416,18 @@ class Photo(EndpointsModel):
       The updated Photo instance.
 
     Raises:
-      endpoints.BadRequestException: if the key from the request is invalid (as
-        a integer serialized to string) or causes a datastore error. This
-        results in a 400 response.
+      endpoints.BadRequestException: if the key from the request is invalid
+        (see KeyFromString) or causes a datastore error. This results in a
+        400 response.
       endpoints.NotFoundException: If the photo entity is not stored in the
         datastore. This results in a 404 response.
       endpoints.BadRequestException: if the request does not have a title
         or base64 photo contents. This results in a 400 response.
     """
-    existing = None
+    key = cls.KeyFromString(photo_request.key)
     try:
-      id_as_long = long(photo_request.key)
-      existing = cls.get_by_id(id_as_long)
-    except (TypeError, ValueError, datastore_errors.Error):
+      existing = key.get()
+    except datastore_errors.Error:
       raise endpoints.BadRequestException(cls.KEY_WRONG_FORMAT)
 
     if existing is None:
@@ -569,6 +1457,1205 @@ class Photo(EndpointsModel):
     photo.owner = existing.owner
     # Set ACL since we don't allow it in the Schema for Update
     photo.acl = existing.acl
+    # So the existing contents are deleted from the storage backend.
+    photo.content_key = existing.content_key
+    # Metadata comes from the new contents, not the payload.
+    photo.ExtractMetadata()
+    photo.ComputePerceptualHash()
 
     photo.put()
+    UsageShard.Add(photo.owner, 0,
+                   photo.ContentSize() - existing.ContentSize())
     return photo
+
+  def ToOperationResult(self, local_key):
+    """Creates a PhotoOperationResult for the current (stored) entity.
+
+    Args:
+      local_key: String; the localKey sent with the operation.
+
+    Returns:
+      A PhotoOperationResult populated with the key, updated stamp and tags.
+    """
+    return PhotoOperationResult(localKey=local_key, key=self.key,
+                                updated=self.updated, tags=self.tags)
+
+  @classmethod
+  def ApplyBatch(cls, batch_request, current_picturesque_user):
+    """Applies the writes in a PhotoBatchRequest for the current user.
+
+    Operations are validated individually; one that can't be applied (or a
+    create which would exceed the storage quota) is reported with an error in
+    its result rather than failing the whole request. All reads, puts and
+    deletes are each issued as a single batch RPC, so a batch costs the same
+    number of round trips no matter how many operations it contains.
+
+    The existing photos are read, checked and written in a single
+    cross-group transaction together with the change to the owner's storage
+    usage, so patches and deletes apply to the photos as they are when the
+    batch commits; MAX_BATCH_SIZE keeps this within
+    the entity group limit. The client is expected to have coalesced its
+    queued writes so that each key appears at most once.
+
+    Args:
+      batch_request: A PhotoBatchRequest message.
+      current_picturesque_user: The PicturesqueUser making the request; all
+        photos written must be owned by this user.
+
+    Returns:
+      A PhotoBatchResponse with one result per operation, in request order.
+
+    Raises:
+      endpoints.BadRequestException: if the batch contains more than
+        MAX_BATCH_SIZE operations. This results in a 400 response.
+    """
+    operations = batch_request.operations
+    if len(operations) > cls.MAX_BATCH_SIZE:
+      raise endpoints.BadRequestException(cls.BATCH_TOO_LARGE)
+
+    owner = current_picturesque_user.user_object
+    parent = cls.OwnerParent(current_picturesque_user.googleplus_user_id)
+    photo_count, byte_count = UsageShard.GetUsage(owner)
+    results = [None] * len(operations)
+    to_put = []  # List of (index, local key, photo) tuples for creates
+    created = []  # Photos in to_put
+    to_get = []  # List of (index, operation, key) tuples
+
+    for index, operation in enumerate(operations):
+      error = None
+      if operation.operation == PhotoOperation.Operation.CREATE:
+        if operation.title is None:
+          error = cls.TITLE_NEEDED
+        elif operation.base64Photo is None:
+          error = cls.PHOTO_NEEDED
+        elif operation.mimeType is None:
+          error = cls.MIME_TYPE_NEEDED
+        elif not UsageShard.Allows(photo_count + 1,
+                                   byte_count + len(operation.base64Photo)):
+          error = UsageShard.QUOTA_EXCEEDED
+        else:
+          photo_count += 1
+          byte_count += len(operation.base64Photo)
+          photo = cls(parent=parent, title=operation.title,
+                      description=operation.description,
+                      base64_photo=operation.base64Photo,
+                      mime_type=operation.mimeType, owner=owner)
+          photo.ExtractMetadata()
+          photo.ComputePerceptualHash()
+          to_put.append((index, operation.localKey, photo))
+          created.append(photo)
+      else:
+        try:
+          to_get.append((index, operation, cls.KeyFromString(operation.key)))
+        except endpoints.BadRequestException:
+          error = cls.KEY_WRONG_FORMAT
+
+      if error is not None:
+        results[index] = PhotoOperationResult(localKey=operation.localKey,
+                                              key=operation.key, error=error)
+
+    def write_batch():
+      # Reset, since the transaction may be retried.
+      to_update = list(to_put)
+      to_delete = []
+      errors = []  # List of (index, operation, error) tuples
+
+      existing_photos = ndb.get_multi([key for _, _, key in to_get])
+      for (index, operation, _), existing in zip(to_get, existing_photos):
+        if existing is None:
+          errors.append((index, operation, cls.NOT_FOUND_ERROR))
+        elif existing.owner != owner:
+          errors.append((index, operation, cls.FORBIDDEN_ERROR))
+        elif operation.operation == PhotoOperation.Operation.DELETE:
+          to_delete.append((index, operation.localKey, existing))
+        else:
+          if operation.title is not None:
+            existing.title = operation.title
+          if operation.description is not None:
+            existing.description = operation.description
+          to_update.append((index, operation.localKey, existing))
+
+      # Patches don't change the photo contents.
+      deleted = [photo for _, _, photo in to_delete]
+      added_photos = len(created) - len(deleted)
+      added_bytes = (sum(photo.ContentSize() for photo in created) -
+                     sum(photo.ContentSize() for photo in deleted))
+
+      futures = ndb.put_multi_async([photo for _, _, photo in to_update])
+      futures.extend(ndb.delete_multi_async(
+          [photo._key for photo in deleted]))
+      if added_photos or added_bytes:
+        futures.append(UsageShard.AddAsync(owner, added_photos, added_bytes))
+      for future in futures:
+        future.get_result()
+      return to_update, to_delete, errors
+
+    # The existing photos are read in the transaction too, so a replayed
+    # patch can't overwrite a change (e.g. to the ACL) made since.
+    to_update, to_delete, errors = ndb.transaction(write_batch, xg=True)
+    cls.DeleteContents([photo.content_key for _, _, photo in to_delete])
+
+    for index, operation, error in errors:
+      results[index] = PhotoOperationResult(localKey=operation.localKey,
+                                            key=operation.key, error=error)
+    for index, local_key, photo in to_update:
+      results[index] = photo.ToOperationResult(local_key)
+    for index, local_key, photo in to_delete:
+      results[index] = PhotoOperationResult(localKey=local_key, key=photo.key)
+
+    return PhotoBatchResponse(results=results)
+
+  @classmethod
+  def _UpdateAcls(cls, keys, owner, operation, acl_user_ids):
+    """Updates the ACLs of photos in one entity group; run in a transaction.
+
+    Args:
+      keys: List of ndb.Keys of the photos, all with the same root.
+      owner: App Engine User who must own the photos. Photos owned by anyone
+        else are left alone.
+      operation: An AclBulkRequest.Operation.
+      acl_user_ids: List of Google+ IDs to remove, or the new ACL.
+
+    Returns:
+      Tuple of two sets of Google+ IDs; those removed from and those added to
+        the ACLs.
+    """
+    removed_ids = set()
+    added_ids = set()
+    changed = []
+    for photo in ndb.get_multi(keys):
+      if photo is None or photo.owner != owner:
+        continue
+
+      previous_acl = set(photo.acl)
+      if operation == AclBulkRequest.Operation.REMOVE:
+        new_acl = [acl_id for acl_id in photo.acl
+                   if acl_id not in acl_user_ids]
+      else:
+        new_acl = list(acl_user_ids)
+
+      if set(new_acl) != previous_acl:
+        photo.acl = new_acl
+        changed.append(photo)
+      removed_ids.update(previous_acl - set(new_acl))
+      added_ids.update(set(new_acl) - previous_acl)
+
+    ndb.put_multi(changed)
+    return removed_ids, added_ids
+
+  @classmethod
+  def StartAclBulkUpdate(cls, bulk_request, current_picturesque_user):
+    """Validates a bulk ACL request and starts the background job for it.
+
+    Args:
+      bulk_request: An AclBulkRequest message.
+      current_picturesque_user: The PicturesqueUser making the request.
+
+    Raises:
+      endpoints.BadRequestException: if the ACL user IDs or photo keys are
+        invalid. This results in a 400 response.
+    """
+    acl_user_ids = list(bulk_request.aclUserIds)
+    if (bulk_request.operation == AclBulkRequest.Operation.REMOVE and
+        not acl_user_ids):
+      raise endpoints.BadRequestException(cls.ACL_IDS_NEEDED)
+    if not all(acl_user_ids):
+      raise endpoints.BadRequestException(
+          'ACL user IDs must be non-empty strings.')
+
+    ShareGroup.RequireOwnedAclEntries(
+        acl_user_ids, current_picturesque_user.user_object)
+
+    photo_keys = list(bulk_request.photoKeys)
+    for photo_key in photo_keys:
+      cls.KeyFromString(photo_key)
+
+    step = AclBulkUpdateStep(
+        jobId=uuid.uuid4().hex,
+        ownerGoogleplusUserId=current_picturesque_user.googleplus_user_id,
+        operation=bulk_request.operation, aclUserIds=acl_user_ids,
+        photoKeys=photo_keys)
+    jobs.enqueue(AclBulkUpdateJob, [step],
+                 idempotency_key='%s-%d' % (step.jobId, step.step))
+
+  @classmethod
+  def UpdateAclBatch(cls, step, owner):
+    """Runs one batch of a bulk ACL update and enqueues the next one.
+
+    The photos of each entity group are updated in their own transaction, with
+    all groups in the batch updated concurrently; root photos are one group
+    each, while photos parented under their owner (see PARENT_UNDER_OWNER)
+    share one, so they don't contend with each other. The photos updated are
+    either the explicitly requested ones (in slices of photoIds and
+    photoKeys) or found by queries paged with cursors: for REMOVE, one query
+    per removed ID for the owner's photos shared with that ID; for REPLACE,
+    all of the owner's photos.
+
+    Once all batches are done, the in_users_acl_list of every user added to
+    or removed from an ACL is updated, once per user rather than per photo.
+    Share group entries are skipped for this; their members are tracked when
+    they are added to or removed from the group.
+
+    Tasks are enqueued with idempotency keys derived from the job ID and
+    step, so a retried batch doesn't start a second chain.
+
+    Args:
+      step: An AclBulkUpdateStep message describing the batch.
+      owner: App Engine User who owns the photos.
+    """
+    operation = step.operation
+    acl_user_ids = step.aclUserIds
+    # Steps enqueued before photoKeys was added only have photoIds.
+    photo_keys = ([ndb.Key(cls, photo_id) for photo_id in step.photoIds] +
+                  [cls.KeyFromString(photo_key)
+                   for photo_key in step.photoKeys])
+    position = step.position
+    cursor = None
+    if step.cursor is not None:
+      cursor = Cursor(urlsafe=step.cursor)
+
+    if photo_keys:
+      next_position = position + cls.ACL_JOB_BATCH_SIZE
+      keys = photo_keys[position:next_position]
+      next_cursor = None
+      more = next_position < len(photo_keys)
+    elif operation == AclBulkRequest.Operation.REMOVE:
+      query = cls.query(cls.owner == owner,
+                        cls.acl == acl_user_ids[position])
+      keys, next_cursor, more = query.fetch_page(
+          cls.ACL_JOB_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+      next_position = position
+      if not more:
+        next_cursor = None
+        next_position = position + 1
+        more = next_position < len(acl_user_ids)
+    else:
+      query = cls.query(cls.owner == owner)
+      keys, next_cursor, more = query.fetch_page(
+          cls.ACL_JOB_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+      next_position = position
+
+    groups = collections.OrderedDict()
+    for key in keys:
+      groups.setdefault(key.root(), []).append(key)
+
+    removed_ids = set(step.removedIds)
+    added_ids = set(step.addedIds)
+    futures = [ndb.transaction_async(
+                   lambda group_keys=group_keys: cls._UpdateAcls(
+                       group_keys, owner, operation, acl_user_ids))
+               for group_keys in groups.itervalues()]
+    for future in futures:
+      removed, added = future.get_result()
+      removed_ids.update(removed)
+      added_ids.update(added)
+
+    if more:
+      next_step = AclBulkUpdateStep(
+          jobId=step.jobId, step=step.step + 1,
+          ownerGoogleplusUserId=step.ownerGoogleplusUserId,
+          operation=operation, aclUserIds=acl_user_ids,
+          photoIds=step.photoIds, photoKeys=step.photoKeys,
+          position=next_position, removedIds=sorted(removed_ids),
+          addedIds=sorted(added_ids))
+      if next_cursor is not None:
+        next_step.cursor = next_cursor.urlsafe()
+      jobs.enqueue(AclBulkUpdateJob, [next_step],
+                   idempotency_key='%s-%d' % (step.jobId, next_step.step))
+      return
+
+    added_ids = set(acl_id for acl_id in added_ids
+                    if ShareGroup.ParseAclEntry(acl_id) is None)
+    removed_ids = set(acl_id for acl_id in removed_ids - added_ids
+                      if ShareGroup.ParseAclEntry(acl_id) is None)
+    PicturesqueUser.EnqueueInListUpdates(
+        added_ids, removed_ids, step.ownerGoogleplusUserId,
+        idempotency_key='%s-lists' % (step.jobId,))
+
+
+class ShareGroup(EndpointsModel):
+  """Model for a named group of users that photos can be shared with.
+
+  A photo is shared with a group by adding the group's ACL entry to the photo
+  ACL, so the photo stores (and indexes) a single value no matter how many
+  members the group has, and changing the members only rewrites the group.
+  The members are indexed, so the groups of an owner which have a given user
+  as a member can be found when listing the photos shared with that user.
+
+  Attributes:
+    _message_fields_schema: List of fields which appear in API requests.
+    name: String; name of the group.
+    owner: App Engine User Property corresponding to the owner of the group.
+    member_ids: List of Google+ User IDs (as strings) of the group members.
+    key: String version of the integer ID automatically allocated from the
+      datastore. As with Photo, a string is used for JavaScript clients.
+    acl_entry: String to add to a photo ACL to share the photo with the group.
+
+    NewShareGroupSchema: The schema used for new share groups.
+  """
+
+  ACL_ENTRY_PREFIX = 'group:'
+  # Replacing every member then changes at most 200 inUsersAclList entries,
+  # which fits in the tasks that can be added in the same transaction.
+  MAX_MEMBERS = 100
+
+  FORBIDDEN_ERROR = 'You do not own this share group.'
+  KEY_WRONG_FORMAT = 'Key must be a string value of integer.'
+  MEMBER_IDS_INVALID = 'Member IDs must be non-empty strings.'
+  TOO_MANY_MEMBERS = 'Too many members in share group.'
+  NAME_NEEDED = 'Share group must have a name.'
+  NOT_FOUND_ERROR = 'Share group not found.'
+  UNKNOWN_GROUP = 'Unknown share group in ACL.'
+
+  NewShareGroupSchema = MessageFieldsSchema(
+      ('name', 'memberIds'), name='NewShareGroup')
+
+  _message_fields_schema = ('key', 'name', 'memberIds', 'aclEntry')
+
+  name = ndb.StringProperty()
+  owner = ndb.UserProperty(required=True)
+  member_ids = ndb.StringProperty('memberIds', repeated=True)
+
+  def KeySet(self, value):
+    """Setter for 'key' property; see Photo.KeySet.
+
+    Args:
+      value: String (of integer value), the value attempting to be set.
+
+    Raises:
+      endpoints.BadRequestException: if the value was not able to be cast into
+        a long. This results in a 400 response.
+    """
+    try:
+      value = long(value)
+    except (TypeError, ValueError):
+      raise endpoints.BadRequestException(ShareGroup.KEY_WRONG_FORMAT)
+
+    self.UpdateFromKey(ndb.Key(ShareGroup, value))
+
+  @EndpointsAliasProperty(setter=KeySet)
+  def key(self):
+    """The key of the ShareGroup.
+
+    Returns:
+      Integer ID as a string if there is a key and the key has an integer ID.
+    """
+    if self._key is not None and self._key.integer_id() is not None:
+      return str(self._key.integer_id())
+
+  def SetAclEntry(self, unused_value):
+    """Setter for 'aclEntry' property.
+
+    Args:
+      unused_value: The value attempting to be set. Will not be used.
+
+    Raises:
+      endpoints.BadRequestException: if the value was attempted to be set.
+        This results in a 400 response.
+    """
+    raise endpoints.BadRequestException('aclEntry can\'t be set.')
+
+  @EndpointsAliasProperty(name='aclEntry', setter=SetAclEntry)
+  def acl_entry(self):
+    """Getter for 'aclEntry' property.
+
+    Returns:
+      The ACL entry for the group if it has been stored, else None.
+    """
+    if self._key is not None and self._key.integer_id() is not None:
+      return '%s%d' % (self.ACL_ENTRY_PREFIX, self._key.integer_id())
+
+  def CheckValues(self):
+    """Makes sure the group has a name and valid member IDs.
+
+    Raises:
+      endpoints.BadRequestException: if the name is missing, one of the
+        member IDs is empty or there are more than MAX_MEMBERS. This results
+        in a 400 response.
+    """
+    if not self.name:
+      raise endpoints.BadRequestException(self.NAME_NEEDED)
+    if not all(self.member_ids):
+      raise endpoints.BadRequestException(self.MEMBER_IDS_INVALID)
+    if len(set(self.member_ids)) > self.MAX_MEMBERS:
+      raise endpoints.BadRequestException(self.TOO_MANY_MEMBERS)
+
+  @classmethod
+  def ParseAclEntry(cls, acl_entry):
+    """Gets the share group ID from an ACL entry.
+
+    Args:
+      acl_entry: String; an entry of a photo ACL.
+
+    Returns:
+      The integer ID of the share group, or None if the entry is not a
+        (well-formed) share group entry.
+    """
+    if not acl_entry.startswith(cls.ACL_ENTRY_PREFIX):
+      return None
+    try:
+      return long(acl_entry[len(cls.ACL_ENTRY_PREFIX):])
+    except ValueError:
+      return None
+
+  @classmethod
+  def _KeysFromAcl(cls, acl):
+    """Gets the keys of the share groups in an ACL."""
+    keys = []
+    for acl_entry in acl:
+      group_id = cls.ParseAclEntry(acl_entry)
+      if group_id is not None:
+        keys.append(ndb.Key(cls, group_id))
+    return keys
+
+  @classmethod
+  def AclEntriesFor(cls, owner, googleplus_user_id):
+    """Gets the ACL entries of an owner's groups which have a given member.
+
+    Args:
+      owner: App Engine User who owns the groups.
+      googleplus_user_id: String; the Google+ ID of the member.
+
+    Returns:
+      List of ACL entry strings.
+    """
+    keys = cls.query(cls.owner == owner,
+                     cls.member_ids == googleplus_user_id).fetch(
+                         keys_only=True)
+    return ['%s%d' % (cls.ACL_ENTRY_PREFIX, key.integer_id()) for key in keys]
+
+  @classmethod
+  def AnyHasMember(cls, acl, googleplus_user_id):
+    """Determines whether any share group in an ACL has a given member.
+
+    Args:
+      acl: List of photo ACL entries.
+      googleplus_user_id: String; the Google+ ID of a user.
+
+    Returns:
+      Boolean; True if one of the groups has the user as a member.
+    """
+    keys = cls._KeysFromAcl(acl)
+    if not keys:
+      return False
+    return any(group is not None and googleplus_user_id in group.member_ids
+               for group in ndb.get_multi(keys))
+
+  @classmethod
+  def RequireOwnedAclEntries(cls, acl, owner):
+    """Makes sure every share group in a list of ACL entries is the owner's.
+
+    Args:
+      acl: List of photo ACL entries.
+      owner: App Engine User who is sharing.
+
+    Raises:
+      endpoints.BadRequestException: if one of the groups doesn't exist or
+        isn't owned by owner. This results in a 400 response.
+    """
+    keys = cls._KeysFromAcl(acl)
+    for group in ndb.get_multi(keys):
+      if group is None or group.owner != owner:
+        raise endpoints.BadRequestException(cls.UNKNOWN_GROUP)
+
+
+class UsageShard(ndb.Model):
+  """Model for one shard of the storage usage counters of a photo owner.
+
+  Usage is counted in SHARDS entities per owner, keyed by the owner's email
+  (as Photo.owner is compared by email), so concurrent writes by one user
+  rarely contend on the same entity. Reading the usage is a single get_multi
+  of SHARDS small entities, rather than a scan of the owner's photos.
+
+  Counters are changed with AddAsync in the same (cross-group) transaction
+  as the photo writes which change usage. Photos stored before usage was
+  counted can be accounted for with Recount.
+
+  Attributes:
+    photo_count: Integer; number of photos counted in this shard.
+    byte_count: Integer; total size of the photo contents in this shard.
+  """
+
+  SHARDS = 4
+  MAX_PHOTOS = 2000
+  MAX_BYTES = 500 * 1024 * 1024
+  QUOTA_EXCEEDED = 'Storage quota exceeded.'
+
+  photo_count = ndb.IntegerProperty('photoCount', default=0, indexed=False)
+  byte_count = ndb.IntegerProperty('byteCount', default=0, indexed=False)
+
+  @classmethod
+  def ShardKeys(cls, owner):
+    """Gets the keys of all usage shards of an owner.
+
+    Args:
+      owner: App Engine User who owns photos.
+
+    Returns:
+      List of SHARDS ndb.Key instances.
+    """
+    return [ndb.Key(cls, '%s:%d' % (owner.email(), index))
+            for index in xrange(cls.SHARDS)]
+
+  @classmethod
+  def GetUsage(cls, owner):
+    """Sums the usage counters of an owner.
+
+    Args:
+      owner: App Engine User who owns photos.
+
+    Returns:
+      Tuple of integers; the number of photos and their total size in bytes.
+    """
+    shards = [shard for shard in ndb.get_multi(cls.ShardKeys(owner))
+              if shard is not None]
+    return (sum(shard.photo_count for shard in shards),
+            sum(shard.byte_count for shard in shards))
+
+  @classmethod
+  def Allows(cls, photo_count, byte_count):
+    """Determines whether a usage is within the quota.
+
+    Args:
+      photo_count: Integer; a number of photos.
+      byte_count: Integer; a total size of photo contents.
+
+    Returns:
+      Boolean; True if both are within the quota.
+    """
+    return photo_count <= cls.MAX_PHOTOS and byte_count <= cls.MAX_BYTES
+
+  @classmethod
+  def RequireQuota(cls, owner, added_bytes):
+    """Makes sure an owner can store another photo.
+
+    The check is not transactional, so concurrent creates may together
+    exceed the quota slightly.
+
+    Args:
+      owner: App Engine User who owns photos.
+      added_bytes: Integer; size of the photo contents to be stored.
+
+    Raises:
+      endpoints.ForbiddenException: if the photo would exceed the quota. This
+        results in a 403 response.
+    """
+    photo_count, byte_count = cls.GetUsage(owner)
+    if not cls.Allows(photo_count + 1, byte_count + added_bytes):
+      raise endpoints.ForbiddenException(cls.QUOTA_EXCEEDED)
+
+  @classmethod
+  @ndb.tasklet
+  def AddAsync(cls, owner, photo_count, byte_count):
+    """Adds to the usage counters of an owner, in a random shard.
+
+    Meant to be called in the transaction writing the photos; otherwise a
+    transaction is used just for the shard.
+
+    Args:
+      owner: App Engine User who owns photos.
+      photo_count: Integer; change in the number of photos.
+      byte_count: Integer; change in the total size of photo contents.
+
+    Returns:
+      An ndb.Future which completes when the shard has been written.
+    """
+    key = random.choice(cls.ShardKeys(owner))
+
+    @ndb.tasklet
+    def add():
+      shard = yield key.get_async()
+      if shard is None:
+        shard = cls(key=key)
+      shard.photo_count += photo_count
+      shard.byte_count += byte_count
+      yield shard.put_async()
+
+    if ndb.in_transaction():
+      yield add()
+    else:
+      yield ndb.transaction_async(add)
+
+  @classmethod
+  def Add(cls, owner, photo_count, byte_count):
+    """Synchronous version of AddAsync."""
+    cls.AddAsync(owner, photo_count, byte_count).get_result()
+
+  @classmethod
+  def Recount(cls, owner, batch_size=50):
+    """Recomputes the usage counters of an owner from their photos.
+
+    Meant for photos stored before usage was counted, or to repair counters
+    after bulk changes. Writes made while the recount runs may be lost.
+
+    Args:
+      owner: App Engine User who owns photos.
+      batch_size: Integer; number of photos fetched per page.
+
+    Returns:
+      Tuple of integers; the number of photos and their total size in bytes.
+    """
+    photo_count = 0
+    byte_count = 0
+    query = Photo.query(Photo.owner == owner)
+    cursor = None
+    more = True
+    while more:
+      photos, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+      photo_count += len(photos)
+      byte_count += sum(photo.ContentSize() for photo in photos)
+
+    shards = [cls(key=key) for key in cls.ShardKeys(owner)]
+    shards[0].photo_count = photo_count
+    shards[0].byte_count = byte_count
+    ndb.transaction(lambda: ndb.put_multi(shards), xg=True)
+    return photo_count, byte_count
+
+  @classmethod
+  def Reset(cls, owner):
+    """Sets the usage counters of an owner to zero."""
+    ndb.delete_multi(cls.ShardKeys(owner))
+
+
+class DuplicateReport(ndb.Model):
+  """Model for the result of a user's latest duplicate search.
+
+  Keyed by the Google+ ID of the user. Starting a search replaces the report;
+  each batch of the search (see Photo.FindDuplicatesBatch) merges the pairs
+  of similar photos it found into the groups.
+
+  Attributes:
+    job_id: String identifying the search the report belongs to.
+    step: Integer; the number of batches merged so far.
+    max_distance: Integer; the Hamming distance searched within.
+    done: Boolean; whether every batch has been merged.
+    groups: List of strings, each the space separated keys (as in Photo.key)
+      of a group of similar photos.
+    started: Date time the search was started.
+  """
+
+  NOT_FOUND_ERROR = 'No duplicate search was started.'
+
+  job_id = ndb.StringProperty(indexed=False)
+  step = ndb.IntegerProperty(default=0, indexed=False)
+  max_distance = ndb.IntegerProperty(indexed=False)
+  done = ndb.BooleanProperty(default=False, indexed=False)
+  groups = ndb.StringProperty(repeated=True, indexed=False)
+  started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+  def AddPairs(self, pairs):
+    """Merges pairs of similar photos into the groups.
+
+    Groups sharing a photo are joined (with union-find), so a group holds
+    every photo connected by a chain of similar pairs.
+
+    Args:
+      pairs: Iterable of (key, key) tuples of photo key strings.
+    """
+    parents = {}
+
+    def find(key):
+      while parents[key] != key:
+        parents[key] = parents[parents[key]]
+        key = parents[key]
+      return key
+
+    def union(first, second):
+      parents.setdefault(first, first)
+      parents.setdefault(second, second)
+      first_root, second_root = find(first), find(second)
+      if first_root != second_root:
+        parents[second_root] = first_root
+
+    for group in self.groups:
+      keys = group.split()
+      for key in keys:
+        union(keys[0], key)
+    for first, second in pairs:
+      union(first, second)
+
+    groups = collections.defaultdict(list)
+    for key in parents:
+      groups[find(key)].append(key)
+    self.groups = sorted(' '.join(sorted(keys))
+                         for keys in groups.itervalues())
+
+  def ToMessage(self):
+    """Creates a DuplicatesResponse for the report."""
+    return DuplicatesResponse(
+        done=self.done, maxDistance=self.max_distance,
+        groups=[DuplicateGroup(photoKeys=group.split())
+                for group in self.groups])
+
+
+class PhotoMessageSerializer(object):
+  """Builds Photo messages directly from entity values.
+
+  EndpointsModel.ToMessage resolves every field to a property and picks a
+  conversion for it on every call, and the 'isMine' getter looks up the
+  current user for each entity. Here the field conversions are chosen once
+  per set of fields, and ownership is determined by comparing against a user
+  looked up once by the caller. Values are passed through to the message
+  as-is, so the photo contents are not copied before encoding.
+
+  Attributes:
+    message_class: The ProtoRPC message class for the fields.
+    collection_class: The ProtoRPC collection message class for the fields.
+  """
+
+  def __init__(self, fields):
+    self.message_class = Photo.ProtoModel(fields=fields)
+    self.collection_class = Photo.ProtoCollection(collection_fields=fields)
+    self._getters = [(field.name, self._Getter(field))
+                     for field in self.message_class.all_fields()]
+
+  @staticmethod
+  def _Getter(field):
+    """Creates a function to get the message value of a field.
+
+    Args:
+      field: A field on the Photo ProtoRPC message class.
+
+    Returns:
+      A function accepting a Photo and a boolean (whether the current user
+        owns the photo) and returning the value to set on the message.
+    """
+    name = field.name
+    if name == 'isMine':
+      return lambda photo, is_mine: is_mine
+    elif name == 'key':
+      return lambda photo, unused_is_mine: photo.key
+    elif name == 'updated':
+      return lambda photo, unused_is_mine: (
+          photo.updated and utils.DatetimeValueToString(photo.updated))
+
+    prop = Photo._GetEndpointsProperty(name)
+    code_name = prop._code_name
+    if isinstance(prop, (ndb.StringProperty, ndb.BlobProperty,
+                         ndb.ComputedProperty)):
+      return lambda photo, unused_is_mine: getattr(photo, code_name)
+    elif field.repeated:
+      return lambda photo, unused_is_mine: [
+          ToValue(prop, value) for value in getattr(photo, code_name)]
+    else:
+      return lambda photo, unused_is_mine: ToValue(prop,
+                                                   getattr(photo, code_name))
+
+  def ToMessage(self, photo, is_mine):
+    """Converts a photo to a ProtoRPC message.
+
+    Args:
+      photo: A Photo entity.
+      is_mine: Boolean; whether the current user owns the photo.
+
+    Returns:
+      An instance of message_class.
+    """
+    values = {}
+    for name, getter in self._getters:
+      value = getter(photo, is_mine)
+      if value is not None:
+        values[name] = value
+    return self.message_class(**values)
+
+  def ToMessageCollection(self, photos, current_user, next_cursor=None):
+    """Converts a list of photos and cursor to a collection message.
+
+    Args:
+      photos: A list of Photo entities.
+      current_user: The App Engine User of the current Picturesque user, used
+        to determine 'isMine' for each photo.
+      next_cursor: An optional query cursor, defaults to None.
+
+    Returns:
+      An instance of collection_class.
+    """
+    result = self.collection_class(
+        items=[self.ToMessage(photo, photo.owner == current_user)
+               for photo in photos])
+    if next_cursor is not None:
+      result.nextPageToken = next_cursor.to_websafe_string()
+    return result
+
+
+class PhotoOperation(messages.Message):
+  """Message for a single queued write within a photo.batch request.
+
+  Attributes:
+    localKey: The key the client uses to track the operation; echoed back in
+      the corresponding result so the client can match them up.
+    operation: The kind of write being performed.
+    key: String version of the integer ID of an existing photo. Required for
+      PATCH and DELETE, ignored for CREATE.
+    title: String; title for photo.
+    description: String; long description of what is in photo.
+    base64Photo: Bytes; contents of photo. Only used for CREATE.
+    mimeType: String; MIME type of photo. Only used for CREATE.
+  """
+
+  class Operation(messages.Enum):
+    """Enum of the writes supported in a batch."""
+    CREATE = 1
+    PATCH = 2
+    DELETE = 3
+
+  localKey = messages.StringField(1)
+  operation = messages.EnumField(Operation, 2, required=True)
+  key = messages.StringField(3)
+  title = messages.StringField(4)
+  description = messages.StringField(5)
+  base64Photo = messages.BytesField(6)
+  mimeType = messages.StringField(7)
+
+
+class PhotoOperationResult(messages.Message):
+  """Message for the outcome of a single PhotoOperation.
+
+  Attributes:
+    localKey: The localKey sent with the operation.
+    key: String version of the integer ID of the photo written. For CREATE
+      this is the newly allocated ID.
+    updated: Date time corresponding to last update of stored photo. Not set
+      for DELETE.
+    tags: List of strings, parsed hashtags from description. Not set for
+      DELETE.
+    error: String describing why the operation was not applied, if it failed.
+  """
+
+  localKey = messages.StringField(1)
+  key = messages.StringField(2)
+  updated = message_types.DateTimeField(3)
+  tags = messages.StringField(4, repeated=True)
+  error = messages.StringField(5)
+
+
+class PhotoBatchRequest(messages.Message):
+  """Message for a photo.batch request.
+
+  Attributes:
+    operations: List of PhotoOperation messages to be applied in order.
+  """
+
+  operations = messages.MessageField(PhotoOperation, 1, repeated=True)
+
+
+class PhotoBatchResponse(messages.Message):
+  """Message for a photo.batch response.
+
+  Attributes:
+    results: List of PhotoOperationResult messages, one for each operation in
+      the request and in the same order.
+  """
+
+  results = messages.MessageField(PhotoOperationResult, 1, repeated=True)
+
+
+class AclBulkRequest(messages.Message):
+  """Message for an acl.bulkUpdate request.
+
+  Attributes:
+    operation: REMOVE to remove aclUserIds from each photo ACL, or REPLACE to
+      set each photo ACL to exactly aclUserIds.
+    aclUserIds: List of Google+ IDs as strings.
+    photoKeys: Optional list of photo keys (as in Photo.key). If empty, all
+      of the current user's photos are updated.
+  """
+
+  class Operation(messages.Enum):
+    """Enum of the supported bulk ACL updates."""
+    REMOVE = 1
+    REPLACE = 2
+
+  operation = messages.EnumField(Operation, 1, required=True)
+  aclUserIds = messages.StringField(2, repeated=True)
+  photoKeys = messages.StringField(3, repeated=True)
+
+
+class UsageResponse(messages.Message):
+  """Message for a users.usage response.
+
+  Attributes:
+    photoCount: Integer; number of photos the user stores.
+    byteCount: Integer; total size of the user's photo contents.
+    photoQuota: Integer; maximum number of photos the user can store.
+    byteQuota: Integer; maximum total size of the user's photo contents.
+  """
+
+  photoCount = messages.IntegerField(1)
+  byteCount = messages.IntegerField(2)
+  photoQuota = messages.IntegerField(3)
+  byteQuota = messages.IntegerField(4)
+
+
+class SimilarPhotosRequest(messages.Message):
+  """Message for a photo.similar request.
+
+  Attributes:
+    key: String; the key of one of the current user's photos.
+    maxDistance: Integer; the maximum Hamming distance between perceptual
+      hashes of similar photos, at most image_hash.MAX_DISTANCE.
+  """
+
+  key = messages.StringField(1, required=True)
+  maxDistance = messages.IntegerField(2, default=Photo.SIMILAR_DISTANCE)
+
+
+class SimilarPhoto(messages.Message):
+  """Message for one photo in a photo.similar response.
+
+  Attributes:
+    key: String; the key of the photo.
+    distance: Integer; the Hamming distance of its perceptual hash.
+  """
+
+  key = messages.StringField(1)
+  distance = messages.IntegerField(2)
+
+
+class SimilarPhotosResponse(messages.Message):
+  """Message for a photo.similar response.
+
+  Attributes:
+    items: List of SimilarPhoto messages, closest first.
+  """
+
+  items = messages.MessageField(SimilarPhoto, 1, repeated=True)
+
+
+class FindDuplicatesRequest(messages.Message):
+  """Message for a photo.findDuplicates request.
+
+  Attributes:
+    maxDistance: Integer; the maximum Hamming distance between perceptual
+      hashes of duplicates, at most image_hash.MAX_DISTANCE.
+  """
+
+  maxDistance = messages.IntegerField(1, default=Photo.DUPLICATE_DISTANCE)
+
+
+class DuplicateGroup(messages.Message):
+  """Message for a group of similar photos.
+
+  Attributes:
+    photoKeys: List of the keys of the photos.
+  """
+
+  photoKeys = messages.StringField(1, repeated=True)
+
+
+class DuplicatesResponse(messages.Message):
+  """Message for a photo.duplicates response.
+
+  Attributes:
+    done: Boolean; False while the search is still running, in which case
+      the groups are those found so far.
+    maxDistance: Integer; the Hamming distance searched within.
+    groups: List of DuplicateGroup messages.
+  """
+
+  done = messages.BooleanField(1)
+  maxDistance = messages.IntegerField(2)
+  groups = messages.MessageField(DuplicateGroup, 3, repeated=True)
+
+
+class InListUpdate(messages.Message):
+  """Payload of InListUpdateJob; a change to one user's inUsersAclList.
+
+  Attributes:
+    sharedWithUserId: String; the Google+ ID of the user whose list changes.
+    sharingUserId: String; the Google+ ID of the user sharing photos.
+    added: Boolean; True if the sharing user started sharing with the user,
+      False if they may have stopped.
+    recheck: Boolean; if set (with added False), the removal was already
+      made and is checked again; see PicturesqueUser.RecheckInList.
+  """
+
+  sharedWithUserId = messages.StringField(1, required=True)
+  sharingUserId = messages.StringField(2, required=True)
+  added = messages.BooleanField(3, default=True)
+  recheck = messages.BooleanField(4, default=False)
+
+
+class InListFanOut(messages.Message):
+  """Payload of InListFanOutJob; inUsersAclList changes for one sharer.
+
+  Attributes:
+    fanOutId: String identifying the changes; used for idempotency keys.
+    sharingUserId: String; the Google+ ID of the user sharing photos.
+    addedIds: List of Google+ IDs of users the sharer started sharing with.
+    removedIds: List of Google+ IDs of users the sharer may have stopped
+      sharing with.
+  """
+
+  fanOutId = messages.StringField(1, required=True)
+  sharingUserId = messages.StringField(2, required=True)
+  addedIds = messages.StringField(3, repeated=True)
+  removedIds = messages.StringField(4, repeated=True)
+
+
+class AclBulkUpdateStep(messages.Message):
+  """Payload of AclBulkUpdateJob; one batch of an acl.bulkUpdate request.
+
+  Attributes:
+    jobId: String identifying the bulk update; used for idempotency keys.
+    step: Integer; the number of batches run before this one.
+    ownerGoogleplusUserId: String; the Google+ ID of the owner.
+    operation: The AclBulkRequest.Operation.
+    aclUserIds: List of Google+ IDs to remove, or the new ACL.
+    photoIds: List of integer IDs of root photos to update; only set by
+      steps enqueued before photoKeys.
+    photoKeys: List of photo key strings (see Photo.key) to update. If this
+      and photoIds are empty, all of the owner's (relevant) photos are
+      updated.
+    cursor: Urlsafe cursor string to continue the current query from.
+    position: Integer; the offset into photoIds and photoKeys (in that
+      order), or for REMOVE the index of the ACL ID whose query is being
+      paged through.
+    removedIds: List of Google+ IDs removed from an ACL in earlier batches.
+    addedIds: List of Google+ IDs added to an ACL in earlier batches.
+  """
+
+  jobId = messages.StringField(1, required=True)
+  step = messages.IntegerField(2, default=0)
+  ownerGoogleplusUserId = messages.StringField(3, required=True)
+  operation = messages.EnumField(AclBulkRequest.Operation, 4, required=True)
+  aclUserIds = messages.StringField(5, repeated=True)
+  photoIds = messages.IntegerField(6, repeated=True)
+  cursor = messages.StringField(7)
+  position = messages.IntegerField(8, default=0)
+  removedIds = messages.StringField(9, repeated=True)
+  addedIds = messages.StringField(10, repeated=True)
+  photoKeys = messages.StringField(11, repeated=True)
+
+
+class DuplicateSearchStep(messages.Message):
+  """Payload of FindDuplicatesJob; one batch of a duplicate search.
+
+  Attributes:
+    jobId: String identifying the search; see DuplicateReport.job_id.
+    step: Integer; the number of batches run before this one.
+    ownerGoogleplusUserId: String; the Google+ ID of the owner.
+    maxDistance: Integer; the Hamming distance searched within.
+    cursor: Urlsafe cursor string to continue the owner's photos from.
+  """
+
+  jobId = messages.StringField(1, required=True)
+  step = messages.IntegerField(2, default=0)
+  ownerGoogleplusUserId = messages.StringField(3, required=True)
+  maxDistance = messages.IntegerField(4, required=True)
+  cursor = messages.StringField(5)
+
+
+@jobs.register
+class InListUpdateJob(jobs.Job):
+  """Job keeping inUsersAclList up to date as photos are (un)shared.
+
+  Failures are mostly contention on a popular shared-with user, so retries
+  back off quickly to a fairly long delay.
+  """
+
+  name = 'in-list-update'
+  payload_class = InListUpdate
+  batch_size = 50
+  retry_policy = jobs.RetryPolicy(min_backoff_seconds=5,
+                                  max_backoff_seconds=300)
+
+  def Run(self, payloads):
+    """Applies UpdateInList or RemoveFromInList for each payload.
+
+    Removals which were made are checked again after a delay, with
+    RecheckInList.
+    """
+    sharing_users = {}
+    rechecks = []
+    try:
+      for payload in payloads:
+        if payload.added:
+          PicturesqueUser.UpdateInList(payload.sharedWithUserId,
+                                       payload.sharingUserId)
+          continue
+
+        if payload.sharingUserId not in sharing_users:
+          sharing_users[payload.sharingUserId] = PicturesqueUser.get_by_id(
+              payload.sharingUserId)
+        sharing_user = sharing_users[payload.sharingUserId]
+        # Without an account, the sharing user can't own any photos.
+        if sharing_user is None or sharing_user.user_object is None:
+          continue
+        if payload.recheck:
+          PicturesqueUser.RecheckInList(payload.sharedWithUserId,
+                                        payload.sharingUserId,
+                                        sharing_user.user_object)
+        elif PicturesqueUser.RemoveFromInList(payload.sharedWithUserId,
+                                              payload.sharingUserId,
+                                              sharing_user.user_object):
+          rechecks.append(InListUpdate(
+              sharedWithUserId=payload.sharedWithUserId,
+              sharingUserId=payload.sharingUserId, added=False, recheck=True))
+    finally:
+      # Also when the batch fails part way: the removals made so far are
+      # no-ops when it is retried, so their rechecks would be lost.
+      jobs.enqueue(InListUpdateJob, rechecks,
+                   countdown=PicturesqueUser.IN_LIST_RECHECK_SECONDS)
+
+
+@jobs.register
+class InListFanOutJob(jobs.Job):
+  """Job enqueueing InListUpdateJob tasks for too many IDs for a transaction.
+
+  A transaction can only add jobs.MAX_TRANSACTIONAL_TASKS tasks, so
+  PicturesqueUser.EnqueueInListUpdates adds one of these instead when a
+  change needs more InListUpdateJob tasks.
+  """
+
+  name = 'in-list-fan-out'
+  payload_class = InListFanOut
+
+  def Run(self, payloads):
+    """Enqueues the InListUpdateJob tasks, named after the fan-out."""
+    for payload in payloads:
+      PicturesqueUser.EnqueueInListUpdates(
+          payload.addedIds, payload.removedIds, payload.sharingUserId,
+          idempotency_key=payload.fanOutId)
+
+
+@jobs.register
+class AclBulkUpdateJob(jobs.Job):
+  """Job running the batches of an acl.bulkUpdate request in sequence."""
+
+  name = 'acl-bulk-update'
+  payload_class = AclBulkUpdateStep
+
+  def Run(self, payloads):
+    """Runs Photo.UpdateAclBatch for each step.
+
+    Raises:
+      jobs.PermanentJobError: if the owner no longer has an account.
+    """
+    for step in payloads:
+      owner = PicturesqueUser.get_by_id(step.ownerGoogleplusUserId)
+      if owner is None or owner.user_object is None:
+        raise jobs.PermanentJobError('No account for %s.' %
+                                     (step.ownerGoogleplusUserId,))
+      Photo.UpdateAclBatch(step, owner.user_object)
+
+
+@jobs.register
+class FindDuplicatesJob(jobs.Job):
+  """Job running the batches of a photo.findDuplicates request in turn."""
+
+  name = 'find-duplicates'
+  payload_class = DuplicateSearchStep
+
+  def Run(self, payloads):
+    """Runs Photo.FindDuplicatesBatch for each step.
+
+    Raises:
+      jobs.PermanentJobError: if the owner no longer has an account.
+    """
+    for step in payloads:
+      owner = PicturesqueUser.get_by_id(step.ownerGoogleplusUserId)
+      if owner is None or owner.user_object is None:
+        raise jobs.PermanentJobError('No account for %s.' %
+                                     (step.ownerGoogleplusUserId,))
+      Photo.FindDuplicatesBatch(step, owner)
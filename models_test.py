@@ -0,0 +1,126 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Tests for models.PicturesqueUser account sign up, on testbed stubs.
+
+Run from the application root with the App Engine SDK:
+
+  APPENGINE_SDK=/path/to/google_appengine python models_test.py
+"""
+
+
+import os
+import sys
+import unittest
+
+if os.getenv('APPENGINE_SDK'):
+  sys.path.insert(0, os.getenv('APPENGINE_SDK'))
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+from google.appengine.ext import endpoints
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import appengine_config  # For import path mangling
+from models import PicturesqueUser
+
+
+AUTH_DOMAIN = 'gmail.com'
+GOOGLEPLUS_USER_ID = '1234'
+SHARING_USER_ID = '5678'
+
+
+class TransactionCounter(object):
+  """Pre-call hook counting the datastore transactions begun."""
+
+  def __init__(self):
+    self.count = 0
+
+  def __call__(self, service, call, unused_request, unused_response):
+    """Counts a single RPC if it begins a transaction."""
+    if service == 'datastore_v3' and call == 'BeginTransaction':
+      self.count += 1
+
+
+class GetOrCreateAccountTest(unittest.TestCase):
+  """Tests for PicturesqueUser.GetOrCreateAccount."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.setup_env(auth_domain=AUTH_DOMAIN, overwrite=True)
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_user_stub()
+
+    self.user = users.User(email='signing-up@gmail.com')
+    self.transactions = TransactionCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'transaction_counter', self.transactions)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _Store(self, picturesque_user):
+    """Puts an account and clears the caches, as in a new request."""
+    picturesque_user.put()
+    ndb.get_context().clear_cache()
+    self.transactions.count = 0
+
+  def _Stored(self):
+    """Gets the stored account, bypassing the caches."""
+    return PicturesqueUser.get_by_id(GOOGLEPLUS_USER_ID, use_cache=False,
+                                     use_memcache=False)
+
+  def testPartialAccountIsCompleted(self):
+    self._Store(PicturesqueUser(id=GOOGLEPLUS_USER_ID,
+                                in_users_acl_list=[SHARING_USER_ID]))
+
+    account = PicturesqueUser.GetOrCreateAccount(self.user,
+                                                 GOOGLEPLUS_USER_ID)
+
+    self.assertEqual(self.user, account.user_object)
+    self.assertEqual([SHARING_USER_ID], account.in_users_acl_list)
+    stored = self._Stored()
+    self.assertEqual(self.user, stored.user_object)
+    self.assertEqual([SHARING_USER_ID], stored.in_users_acl_list)
+    self.assertEqual(1, self.transactions.count)
+
+  def testExistingAccountSkipsTransaction(self):
+    self._Store(PicturesqueUser(id=GOOGLEPLUS_USER_ID,
+                                user_object=self.user,
+                                in_users_acl_list=[SHARING_USER_ID]))
+
+    account = PicturesqueUser.GetOrCreateAccount(self.user,
+                                                 GOOGLEPLUS_USER_ID)
+
+    self.assertEqual(self.user, account.user_object)
+    self.assertEqual([SHARING_USER_ID], account.in_users_acl_list)
+    self.assertEqual(0, self.transactions.count)
+
+  def testOtherUsersAccountIsForbidden(self):
+    other_user = users.User(email='already-signed-up@gmail.com')
+    self._Store(PicturesqueUser(id=GOOGLEPLUS_USER_ID,
+                                user_object=other_user))
+
+    self.assertRaises(endpoints.ForbiddenException,
+                      PicturesqueUser.GetOrCreateAccount, self.user,
+                      GOOGLEPLUS_USER_ID)
+    self.assertEqual(other_user, self._Stored().user_object)
+    self.assertEqual(0, self.transactions.count)
+
+  def testNewAccountIsCreated(self):
+    account = PicturesqueUser.GetOrCreateAccount(self.user,
+                                                 GOOGLEPLUS_USER_ID)
+
+    self.assertEqual(GOOGLEPLUS_USER_ID, account.key.id())
+    self.assertEqual(self.user, account.user_object)
+    self.assertEqual([], account.in_users_acl_list)
+    self.assertEqual(self.user, self._Stored().user_object)
+    self.assertEqual(1, self.transactions.count)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,317 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module for pluggable storage of photo contents.
+
+By default the contents of a photo are stored inline, in the base64Photo
+property of its Photo entity. Setting a storage backend moves them out of
+the entity: Photo stores the contents in the backend under a new key when
+they change and keeps only the key ('contentKey') and size, so queries and
+writes which don't need the bytes (ACL updates, patches, counting usage) no
+longer read or write them. A backend is set once per instance, e.g. in
+appengine_config.py:
+
+  import photo_storage
+  photo_storage.set_storage(photo_storage.BlobServiceStorage('my-bucket'))
+
+Every backend implements the Storage interface (put, get, delete and stream
+by key):
+
+  - DatastoreStorage keeps the contents in PhotoContent entities, written
+    outside of any transaction the photo is put in.
+  - BlobServiceStorage keeps them as objects in a Cloud Storage bucket, via
+    the Cloud Storage client library (which must be added to the app).
+  - LocalFileStorage keeps them as files in a local directory and reads them
+    with mmap, so streaming them doesn't copy the bytes. It is meant for
+    tests and benchmark.py; instances can't write to their filesystem.
+
+Photos written before a backend was set keep their inline contents and are
+still read from the entity. Contents are never updated in place: new
+contents get a new key and the old key is deleted once the photo is
+committed. Every backend stores contents at once, even when the photo is
+put in a transaction, so a retried transaction (which puts the same Photo
+object again) can point the photo at contents stored by an earlier attempt;
+a failed transaction can at worst leave unused contents behind.
+"""
+
+
+import mmap
+import os
+import re
+import tempfile
+import uuid
+
+from google.appengine.ext import ndb
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+KEY_REGEX = re.compile('^[a-zA-Z0-9_-]+$')
+
+_STORAGE = None
+
+
+class Storage(object):
+  """Interface of a photo contents storage backend.
+
+  Keys are created by NewKey and are only written once; GetMulti and Stream
+  have default implementations in terms of Get.
+  """
+
+  def NewKey(self):
+    """Creates a new, unused key.
+
+    Returns:
+      String key.
+    """
+    return uuid.uuid4().hex
+
+  def Put(self, key, contents, mime_type=None):
+    """Stores contents under a key.
+
+    Args:
+      key: String key from NewKey.
+      contents: String; the photo contents.
+      mime_type: Optional MIME type of the contents.
+    """
+    raise NotImplementedError
+
+  def Get(self, key):
+    """Retrieves the contents stored under a key.
+
+    Args:
+      key: String key.
+
+    Returns:
+      String contents, or None if there are none.
+    """
+    raise NotImplementedError
+
+  def GetMulti(self, keys):
+    """Retrieves the contents stored under several keys.
+
+    Args:
+      keys: List of string keys.
+
+    Returns:
+      List of string contents (or None) in the same order as keys.
+    """
+    return [self.Get(key) for key in keys]
+
+  def Delete(self, key):
+    """Deletes the contents stored under a key, if any.
+
+    Args:
+      key: String key.
+    """
+    raise NotImplementedError
+
+  def Stream(self, key, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the contents stored under a key in chunks.
+
+    Args:
+      key: String key.
+      chunk_size: Integer; maximum number of bytes per chunk.
+
+    Returns:
+      Iterator of strings (or buffers), empty if there are no contents.
+    """
+    contents = self.Get(key) or ''
+    for offset in xrange(0, len(contents), chunk_size):
+      yield buffer(contents, offset, chunk_size)
+
+
+class PhotoContent(ndb.Model):
+  """Model for the contents of a photo, keyed by storage key.
+
+  Attributes:
+    contents: String; the photo contents.
+  """
+
+  # Contents are read once per request, so caching them would only evict
+  # more useful entries.
+  _use_cache = False
+  _use_memcache = False
+
+  contents = ndb.BlobProperty(indexed=False)
+
+
+class DatastoreStorage(Storage):
+  """Stores contents in PhotoContent entities."""
+
+  @ndb.non_transactional
+  def Put(self, key, contents, mime_type=None):
+    # Not part of the photo's transaction, so a rolled back attempt doesn't
+    # take the contents with it; see the module docstring.
+    PhotoContent(id=key, contents=contents).put()
+
+  def Get(self, key):
+    return self.GetMulti([key])[0]
+
+  def GetMulti(self, keys):
+    entities = ndb.get_multi([ndb.Key(PhotoContent, key) for key in keys])
+    return [entity and entity.contents for entity in entities]
+
+  def Delete(self, key):
+    ndb.Key(PhotoContent, key).delete()
+
+
+class BlobServiceStorage(Storage):
+  """Stores contents as objects in a Cloud Storage bucket.
+
+  Args:
+    bucket: String; name of the bucket.
+    prefix: String; prefix for object names. Defaults to 'photos/'.
+  """
+
+  def __init__(self, bucket, prefix='photos/'):
+    self.bucket = bucket
+    self.prefix = prefix
+
+  @staticmethod
+  def _Client():
+    """Imports the Cloud Storage client library."""
+    # Only needed here, so not imported when an instance starts.
+    import cloudstorage
+    return cloudstorage
+
+  def _ObjectName(self, key):
+    """Gets the full object name for a key."""
+    return '/%s/%s%s' % (self.bucket, self.prefix, key)
+
+  def Put(self, key, contents, mime_type=None):
+    client = self._Client()
+    with client.open(self._ObjectName(key), 'w',
+                     content_type=mime_type) as fh:
+      fh.write(contents)
+
+  def Get(self, key):
+    client = self._Client()
+    try:
+      with client.open(self._ObjectName(key)) as fh:
+        return fh.read()
+    except client.NotFoundError:
+      return None
+
+  def Delete(self, key):
+    client = self._Client()
+    try:
+      client.delete(self._ObjectName(key))
+    except client.NotFoundError:
+      pass
+
+  def Stream(self, key, chunk_size=DEFAULT_CHUNK_SIZE):
+    client = self._Client()
+    try:
+      fh = client.open(self._ObjectName(key), read_buffer_size=chunk_size)
+    except client.NotFoundError:
+      return
+    with fh:
+      while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+          return
+        yield chunk
+
+
+class LocalFileStorage(Storage):
+  """Stores contents as files under a local directory.
+
+  Files are written to a temporary file and renamed into place, so readers
+  never see partial contents.
+
+  Args:
+    root: String; path of the directory, which is created if needed.
+  """
+
+  def __init__(self, root):
+    self.root = root
+
+  def _Path(self, key):
+    """Gets the path of the file for a key.
+
+    Raises:
+      ValueError: if the key contains characters which aren't allowed in
+        keys created by NewKey.
+    """
+    if not KEY_REGEX.match(key):
+      raise ValueError('Invalid storage key %r.' % (key,))
+    # Spread files over subdirectories to keep directories small.
+    return os.path.join(self.root, key[:2], key)
+
+  def Put(self, key, contents, mime_type=None):
+    path = self._Path(key)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:  # Created by another thread in the meantime.
+        if not os.path.isdir(directory):
+          raise
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+      with os.fdopen(fd, 'wb') as fh:
+        fh.write(contents)
+      os.rename(temp_path, path)
+    finally:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  def _Map(self, key):
+    """Maps the file for a key into memory.
+
+    Returns:
+      A read-only mmap.mmap, '' for an empty file or None if there is no
+        file.
+    """
+    try:
+      fh = open(self._Path(key), 'rb')
+    except IOError:
+      return None
+    with fh:
+      if not os.fstat(fh.fileno()).st_size:
+        return ''  # Empty files can't be mapped.
+      return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def Get(self, key):
+    mapped = self._Map(key)
+    if not mapped:
+      return mapped
+    try:
+      return mapped[:]
+    finally:
+      mapped.close()
+
+  def Delete(self, key):
+    try:
+      os.remove(self._Path(key))
+    except OSError:
+      pass
+
+  def Stream(self, key, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields buffers over the mapped file, so no bytes are copied.
+
+    The file stays mapped until the last buffer is garbage collected.
+    """
+    mapped = self._Map(key)
+    if not mapped:
+      return
+    for offset in xrange(0, len(mapped), chunk_size):
+      yield buffer(mapped, offset, chunk_size)
+
+
+def set_storage(storage):
+  """Sets the storage backend for photo contents on this instance.
+
+  Args:
+    storage: A Storage, or None to store contents inline in Photo entities.
+  """
+  global _STORAGE
+  _STORAGE = storage
+
+
+def get_storage():
+  """Gets the storage backend for photo contents.
+
+  Returns:
+    The Storage set with set_storage, or None if contents are stored inline.
+  """
+  return _STORAGE
@@ -8,15 +8,26 @@ single sentence description for each method.
 """
 
 
-from google.appengine.ext import deferred
 from google.appengine.ext import endpoints
 from google.appengine.ext import ndb
 from protorpc import message_types
 from protorpc import remote
 
 import auth_util
+from models import AclBulkRequest
+from models import DuplicateReport
+from models import DuplicatesResponse
+from models import FindDuplicatesRequest
 from models import Photo
+from models import PhotoBatchRequest
+from models import PhotoBatchResponse
 from models import PicturesqueUser
+from models import ShareGroup
+from models import SimilarPhotosRequest
+from models import SimilarPhotosResponse
+from models import UsageResponse
+from models import UsageShard
+import rate_limit
 import settings
 
 
@@ -31,6 +42,7 @@ class PicturesqueApi(remote.Service):
   # photo Resource
   @Photo.method(request_fields=Photo.NewPhotoSchema,
                 path='photo', name='photo.create')
+  @rate_limit.limited(rate_limit.UPLOAD)
   def PhotoCreate(self, photo):
     """Simple method to create a photo with title and description."""
 
@@ -45,9 +57,14 @@ class PicturesqueApi(remote.Service):
     # Raises:
     #   endpoints.BadRequestException: if the request does not have a title
     #     or base64 photo contents. This results in a 400 response.
+    #   endpoints.ForbiddenException: if the photo would exceed the user's
+    #     storage quota. This results in a 403 response.
     # """
     current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
     photo.owner = current_picturesque_user.user_object
+    parent = Photo.OwnerParent(current_picturesque_user.googleplus_user_id)
+    if parent is not None:
+      photo._key = ndb.Key(Photo, None, parent=parent)
 
     if photo.title is None:
       raise endpoints.BadRequestException(Photo.TITLE_NEEDED)
@@ -56,22 +73,33 @@ class PicturesqueApi(remote.Service):
     if photo.mime_type is None:
       raise endpoints.BadRequestException(Photo.MIME_TYPE_NEEDED)
 
-    photo.put()
+    photo_bytes = len(photo.base64_photo)
+    UsageShard.RequireQuota(photo.owner, photo_bytes)
+    photo.ExtractMetadata()
+    photo.ComputePerceptualHash()
+
+    def create_photo():
+      photo.put()
+      UsageShard.Add(photo.owner, 1, photo_bytes)
+
+    ndb.transaction(create_photo, xg=True)
     return photo
 
-  @Photo.method(request_fields=('key',),
+  @Photo.method(request_fields=('key',), response_message=Photo.ProtoModel(),
                 http_method='GET', path='photo/{key}', name='photo.read')
+  @rate_limit.limited(rate_limit.READ)
   def PhotoRead(self, photo):
     """Retrieve Photo with metadata by key."""
 
-    # Sets the value of _is_mine based on whether the current user is the owner.
+    # Determines 'isMine' based on whether the current user is the owner and
+    # builds the response directly with Photo.Serializer.
 
     # Args:
     #   photo: An instance of Photo parsed from the request.
 
     # Returns:
-    #   The instance of Photo parsed from the request if the included key
-    #     corresponds to an entity from the the datastore.
+    #   A Photo message for the instance parsed from the request if the
+    #     included key corresponds to an entity from the the datastore.
 
     # Raises:
     #   endpoints.NotFoundException: if the key from the request does not
@@ -85,19 +113,19 @@ class PicturesqueApi(remote.Service):
     if not photo.from_datastore:
       raise endpoints.NotFoundException(Photo.NOT_FOUND_ERROR)
 
-    if photo.owner == current_picturesque_user.user_object:
-      photo._is_mine = True
+    is_mine = photo.owner == current_picturesque_user.user_object
     # In the case the signed-in user is not the owner, check the ACL
-    elif current_picturesque_user.googleplus_user_id not in photo.acl:
+    if (not is_mine and
+        not photo.IsSharedWith(current_picturesque_user.googleplus_user_id)):
       raise endpoints.ForbiddenException(Photo.FORBIDDEN_ERROR)
-    else:
-      photo._is_mine = False
 
-    return photo
+    Photo.LoadContents([photo])
+    return Photo.Serializer().ToMessage(photo, is_mine)
 
   @Photo.method(request_fields=('key',),
                 response_message=message_types.VoidMessage,
                 http_method='DELETE', path='photo/{key}', name='photo.delete')
+  @rate_limit.limited(rate_limit.WRITE)
   def PhotoDelete(self, photo):
     """Delete Photo and metadata by key."""
 
@@ -112,11 +140,18 @@ class PicturesqueApi(remote.Service):
     #    content response.
     # """
     PicturesqueUser.RequireOwner(photo)
-    photo.key.delete()
+
+    def delete_photo():
+      photo._key.delete()
+      UsageShard.Add(photo.owner, -1, -photo.ContentSize())
+
+    ndb.transaction(delete_photo, xg=True)
+    Photo.DeleteContents([photo.content_key])
     return message_types.VoidMessage()
 
   @Photo.method(request_message=Photo.ProtoModel(),
                 http_method='PUT', path='photo/{key}', name='photo.update')
+  @rate_limit.limited(rate_limit.UPLOAD)
   def PhotoUpdate(self, photo_request):
     """Update Photo/metadata by key."""
 
@@ -137,6 +172,7 @@ class PicturesqueApi(remote.Service):
 
   @Photo.method(request_fields=Photo.PatchPhotoSchema,
                 http_method='PATCH', path='photo/{key}', name='photo.patch')
+  @rate_limit.limited(rate_limit.WRITE)
   def PhotoPatch(self, photo):
     """Patch Photo/metadata by key."""
 
@@ -151,16 +187,19 @@ class PicturesqueApi(remote.Service):
     # """
     PicturesqueUser.RequireOwner(photo)
     photo.put()
+    Photo.LoadContents([photo])
     return photo
 
   @Photo.query_method(query_fields=Photo.QueryFields,
                       path='photos', name='photo.list')
+  @rate_limit.limited(rate_limit.LIST)
   def PhotoList(self, query):
     """Get list of Photos based on queries."""
 
     # The query user will be set by the setter for the 'ownerGoogleplusUserId'
     # property; this setter is always called since the propery has a default
-    # value so the query will always specify an owner.
+    # value so the query will always specify an owner (as a filter, or as the
+    # ancestor if Photo.OWNER_ANCESTOR_QUERIES is set).
 
     # Args:
     #   query: An ndb.Query object corresponding to the Photo kind. Values
@@ -170,14 +209,124 @@ class PicturesqueApi(remote.Service):
 
     # Returns:
     #   The query object parsed from the request, sorted in ascending order by
-    #     the 'updated' timestamp property.
+    #     the 'updated' timestamp property, or by 'takenAt' if requested via
+    #     'orderBy' or the 'takenAfter'/'takenBefore' filters. Ties are broken
+    #     by key, which is needed for cursors when the ACL filter matches share
+    #     groups.
+    # """
+    if not query.orders:
+      query = query.order(Photo.updated)
+    return query.order(Photo._key)
+
+  @endpoints.method(PhotoBatchRequest, PhotoBatchResponse,
+                    path='photos/batch', name='photo.batch')
+  @rate_limit.limited(rate_limit.UPLOAD)
+  def PhotoBatch(self, request):
+    """Apply a batch of queued photo creates, patches and deletes."""
+
+    # Used by clients to replay writes made while offline. The client
+    # coalesces its queued writes per photo before sending, so a photo edited
+    # many times offline results in a single operation here.
+
+    # Args:
+    #   request: An instance of PhotoBatchRequest parsed from the request.
+
+    # Returns:
+    #   An instance of PhotoBatchResponse with one result per operation. Failed
+    #     operations carry an error message instead of failing the request.
+
+    # Raises:
+    #   endpoints.BadRequestException: if the batch contains too many
+    #     operations. This results in a 400 response.
+    # """
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    return Photo.ApplyBatch(request, current_picturesque_user)
+
+  @endpoints.method(SimilarPhotosRequest, SimilarPhotosResponse,
+                    http_method='GET', path='photo/{key}/similar',
+                    name='photo.similar')
+  @rate_limit.limited(rate_limit.LIST)
+  def PhotoSimilar(self, request):
+    """Find own photos which look like one of them."""
+
+    # Photos are compared by their perceptual hash (see image_hash.py), which
+    # is computed when their contents are written. Only the photos sharing
+    # (nearly) a segment of the hash are read; see Photo.FindSimilarAsync.
+
+    # Args:
+    #   request: An instance of SimilarPhotosRequest parsed from the request.
+
+    # Returns:
+    #   An instance of SimilarPhotosResponse with the keys and distances of
+    #     the similar photos, closest first.
+
+    # Raises:
+    #   endpoints.BadRequestException: if the key or distance is invalid.
+    #     This results in a 400 response.
+    #   endpoints.NotFoundException: if the photo doesn't exist. This results
+    #     in a 404 response.
+    #   endpoints.ForbiddenException: if the current user doesn't own the
+    #     photo. This results in a 403 response.
+    # """
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    return Photo.FindSimilarPhotos(request, current_picturesque_user)
+
+  @endpoints.method(FindDuplicatesRequest, message_types.VoidMessage,
+                    path='photos/duplicates', name='photo.findDuplicates')
+  @rate_limit.limited(rate_limit.BULK)
+  def PhotoFindDuplicates(self, request):
+    """Start a search for groups of near-identical own photos."""
+
+    # The search is run as a background job in batches (see
+    # FindDuplicatesJob), so the response is sent before it is done. Its
+    # result replaces that of any earlier search and is read with
+    # photo.duplicates.
+
+    # Args:
+    #   request: An instance of FindDuplicatesRequest parsed from the request.
+
+    # Returns:
+    #   An instance of message_types.VoidMessage. This results in a 204 no
+    #    content response.
+
+    # Raises:
+    #   endpoints.BadRequestException: if the distance is invalid. This
+    #     results in a 400 response.
     # """
-    return query.order(Photo.updated)
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    Photo.StartDuplicateSearch(request, current_picturesque_user)
+    return message_types.VoidMessage()
+
+  @endpoints.method(message_types.VoidMessage, DuplicatesResponse,
+                    http_method='GET', path='photos/duplicates',
+                    name='photo.duplicates')
+  @rate_limit.limited(rate_limit.READ)
+  def PhotoDuplicates(self, unused_request):
+    """Get the groups of near-identical photos from the last search."""
+
+    # Args:
+    #   unused_request: An instance of message_types.VoidMessage.
+
+    # Returns:
+    #   An instance of DuplicatesResponse; while the search is running, with
+    #     the groups found so far.
+
+    # Raises:
+    #   endpoints.NotFoundException: if the current user never started a
+    #     search. This results in a 404 response.
+    # """
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    report = DuplicateReport.get_by_id(
+        current_picturesque_user.googleplus_user_id)
+    if report is None:
+      raise endpoints.NotFoundException(DuplicateReport.NOT_FOUND_ERROR)
+    return report.ToMessage()
 
   # users Resource
   @PicturesqueUser.method(request_message=message_types.VoidMessage,
                           user_required=True,
                           path='users/join', name='users.join')
+  @rate_limit.limited(rate_limit.SIGN_UP)
   def SignUp(self, unused_request):
     """Sign up to create a Picturesque user account."""
 
@@ -201,10 +350,31 @@ class PicturesqueApi(remote.Service):
     current_user = endpoints.get_current_user()
     return PicturesqueUser.GetOrCreateAccount(current_user, googleplus_user_id)
 
+  @endpoints.method(message_types.VoidMessage, UsageResponse,
+                    http_method='GET', path='users/usage', name='users.usage')
+  @rate_limit.limited(rate_limit.READ)
+  def UserUsage(self, unused_request):
+    """Get storage usage and quota for the current user."""
+
+    # Args:
+    #   unused_request: An instance of message_types.VoidMessage.
+
+    # Returns:
+    #   An instance of UsageResponse with the counts of photos and bytes the
+    #     current user stores and the limits on them.
+    # """
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    photo_count, byte_count = UsageShard.GetUsage(
+        current_picturesque_user.user_object)
+    return UsageResponse(photoCount=photo_count, byteCount=byte_count,
+                         photoQuota=UsageShard.MAX_PHOTOS,
+                         byteQuota=UsageShard.MAX_BYTES)
+
   # acl Resource
   @Photo.method(request_fields=Photo.AddAclSchema,
                 response_fields=Photo.AclSchema,
                 path='acl/{key}', name='acl.addUsers')
+  @rate_limit.limited(rate_limit.WRITE)
   def AclInsert(self, photo):
     """Insert ACL for own photo."""
 
@@ -213,7 +383,8 @@ class PicturesqueApi(remote.Service):
 
     # Allows new users to be appended to the ACL for a given photo. Only the
     # owner can change ACLs. This is done by updated the 'acl' property on
-    # the current photo.
+    # the current photo. Share groups (see ShareGroup) owned by the current
+    # user can be added by their ACL entry.
 
     # Args:
     #   photo: An instance of Photo parsed from the request.
@@ -226,20 +397,211 @@ class PicturesqueApi(remote.Service):
     current_picturesque_user = PicturesqueUser.RequireOwner(photo)
     googleplus_user_id = current_picturesque_user.googleplus_user_id
 
-    def update_other_users():
-      for acl_id in set(photo.acl_user_ids):
-        # TODO(dhermes): Find and address the bug in endpoints-proto-datastore
-        #                or ndb that causes this to be needed.
-        if isinstance(acl_id, ndb.model._BaseValue):
-          acl_id = acl_id.b_val
+    acl_ids = set()
+    for acl_id in photo.acl_user_ids:
+      # TODO(dhermes): Find and address the bug in endpoints-proto-datastore
+      #                or ndb that causes this to be needed.
+      if isinstance(acl_id, ndb.model._BaseValue):
+        acl_id = acl_id.b_val
+      acl_ids.add(acl_id)
+    ShareGroup.RequireOwnedAclEntries(acl_ids, photo.owner)
 
-        if acl_id not in photo.acl:
-          photo.acl.append(acl_id)
-          deferred.defer(PicturesqueUser.UpdateInList, acl_id,
-                         googleplus_user_id, _transactional=True)
+    def update_other_users():
+      added_ids = acl_ids.difference(photo.acl)
+      photo.acl.extend(sorted(added_ids))
       photo.put()
+      # Group members are tracked when they are added to the group.
+      PicturesqueUser.EnqueueInListUpdates(
+          [acl_id for acl_id in added_ids
+           if ShareGroup.ParseAclEntry(acl_id) is None],
+          (), googleplus_user_id, transactional=True)
 
-    # This spawns tasks for each new ACL user, but does so transactionally;
+    # This spawns tasks for the new ACL users, but does so transactionally;
     # only if the photo object is put() successfully.
     ndb.transaction(update_other_users)
     return photo
+
+  @Photo.method(request_fields=Photo.RemoveAclSchema,
+                response_fields=Photo.AclSchema,
+                path='acl/{key}/remove', name='acl.removeUsers')
+  @rate_limit.limited(rate_limit.WRITE)
+  def AclRemove(self, photo):
+    """Remove users from ACL for own photo."""
+
+    # Only the key for retrieving the photo and an alias property containing
+    # the Google+ IDs to be removed from the ACL.
+
+    # Only the owner can change ACLs. The removal from the photo is done in a
+    # transaction; updating the in_users_acl_list of the removed users is done
+    # in tasks spawned transactionally.
+
+    # Args:
+    #   photo: An instance of Photo parsed from the request.
+
+    # Returns:
+    #   The updated instance of Photo if the ACL update was successful. Only the
+    #     key and the new ACL list will be returned since the AclSchema is used
+    #     for the response.
+    # """
+    current_picturesque_user = PicturesqueUser.RequireOwner(photo)
+    googleplus_user_id = current_picturesque_user.googleplus_user_id
+
+    def remove_other_users():
+      to_remove = set()
+      for acl_id in photo.acl_user_ids:
+        # See AclInsert.
+        if isinstance(acl_id, ndb.model._BaseValue):
+          acl_id = acl_id.b_val
+        to_remove.add(acl_id)
+
+      removed = to_remove.intersection(photo.acl)
+      if removed:
+        photo.acl = [acl_id for acl_id in photo.acl if acl_id not in removed]
+        photo.put()
+      PicturesqueUser.EnqueueInListUpdates(
+          (), [acl_id for acl_id in removed
+               if ShareGroup.ParseAclEntry(acl_id) is None],
+          googleplus_user_id, transactional=True)
+
+    ndb.transaction(remove_other_users)
+    return photo
+
+  @endpoints.method(AclBulkRequest, message_types.VoidMessage,
+                    path='acl/bulk', name='acl.bulkUpdate')
+  @rate_limit.limited(rate_limit.BULK)
+  def AclBulkUpdate(self, request):
+    """Remove users from or replace the ACL of many own photos."""
+
+    # For example, to unshare all photos with a user, send REMOVE with just
+    # that user's Google+ ID and no photo keys.
+
+    # The update is run as a background job in batches (see
+    # AclBulkUpdateJob), so the response is sent before the ACLs are
+    # updated. Photos in photoKeys not owned by the current user are skipped.
+
+    # Args:
+    #   request: An instance of AclBulkRequest parsed from the request.
+
+    # Returns:
+    #   An instance of message_types.VoidMessage. This results in a 204 no
+    #    content response.
+
+    # Raises:
+    #   endpoints.BadRequestException: if the ACL user IDs or photo keys are
+    #     invalid. This results in a 400 response.
+    # """
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    Photo.StartAclBulkUpdate(request, current_picturesque_user)
+    return message_types.VoidMessage()
+
+  # shareGroup Resource
+  @ShareGroup.method(request_fields=ShareGroup.NewShareGroupSchema,
+                     path='shareGroup', name='shareGroup.create')
+  @rate_limit.limited(rate_limit.WRITE)
+  def ShareGroupCreate(self, share_group):
+    """Create a named group of users to share photos with."""
+
+    # Photos are shared with the group by adding its 'aclEntry' to the photo
+    # ACL with acl.addUsers.
+
+    # Args:
+    #   share_group: An instance of ShareGroup parsed from the request.
+
+    # Returns:
+    #   The instance of ShareGroup parsed from the request with a key and ACL
+    #     entry added after being inserted into the datastore.
+
+    # Raises:
+    #   endpoints.BadRequestException: if the request does not have a name or
+    #     has an empty member ID. This results in a 400 response.
+    # """
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    share_group.owner = current_picturesque_user.user_object
+    share_group.CheckValues()
+
+    def create_group():
+      share_group.put()
+      PicturesqueUser.EnqueueInListUpdates(
+          set(share_group.member_ids), (),
+          current_picturesque_user.googleplus_user_id, transactional=True)
+
+    ndb.transaction(create_group)
+    return share_group
+
+  @ShareGroup.method(request_fields=('key', 'name', 'memberIds'),
+                     http_method='PATCH', path='shareGroup/{key}',
+                     name='shareGroup.patch')
+  @rate_limit.limited(rate_limit.WRITE)
+  def ShareGroupPatch(self, share_group):
+    """Rename own share group or replace its members."""
+
+    # Changing the members only writes the group; photos shared with the
+    # group are not touched.
+
+    # Args:
+    #   share_group: An instance of ShareGroup parsed from the request.
+
+    # Returns:
+    #   The updated instance of ShareGroup if the update was successful.
+    # """
+    current_picturesque_user = PicturesqueUser.RequireOwner(share_group)
+    share_group.CheckValues()
+
+    def update_group():
+      stored = share_group._key.get(use_cache=False)
+      previous_ids = set(stored.member_ids)
+      member_ids = set(share_group.member_ids)
+      share_group.put()
+      PicturesqueUser.EnqueueInListUpdates(
+          member_ids - previous_ids, previous_ids - member_ids,
+          current_picturesque_user.googleplus_user_id, transactional=True)
+
+    ndb.transaction(update_group)
+    return share_group
+
+  @ShareGroup.method(request_fields=('key',),
+                     response_message=message_types.VoidMessage,
+                     http_method='DELETE', path='shareGroup/{key}',
+                     name='shareGroup.delete')
+  @rate_limit.limited(rate_limit.WRITE)
+  def ShareGroupDelete(self, share_group):
+    """Delete own share group by key."""
+
+    # Photos shared with the group keep its (now unused) ACL entry, which no
+    # longer grants access to anyone.
+
+    # Args:
+    #   share_group: An instance of ShareGroup parsed from the request.
+
+    # Returns:
+    #   An instance of message_types.VoidMessage. This results in a 204 no
+    #    content response.
+    # """
+    current_picturesque_user = PicturesqueUser.RequireOwner(share_group)
+
+    def delete_group():
+      share_group._key.delete()
+      PicturesqueUser.EnqueueInListUpdates(
+          (), set(share_group.member_ids),
+          current_picturesque_user.googleplus_user_id, transactional=True)
+
+    ndb.transaction(delete_group)
+    return message_types.VoidMessage()
+
+  @ShareGroup.query_method(query_fields=('limit', 'pageToken'),
+                           path='shareGroups', name='shareGroup.list')
+  @rate_limit.limited(rate_limit.LIST)
+  def ShareGroupList(self, query):
+    """Get list of own share groups."""
+
+    # Args:
+    #   query: An ndb.Query object corresponding to the ShareGroup kind.
+
+    # Returns:
+    #   The query object restricted to groups owned by the current user,
+    #     sorted by name.
+    # """
+    current_picturesque_user = PicturesqueUser.RequirePicturesqueUser()
+    return query.filter(
+        ShareGroup.owner == current_picturesque_user.user_object).order(
+            ShareGroup.name)
@@ -7,15 +7,12 @@ the test user and create the default set of new photos.
 """
 
 
-import base64
-import json
 import os
 
 from google.appengine.api import users
-from google.appengine.ext import ndb
 
 import appengine_config  # For import path mangling
-import models
+import library_io
 import settings
 
 
@@ -27,11 +24,7 @@ DEMO_IMAGES_FILE = os.path.join(os.path.dirname(__file__),
 
 def remove_all_existing():
   """Removes all existing Photos owned by the test user."""
-  existing_query = models.Photo.query(models.Photo.owner == TEST_USER)
-  more_results = True
-  while more_results:
-    keys, _, more_results = existing_query.fetch_page(10, keys_only=True)
-    ndb.delete_multi(keys)
+  library_io.delete_library(TEST_USER)
 
 
 def add_demo_photos():
@@ -41,17 +34,9 @@ def add_demo_photos():
   corresponding to those items in DEMO_IMAGES_FILE.
   """
   with open(DEMO_IMAGES_FILE, 'r') as fh:
-    items = json.load(fh)
-
-  new_photos = []
-  for item in items:
-    new_photo = models.Photo()
-    new_photo.base64_photo = base64.b64decode(item['base64Photo'])
-    new_photo.mime_type = item['mimeType']
-    new_photo.title = item['title']
-    new_photo.owner = TEST_USER
-    new_photos.append(new_photo)
-  ndb.put_multi(new_photos)
+    library_io.import_library(
+        TEST_USER, fh,
+        googleplus_user_id=getattr(settings, 'TEST_USER_GOOGLEPLUS_ID', None))
 
 
 def reset_test_user():
@@ -0,0 +1,239 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Module for per-user rate limiting of API methods.
+
+Methods are limited by decorating them (below the Endpoints decorator, so
+the current user is known) with limited and one of the Limit constants:
+
+  @Photo.query_method(...)
+  @rate_limit.limited(rate_limit.LIST)
+  def PhotoList(self, query):
+
+The limit is therefore checked after endpoints-proto-datastore has turned
+the request message into an entity or query, so rejected calls still pay
+for the RPCs that conversion makes: the get of the photo in Photo.KeySet,
+and for photo.list of another owner's photos, the account lookup in
+PicturesqueUser.ExistingAccount and the share group query in
+ShareGroup.AclEntriesFor. The Endpoints decorator only sets up the current
+user right before the conversion, so the limit can't be checked any
+earlier. It bounds the cost of the methods themselves; the gets made by the
+conversion are usually served from ndb's caches.
+
+Each (method, Google+ ID) pair gets a token bucket holding up to burst
+tokens, refilled at rate tokens per second; a call takes one token. Buckets
+are kept in two tiers:
+
+  - Each instance keeps an in-memory bucket, so most calls are admitted or
+    rejected without any RPC.
+  - Across instances, memcache counts the tokens taken in fixed windows of
+    burst / rate seconds, allowing burst per window. Instances lease tokens
+    from the current window a few at a time with a single incr, so the
+    memcache cost is one RPC per lease rather than per call.
+
+A call is admitted only if both tiers have a token. If memcache is
+unavailable, only the instance tier applies.
+
+Rejected calls raise RateLimitExceededException. The Endpoints SPI doesn't
+pass through 429 responses or Retry-After headers, so this is a 503 (which
+clients already retry with backoff) with the delay in the message.
+"""
+
+
+import functools
+import httplib
+import math
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import endpoints
+
+import auth_util
+
+
+MEMCACHE_NAMESPACE = 'picturesque-rate-limit'
+# Number of leases the tokens of a window are split into.
+LEASES_PER_WINDOW = 4
+# Buckets idle for this long are dropped when there are too many.
+MAX_BUCKETS = 10000
+IDLE_SECONDS = 600
+# Set to False (e.g. in benchmark.py) to admit every call.
+ENABLED = True
+
+
+class Limit(object):
+  """A token bucket rate limit.
+
+  Args:
+    rate: Number; tokens added per second.
+    burst: Integer; maximum number of tokens in the bucket.
+  """
+
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.window_seconds = burst / float(rate)
+    self.lease = max(1, burst // LEASES_PER_WINDOW)
+
+
+READ = Limit(rate=10, burst=50)
+LIST = Limit(rate=5, burst=20)
+WRITE = Limit(rate=2, burst=20)
+UPLOAD = Limit(rate=1, burst=10)
+SIGN_UP = Limit(rate=1, burst=5)
+BULK = Limit(rate=0.1, burst=2)
+
+
+class RateLimitExceededException(endpoints.ServiceException):
+  """Rate limit exception that is mapped to a 503 response.
+
+  Args:
+    retry_after: Number of seconds until the call would be admitted.
+  """
+
+  http_status = httplib.SERVICE_UNAVAILABLE
+
+  def __init__(self, retry_after):
+    self.retry_after = int(math.ceil(retry_after))
+    super(RateLimitExceededException, self).__init__(
+        'Rate limit exceeded. Retry after %d seconds.' % (self.retry_after,))
+
+
+class _Bucket(object):
+  """In-memory state of a token bucket on this instance."""
+
+  def __init__(self, limit, now):
+    self.tokens = float(limit.burst)
+    self.updated = now
+    self.leased = 0
+    self.lease_window = None
+    self.blocked_until = 0
+
+
+class RateLimiter(object):
+  """Token buckets for this instance, leasing tokens from memcache.
+
+  Thread safe; the memcache RPC is made outside the lock.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._buckets = {}
+
+  def Admit(self, key, limit, now=None):
+    """Takes a token from a bucket if possible.
+
+    Args:
+      key: String identifying the bucket.
+      limit: The Limit of the bucket.
+      now: Optional current time in seconds; for tests.
+
+    Returns:
+      0 if the call is admitted, else the number of seconds until it would
+        be.
+    """
+    if now is None:
+      now = time.time()
+    window = int(now // limit.window_seconds)
+
+    with self._lock:
+      bucket = self._GetBucket(key, limit, now)
+      retry_after = self._LocalRetryAfter(bucket, limit, now)
+      if retry_after:
+        return retry_after
+      if bucket.lease_window == window and bucket.leased >= 1:
+        bucket.tokens -= 1
+        bucket.leased -= 1
+        return 0
+
+    granted = self._Lease(key, limit, window)
+
+    with self._lock:
+      if not granted:
+        bucket.blocked_until = (window + 1) * limit.window_seconds
+        return bucket.blocked_until - now
+      bucket.lease_window = window
+      bucket.leased = granted
+      # Other threads may have taken the instance tokens in the meantime.
+      retry_after = self._LocalRetryAfter(bucket, limit, now)
+      if retry_after:
+        return retry_after
+      bucket.tokens -= 1
+      bucket.leased -= 1
+      return 0
+
+  def _GetBucket(self, key, limit, now):
+    """Gets (or creates) a bucket, refilled up to now; call with the lock."""
+    bucket = self._buckets.get(key)
+    if bucket is None:
+      if len(self._buckets) >= MAX_BUCKETS:
+        self._Prune(now)
+      bucket = _Bucket(limit, now)
+      self._buckets[key] = bucket
+    else:
+      bucket.tokens = min(limit.burst,
+                          bucket.tokens + (now - bucket.updated) * limit.rate)
+      bucket.updated = now
+    return bucket
+
+  @staticmethod
+  def _LocalRetryAfter(bucket, limit, now):
+    """Seconds until the instance tier admits a call; call with the lock."""
+    if bucket.blocked_until > now:
+      return bucket.blocked_until - now
+    if bucket.tokens < 1:
+      return (1 - bucket.tokens) / limit.rate
+    return 0
+
+  @staticmethod
+  def _Lease(key, limit, window):
+    """Leases tokens of the current window from memcache.
+
+    Returns:
+      Integer; number of tokens leased, up to limit.lease.
+    """
+    used = memcache.incr('%s:%d' % (key, window), delta=limit.lease,
+                         initial_value=0, namespace=MEMCACHE_NAMESPACE)
+    if used is None:  # Memcache is unavailable; rely on the instance tier.
+      return limit.lease
+    return max(0, min(limit.lease, limit.burst - (used - limit.lease)))
+
+  def _Prune(self, now):
+    """Drops idle buckets; call with the lock."""
+    for key, bucket in self._buckets.items():
+      if now - bucket.updated > IDLE_SECONDS:
+        del self._buckets[key]
+
+
+_LIMITER = RateLimiter()
+
+
+def limited(limit):
+  """Decorator rate limiting an API method per user.
+
+  Calls without a Google+ ID in the environment are not limited; the method
+  rejects those anyway. The request has already been converted when the
+  limit is checked; see the module docstring.
+
+  Args:
+    limit: The Limit to apply to each user.
+
+  Returns:
+    Decorator for methods of a remote.Service.
+  """
+  def decorator(method):
+
+    @functools.wraps(method)
+    def limited_method(service_instance, *args, **kwargs):
+      if ENABLED:
+        googleplus_user_id = auth_util.get_google_plus_user_id()
+        if googleplus_user_id is not None:
+          retry_after = _LIMITER.Admit(
+              '%s:%s' % (method.__name__, googleplus_user_id), limit)
+          if retry_after:
+            raise RateLimitExceededException(retry_after)
+      return method(service_instance, *args, **kwargs)
+
+    return limited_method
+
+  return decorator
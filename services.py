@@ -3,12 +3,24 @@
 """Services module for creating an Endpoints API server."""
 
 
-from google.appengine.ext import endpoints
-
+import api_config_cache
+import instrumentation
 import picturesque
 
 
 api_list = [
     picturesque.PicturesqueApi,
 ]
-application = endpoints.api_server(api_list, restricted=False)
+API_SERVER_KWARGS = {'restricted': False}
+application = instrumentation.InstrumentedApplication(
+    api_config_cache.api_server(api_list, **API_SERVER_KWARGS))
+
+
+def warmup(unused_environ, start_response):
+  """WSGI application for warmup requests.
+
+  Importing this module is the actual work; it creates the API server so the
+  instance is ready before it receives user traffic.
+  """
+  start_response('200 OK', [('Content-Type', 'text/plain')])
+  return ['']
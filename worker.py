@@ -0,0 +1,13 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Worker module handling background job tasks (see jobs.py)."""
+
+
+import instrumentation
+import jobs
+import migrations  # Registers the migration job type.
+import models  # Registers the job types.
+
+
+application = instrumentation.InstrumentedApplication(jobs.application,
+                                                      prefix=jobs.JOB_PREFIX)